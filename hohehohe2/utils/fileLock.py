@@ -1,9 +1,420 @@
 # -*- coding: utf-8 -*-
 
-import os, time, datetime, logging
+import os, time, json, random, errno, select, socket, datetime, logging, threading, collections
 from hohehohe2.utils.myException import MyException
 
 
+_local = threading.local()
+"""
+スレッドごとのロック待ちに用いるinotifyインスタンス。
+"""
+
+_OWNER_FILE_NAME = 'owner'
+"""
+FileLockのロックディレクトリの中で所有者を記録するファイルの名前。
+"""
+
+_leaseObservations = collections.OrderedDict()
+"""
+{ロックのパス: (所有者の記録, 最初にその記録を見た時刻)}
+リースのあるロックの所有者の記録が変わらずにいる時間を、このプロセスの時計で測るためのもの。
+"""
+
+_leaseObservationsLock = threading.Lock()
+
+_MAX_LEASE_OBSERVATIONS = 1024
+"""
+_leaseObservationsに覚えておくロックの数の上限。古いものから忘れる。
+"""
+
+
+#============================================================================
+#============================================================================
+def _getInotify():
+	"""
+	このスレッドのinotifyインスタンスを返す。inotifyが使えなければNoneを返す。
+	inotifyインスタンスを閉じるには時間がかかるので、ロックを待つたびに作らずスレッドごとに使い回す。
+	"""
+	instance = getattr(_local, 'inotify', None)
+	if instance is None:
+		instance = False
+		from hohehohe2.utils import inotify
+		if inotify.isAvailable():
+			try:
+				instance = inotify.Inotify()
+			except OSError:
+				logging.debug('Failed creating an inotify instance for file locks.')
+		_local.inotify = instance
+	return instance or None
+
+
+#============================================================================
+#============================================================================
+def _getFcntl():
+	"""
+	fcntlモジュールを返す。使えない環境（Windows等）では例外を送出する。
+	"""
+	try:
+		import fcntl
+	except ImportError:
+		msg = 'fcntl is not available. Use FileLock instead of FlockFileLock.'
+		logging.error(msg)
+		raise MyException(msg)
+	return fcntl
+
+
+#============================================================================
+#============================================================================
+def _flock(fd, operation, timeoutSec):
+	"""
+	fdをflockでロックしTrueを返す。timeoutSec以内にロックできなければfdを閉じてFalseを返す。
+	ロックできない場合はポーリングせず、ロックできるまでブロックするスレッドを起こしてその完了をタイムアウトつきで待つ。
+	タイムアウト後にそのスレッドがロックできた場合は、そのスレッドがすぐに解放してfdを閉じる。
+	"""
+	fcntl = _getFcntl()
+	try:
+		fcntl.flock(fd, operation | fcntl.LOCK_NB)
+		return True
+	except IOError as e:
+		if not e.errno in (errno.EAGAIN, errno.EACCES):
+			os.close(fd)
+			raise
+	if timeoutSec <= 0:
+		os.close(fd)
+		return False
+
+	#Python 2のthreading.Condition.wait()はタイムアウトを指定するとポーリングになるので、完了はパイプで通知する。
+	readFd, writeFd = os.pipe()
+	stateLock = threading.Lock()
+	state = {'abandoned': False, 'done': False, 'locked': False}
+
+	def waitForLock():
+		try:
+			try:
+				fcntl.flock(fd, operation)
+				locked = True
+			except IOError:
+				logging.debug('flock failed ' + repr(fd))
+				locked = False
+			with stateLock:
+				if state['abandoned']:
+					#待っていた側はタイムアウトした。
+					if locked:
+						fcntl.flock(fd, fcntl.LOCK_UN)
+					os.close(fd)
+					return
+				state['done'] = True
+				state['locked'] = locked
+				os.write(writeFd, 'x')
+		finally:
+			os.close(writeFd)
+
+	thread = threading.Thread(target=waitForLock)
+	thread.daemon = True
+	thread.start()
+
+	try:
+		endTime = time.time() + timeoutSec
+		while True:
+			remainingSec = max(endTime - time.time(), 0)
+			try:
+				readable, writable, exceptional = select.select([readFd], [], [], remainingSec)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			if readable or remainingSec <= 0:
+				break
+
+		with stateLock:
+			#タイムアウトと同時にロックできた場合もあるのでstateで判定する。
+			if not state['done']:
+				state['abandoned'] = True
+				return False
+	finally:
+		os.close(readFd)
+
+	if not state['locked']:
+		os.close(fd)
+		return False
+	return True
+
+
+#============================================================================
+#============================================================================
+def _getProcessStartTime(pid):
+	"""
+	プロセスの起動時刻（Linuxの/proc/<pid>/statのstarttime）を文字列で返す。PIDが再利用されたかどうかの判定に用いる。わからなければNoneを返す。
+	"""
+	try:
+		with open('/proc/%d/stat' % pid) as f:
+			data = f.read()
+	except (IOError, OSError):
+		return None
+	#コマンド名は括弧で囲まれ空白を含むことがあるので、閉じ括弧の後から数える。
+	fields = data[data.rfind(')') + 2:].split()
+	return fields[19] if len(fields) > 19 else None
+
+
+#============================================================================
+#============================================================================
+def _getOwnProcessStartTime():
+	"""
+	このプロセスの起動時刻を返す。ロックのたびに/procを読まないよう、最初に読んだ値をPIDとともに覚えておく（fork後は読み直す）。
+	"""
+	pid = os.getpid()
+	cached = getattr(_getOwnProcessStartTime, 'cached', None)
+	if cached is None or cached[0] != pid:
+		cached = _getOwnProcessStartTime.cached = (pid, _getProcessStartTime(pid))
+	return cached[1]
+
+
+#============================================================================
+#============================================================================
+def _isProcessDead(host, pid, processStartTime):
+	"""
+	プロセスが終了していることが確実であればTrueを返す。
+	他のホストのプロセスは確認できないのでFalseを返す。
+	"""
+	if host != socket.gethostname() or os.name == 'nt': #Windowsのos.killはプロセスを終了させる。
+		return False
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		if e.errno == errno.ESRCH:
+			return True
+	#PIDが再利用されていれば起動時刻が異なる。
+	currentStartTime = _getProcessStartTime(pid)
+	return bool(processStartTime and currentStartTime and processStartTime != currentStartTime)
+
+
+#============================================================================
+#============================================================================
+def _readLockOwner(lockFilePath):
+	"""
+	ロックディレクトリに記録された所有者のdictを返す。記録されていないか読めなければNoneを返す。
+	"""
+	return _readOwnerFile(os.path.join(lockFilePath, _OWNER_FILE_NAME))
+
+
+#============================================================================
+#============================================================================
+def _readOwnerFile(ownerFilePath):
+	"""
+	所有者を記録したファイルから所有者のdictを返す。記録されていないか読めなければNoneを返す。
+	"""
+	try:
+		with open(ownerFilePath, 'rb') as f:
+			owner = json.load(f)
+	except (IOError, OSError, ValueError):
+		return None
+	return owner if isinstance(owner, dict) else None
+
+
+#============================================================================
+#============================================================================
+def _getLeaseSec(owner):
+	"""
+	所有者の記録からリースの秒数を返す。リースがなければNoneを返す。
+	"""
+	leaseSec = owner.get('leaseSec')
+	if leaseSec is None and not owner.get('leaseExpiry') is None:
+		#リースの期限を記録する古いバージョン。期限と取得時刻はどちらも所有者の時計なので差は秒数として使える。
+		leaseSec = owner['leaseExpiry'] - owner.get('startTime', 0)
+	return leaseSec
+
+
+#============================================================================
+#============================================================================
+def _hasLeaseExpired(lockPath, owner, leaseSec):
+	"""
+	lockPathの所有者の記録がownerのまま、このプロセスの時計でleaseSec以上変わっていなければTrueを返す。
+	所有者はリースを延長するたびに記録を書き換える。他のホストと時計がずれていても誤って解除しないよう、所有者が記録した時刻は比較に用いない。
+	"""
+	record = (owner.get('token'), owner.get('renewals'), owner.get('leaseExpiry'))
+	now = time.time()
+	with _leaseObservationsLock:
+		observation = _leaseObservations.get(lockPath)
+		if observation is None or observation[0] != record:
+			#初めて見たか、延長されたか、他の所有者に変わった。
+			_leaseObservations.pop(lockPath, None)
+			_leaseObservations[lockPath] = (record, now)
+			while len(_leaseObservations) > _MAX_LEASE_OBSERVATIONS:
+				_leaseObservations.popitem(last=False)
+			return False
+	return now - observation[1] >= leaseSec
+
+
+#============================================================================
+#============================================================================
+def _forgetLease(lockPath):
+	"""
+	lockPathの所有者の記録を見た時刻を忘れる。
+	"""
+	with _leaseObservationsLock:
+		_leaseObservations.pop(lockPath, None)
+
+
+#============================================================================
+#============================================================================
+def _isStaleOwner(lockFilePath, owner):
+	"""
+	所有者のリースが切れているか、所有者のプロセスが終了していることが確実であればTrueを返す。
+	"""
+	if owner is None:
+		#記録の途中か、記録しない古いバージョンによるロック。
+		return False
+	leaseSec = _getLeaseSec(owner)
+	if not leaseSec is None and _hasLeaseExpired(lockFilePath, owner, leaseSec):
+		return True
+	return _isProcessDead(owner.get('host'), owner.get('pid'), owner.get('processStartTime'))
+
+
+#============================================================================
+#============================================================================
+def _describeLockOwner(owner):
+	"""
+	ログに出力するための所有者の説明を返す。
+	"""
+	if owner is None:
+		return 'unknown owner'
+	description = 'host %s, pid %s, locked at %s' % (owner.get('host'), owner.get('pid'), datetime.datetime.fromtimestamp(owner.get('startTime', 0)))
+	leaseSec = _getLeaseSec(owner)
+	if not leaseSec is None:
+		description += ', lease %s sec' % leaseSec
+	return description
+
+
+#============================================================================
+#============================================================================
+def _breakStaleLock(lockFilePath):
+	"""
+	ロックディレクトリの所有者のプロセスが終了しているかリースが切れていれば、ロックを解除してTrueを返す。
+	ロックディレクトリ自体ではなく中の所有者のファイルの名前を変え、それが確認した所有者のものである場合のみディレクトリを削除する。
+	ディレクトリは削除するまで存在し続けるので、他のプロセスと同時に解除しようとしたり、その間に他のプロセスが取得し直したりしても、二つのプロセスがロックを持つことはない。
+	"""
+	owner = _readLockOwner(lockFilePath)
+	if not _isStaleOwner(lockFilePath, owner) or owner.get('token') is None:
+		return False
+
+	ownerFilePath = os.path.join(lockFilePath, _OWNER_FILE_NAME)
+	brokenFilePath = '%s.broken_%08x' % (ownerFilePath, random.getrandbits(32))
+	try:
+		os.rename(ownerFilePath, brokenFilePath)
+	except OSError:
+		#他のプロセスが先に解除したか、所有者が解放した。
+		return False
+
+	#所有者を確認してから名前を変えるまでの間に、所有者が解放して他のプロセスが取得し直したロックであれば元に戻す。
+	#このディレクトリはその取得したプロセスのものなので、他のプロセスが所有者のファイルを作ることはない。
+	brokenOwner = _readOwnerFile(brokenFilePath)
+	if brokenOwner is None or brokenOwner.get('token') != owner['token']:
+		try:
+			if os.path.exists(ownerFilePath):
+				#取得し直したプロセスがリースを延長した。
+				os.remove(brokenFilePath)
+			else:
+				os.rename(brokenFilePath, ownerFilePath)
+		except OSError:
+			pass
+		return False
+
+	#所有者のファイルがないので、他のプロセスはこのロックを解除しようとしない。リースを延長するスレッドの一時ファイルが残っていれば合わせて削除する。
+	logging.warning('Broke a stale lock %s held by %s.' % (repr(lockFilePath), _describeLockOwner(owner)))
+	_forgetLease(lockFilePath)
+	try:
+		for fileName in os.listdir(lockFilePath):
+			os.remove(os.path.join(lockFilePath, fileName))
+		os.rmdir(lockFilePath)
+	except OSError:
+		msg = 'Could not delete a stale lock file ' + repr(lockFilePath)
+		logging.warning(msg)
+		return False
+	return True
+
+
+#============================================================================
+#============================================================================
+class _LockWaiter(object):
+	"""
+	ロックが解放されるのを待つ。
+	inotifyが使えればロックファイルのあるディレクトリを監視し、ロックファイルが削除されたらすぐに起きる。
+	待つ時間は最初はミリ秒程度で、解放されないたびにジッターをつけて倍にしていく。inotifyが使えない場合や他のホストによる解放は通知されないので、その場合はこのポーリングで検知する。
+	"""
+
+	__MIN_SLEEP_SEC = 0.001
+	"""
+	最初に待つ秒数。
+	"""
+
+	def __init__(self, lockFilePath, maxSleepSec):
+		self.__lockFilePath = lockFilePath
+		self.__lockFileName = os.path.basename(lockFilePath)
+
+		self.__maxSleepSec = maxSleepSec
+		"""
+		待つ秒数の上限。
+		"""
+
+		self.__sleepSec = min(self.__MIN_SLEEP_SEC, maxSleepSec)
+		"""
+		次に待つ秒数の上限。
+		"""
+
+		self.__watch = None
+		"""
+		最初にwait()したときに作られる(inotifyインスタンス, watch descriptor)。監視できなければFalse。
+		"""
+
+	def wait(self, timeoutSec):
+		"""
+		ロックが解放されるか、待つ時間（最大timeoutSec）が過ぎるまで待つ。
+		"""
+		sleepSec = min(random.uniform(self.__sleepSec / 2.0, self.__sleepSec), timeoutSec)
+		self.__sleepSec = min(self.__sleepSec * 2, self.__maxSleepSec)
+		if sleepSec <= 0:
+			return
+
+		if self.__watch is None:
+			self.__watch = self.__addWatch()
+			#監視を始める前に解放されていれば通知されない。
+			if self.__watch and not os.path.exists(self.__lockFilePath):
+				return
+
+		if not self.__watch:
+			time.sleep(sleepSec)
+			return
+
+		from hohehohe2.utils import inotify
+		instance, watchDescriptor = self.__watch
+		endTime = time.time() + sleepSec
+		while True:
+			remainingSec = endTime - time.time()
+			if remainingSec <= 0:
+				return
+			#以前に監視したディレクトリのイベントが残っている場合があるのでwatch descriptorでも区別する。
+			for wd, mask, cookie, name in instance.readEvents(remainingSec):
+				if (wd == watchDescriptor and name == self.__lockFileName) or mask & inotify.IN_Q_OVERFLOW:
+					return
+
+	def close(self):
+		if self.__watch:
+			instance, watchDescriptor = self.__watch
+			instance.removeWatch(watchDescriptor)
+		self.__watch = None
+
+	def __addWatch(self):
+		from hohehohe2.utils import inotify
+		instance = _getInotify()
+		if instance is None:
+			return False
+		try:
+			return instance, instance.addWatch(os.path.dirname(self.__lockFilePath), inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_ONLYDIR)
+		except OSError:
+			#ディレクトリがない、監視数の上限に達した等。
+			return False
+
+
 #============================================================================
 #============================================================================
 class _FileLockBase(object):
@@ -15,7 +426,8 @@ class _FileLockBase(object):
 
 	_SLEEP_SEC = 0.5
 	"""
-	ファイルロックが取得できない場合に次にトライするまでの秒数。
+	ファイルロックが取得できない場合に次にトライするまでの秒数の上限。
+	待つ時間はミリ秒程度から倍にしていき、同じホストのプロセスによる解放はinotifyで通知されればすぐに起きる。_LockWaiterを参照。
 	"""
 
 	def __init__(self, filePath, timeLimitSec=5.0):
@@ -23,6 +435,13 @@ class _FileLockBase(object):
 		self._timeLimit = datetime.timedelta(seconds=timeLimitSec)
 		self._lockFilePath = self.getLockFilePath(filePath)
 
+	def _getRemainingSec(self, startTime):
+		"""
+		startTimeから数えたタイムアウトまでの秒数を返す。過ぎていれば0を返す。
+		"""
+		remaining = self._timeLimit - (datetime.datetime.now() - startTime)
+		return max(remaining.total_seconds(), 0.0)
+
 	@classmethod
 	def isLocked(cls, filePath):
 		return os.path.exists(cls.getLockFilePath(filePath))
@@ -45,31 +464,336 @@ class FileLock(_FileLockBase):
 				fileContents = fileContents[::-1] #例としてファイル内の文字を逆順にならべる。
 			with open(filePath, 'w') as f:
 				fileContents = f.write(fileContents)
+
+	sharedをTrueにすると読み込み用の共有ロックになる。共有ロック同士は同時に取得でき、共有ロックがある間は排他ロックの取得を待つ。
+		with FileLock(filePath, shared=True):
+			with open(filePath, 'r') as f:
+				fileContents = f.read()
+
+	排他ロックを待っているプロセスがあれば新たな共有ロックはその後に取得されるので、読み込みが多くても書き込みが待たされ続けることはない。
+	共有ロックは読み込み中のプロセスごとにディレクトリ（getReadLockDirPath()）にファイルを作ることで表す。
+	leaseSecを指定した共有ロックはそのファイルに所有者を記録し、排他ロックと同じくリースが切れると排他ロックを待つプロセスに削除される。
+
+	排他ロックのディレクトリには所有者（ホスト、PID、取得時刻、リースの期限）を記録する（getOwner()）。
+	ロックを待つプロセスは、所有者のプロセスが終了していることが確実な場合（同じホストのみ判定できる）やリースが切れている場合はロックを解除して取得する。
+	leaseSecを指定すると、待っているプロセスが所有者の記録をその秒数の間変わらずに見たときにリースが切れる。長く保持する場合はheartbeatをTrueにすると、スレッドが定期的に記録を書き換えてリースを延長する。
+	リースは待っているプロセスの時計だけで測るので、ホスト間で時計がずれていても構わない。待ち始めてからleaseSecの間は解除されない。
+	他のホストのプロセスが異常終了したロックはリースによってのみ解除されるので、NFS上のファイルではleaseSecを指定すること。
+
+	timeLimitSecを0にすると待たずに一度だけ試す。取得できなければ例外を送出するが、エラーログは出さない。
+	"""
+
+	__READ_LOCK_PREFIX = '.rlock_'
 	"""
+	共有ロックを持つプロセスのファイルを置くディレクトリの名前につけるプレフィックス。
+	"""
+
+	def __init__(self, filePath, timeLimitSec=5.0, shared=False, leaseSec=None, heartbeat=False, sharedLocking=False):
+		"""
+		sharedLockingはFlockFileLockと同じ引数で呼べるようにするためのもの。FileLockの排他ロックは常に共有ロックより優先されるので用いない。
+		"""
+		super(FileLock, self).__init__(filePath, timeLimitSec)
+		self._shared = shared
+		self._readLockDirPath = self.getReadLockDirPath(self._filePath)
+		self.__readerFilePath = None
+
+		self.__leaseSec = leaseSec
+		"""
+		リースの秒数。Noneならリースは切れない。
+		"""
+
+		self.__heartbeat = heartbeat and not leaseSec is None
+		self.__owner = None
+		self.__ownerLock = threading.Lock()
+		self.__heartbeatStop = None
+		"""
+		記録した所有者、その更新のロック、リースを延長するスレッドを止めるためのEvent。
+		"""
 
 	def __enter__(self):
 		startTime = datetime.datetime.now()
-		while(True):
-			try:
-				os.mkdir(self._lockFilePath)
-				return
-			except:
+		if self._shared:
+			self.__lockShared(startTime)
+			return
+
+		waiter = _LockWaiter(self._lockFilePath, self._SLEEP_SEC)
+		try:
+			while(True):
+				try:
+					os.mkdir(self._lockFilePath)
+					break
+				except:
+					if _breakStaleLock(self._lockFilePath):
+						continue
+					if datetime.datetime.now() - startTime > self._timeLimit:
+						msg = 'Could not lock file %s held by %s' % (repr(self._filePath), _describeLockOwner(self.getOwner(self._filePath)))
+						if self._timeLimit: #timeLimitSecが0なら一度試すだけなので、取得できないのはエラーではない。
+							logging.error(msg)
+							import traceback
+							logging.error(traceback.format_exc())
+						raise MyException(msg)
+				waiter.wait(self._getRemainingSec(startTime))
+		finally:
+			waiter.close()
+		self.__recordOwner()
+
+		#ロックを取得してから共有ロックが全て解放されるのを待つ。その間に新たな共有ロックは取得されない。
+		waiter = _LockWaiter(self._readLockDirPath, self._SLEEP_SEC)
+		try:
+			while self.__hasReaders():
 				if datetime.datetime.now() - startTime > self._timeLimit:
-					msg = 'Could not lock file ' + repr(self._filePath)
-					logging.error(msg)
-					import traceback
-					logging.error(traceback.format_exc())
+					self.__exit__(None, None, None)
+					msg = 'Could not lock file %s. It is being read by %s.' % (repr(self._filePath), ', '.join(self.__getReaderFileNames()))
+					if self._timeLimit:
+						logging.error(msg)
 					raise MyException(msg)
-			time.sleep(self._SLEEP_SEC)
+				waiter.wait(self._getRemainingSec(startTime))
+		finally:
+			waiter.close()
 
 	def __exit__(self, exc_type, exc_value, traceback):
+		if self._shared:
+			self.__stopHeartbeat()
+			self.__removeReader(self.__readerFilePath)
+			self.__readerFilePath = None
+			return True
+
+		owner = self.__stopHeartbeat()
+
+		#リースが切れて他のプロセスに解除されていれば、他のプロセスが取得し直したロックを削除しないようにする。
+		#リースがなければ、このプロセスが終了しない限り解除されないので確認しない。
+		if owner and not self.__leaseSec is None and (_readLockOwner(self._lockFilePath) or {}).get('token') != owner['token']:
+			msg = 'A lock file %s was broken by another process since the lease had expired.' % repr(self._lockFilePath)
+			logging.warning(msg)
+			return True
+
 		try:
+			if owner:
+				os.remove(os.path.join(self._lockFilePath, _OWNER_FILE_NAME))
 			os.rmdir(self._lockFilePath)
 		except:
 			msg = 'Could not delete a lock file ' + repr(self._lockFilePath)
 			logging.warning(msg)
 		return True
 
+	@classmethod
+	def getOwner(cls, filePath):
+		"""
+		filePathの排他ロックの所有者をdictで返す。ロックされていないか所有者がわからなければNoneを返す。
+			host, pid: 所有者のホスト名とPID。
+			processStartTime: 所有者のプロセスの起動時刻。PIDの再利用の判定に用いる。
+			startTime: ロックを取得した時刻（所有者のtime.time()）。
+			leaseSec: リースの秒数。Noneならリースはない。
+			renewals: リースを延長した回数。
+			token: ロックの取得ごとに異なる値。
+		"""
+		return _readLockOwner(cls.getLockFilePath(os.path.abspath(os.path.normpath(filePath))))
+
+	def __makeOwner(self):
+		"""
+		記録する所有者のdictを作る。
+		"""
+		return {
+			'host': socket.gethostname(),
+			'pid': os.getpid(),
+			'processStartTime': _getOwnProcessStartTime(),
+			'startTime': time.time(),
+			'leaseSec': self.__leaseSec,
+			'renewals': 0,
+			'token': '%016x' % random.getrandbits(64),
+		}
+
+	def __recordOwner(self):
+		"""
+		ロックディレクトリに所有者を記録し、必要ならリースを延長するスレッドを開始する。
+		"""
+		owner = self.__makeOwner()
+		try:
+			#作ったばかりのディレクトリなので、書き込み途中を読まれても所有者がわからないロックとして扱われるだけ。
+			#ファイルシステムの操作を減らすため、fileオブジェクトを使わずに一度に書き込む。
+			fd = os.open(os.path.join(self._lockFilePath, _OWNER_FILE_NAME), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+			try:
+				os.write(fd, json.dumps(owner))
+			finally:
+				os.close(fd)
+		except (IOError, OSError):
+			msg = 'Could not record the owner of a lock file ' + repr(self._lockFilePath)
+			logging.warning(msg)
+			return
+		self.__owner = owner
+		self.__startHeartbeat()
+
+	def __startHeartbeat(self):
+		"""
+		必要ならリースを延長するスレッドを開始する。
+		"""
+		if self.__heartbeat:
+			self.__heartbeatStop = threading.Event()
+			thread = threading.Thread(target=self.__renewLease, args=(self.__heartbeatStop,))
+			thread.daemon = True
+			thread.start()
+
+	def __stopHeartbeat(self):
+		"""
+		リースを延長するスレッドを止め、記録した所有者を返す。
+		"""
+		with self.__ownerLock:
+			if self.__heartbeatStop:
+				self.__heartbeatStop.set()
+				self.__heartbeatStop = None
+			owner, self.__owner = self.__owner, None
+		return owner
+
+	def __renewLease(self, stop):
+		"""
+		リースの1/3の間隔で所有者の記録を書き換えてリースを延長する。
+		"""
+		while not stop.wait(self.__leaseSec / 3.0):
+			with self.__ownerLock:
+				if stop.is_set():
+					return
+				if self._shared:
+					#共有ロックのファイルは一時ファイルを置くと共有ロックとみなされるので直接書き換える。削除されていれば作り直さない。
+					owner = dict(self.__owner, renewals=self.__owner['renewals'] + 1)
+					try:
+						fd = os.open(self.__readerFilePath, os.O_WRONLY | os.O_TRUNC)
+					except OSError:
+						#リースが切れて排他ロックを待つプロセスに削除された。
+						return
+					try:
+						os.write(fd, json.dumps(owner))
+					finally:
+						os.close(fd)
+					self.__owner = owner
+					continue
+
+				if (_readLockOwner(self._lockFilePath) or {}).get('token') != self.__owner['token']:
+					#他のプロセスに解除された。
+					return
+				owner = dict(self.__owner, renewals=self.__owner['renewals'] + 1)
+				ownerFilePath = os.path.join(self._lockFilePath, _OWNER_FILE_NAME)
+				tmpFilePath = '%s.tmp_%08x' % (ownerFilePath, random.getrandbits(32))
+				try:
+					with open(tmpFilePath, 'wb') as f:
+						json.dump(owner, f)
+					os.rename(tmpFilePath, ownerFilePath)
+				except (IOError, OSError):
+					msg = 'Could not renew the lease of a lock file ' + repr(self._lockFilePath)
+					logging.warning(msg)
+					continue
+				self.__owner = owner
+
+	@classmethod
+	def getReadLockDirPath(cls, filePath):
+		return os.path.join(os.path.dirname(filePath), cls.__READ_LOCK_PREFIX + os.path.basename(filePath))
+
+	def __lockShared(self, startTime):
+		"""
+		共有ロックを取得する。
+		"""
+		waiter = _LockWaiter(self._lockFilePath, self._SLEEP_SEC)
+		try:
+			while(True):
+				if not os.path.exists(self._lockFilePath) or _breakStaleLock(self._lockFilePath):
+					readerFilePath = self.__addReader()
+					if readerFilePath:
+						#登録する間に排他ロックが取得されていれば、そちらを優先する。
+						if not os.path.exists(self._lockFilePath):
+							self.__readerFilePath = readerFilePath
+							self.__startHeartbeat()
+							return
+						self.__stopHeartbeat()
+						self.__removeReader(readerFilePath)
+
+				if datetime.datetime.now() - startTime > self._timeLimit:
+					msg = 'Could not lock file %s for reading.' % repr(self._filePath)
+					if self._timeLimit: #timeLimitSecが0なら一度試すだけなので、取得できないのはエラーではない。
+						logging.error(msg)
+					raise MyException(msg)
+				waiter.wait(self._getRemainingSec(startTime))
+		finally:
+			waiter.close()
+
+	def __addReader(self):
+		"""
+		共有ロックを持つことを示すファイルを作りそのパスを返す。作れなければNoneを返す。
+		"""
+		try:
+			os.mkdir(self._readLockDirPath)
+		except OSError:
+			#既にある。
+			pass
+
+		#プロセスが終了したまま残ったファイルを判別できるよう、名前に所有者を含める。
+		readerFilePath = os.path.join(self._readLockDirPath, '%s_%d_%s_%d_%08x' % (socket.gethostname(), os.getpid(), _getOwnProcessStartTime(), threading.current_thread().ident, random.getrandbits(32)))
+		try:
+			fd = os.open(readerFilePath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+		except OSError:
+			#他のプロセスがディレクトリを削除した等。
+			return None
+		try:
+			if not self.__leaseSec is None:
+				#他のホストで異常終了してもリースで削除できるよう所有者を記録する。書き込み途中を読まれてもリースのない共有ロックとして扱われるだけ。
+				owner = self.__makeOwner()
+				os.write(fd, json.dumps(owner))
+				self.__owner = owner
+		finally:
+			os.close(fd)
+		return readerFilePath
+
+	def __removeReader(self, readerFilePath):
+		"""
+		共有ロックを持つことを示すファイルを削除する。最後の一つであればディレクトリも削除し、排他ロックを待つプロセスに通知する。
+		"""
+		try:
+			os.remove(readerFilePath)
+		except OSError:
+			msg = 'Could not delete a read lock file ' + repr(readerFilePath)
+			logging.warning(msg)
+		try:
+			os.rmdir(self._readLockDirPath)
+		except OSError:
+			#他に共有ロックがある。
+			pass
+
+	def __hasReaders(self):
+		"""
+		共有ロックを持つプロセスがあればTrueを返す。終了したプロセスのものやリースが切れたものは削除する。
+		"""
+		hasReaders = False
+		for readerFileName in self.__getReaderFileNames():
+			readerFilePath = os.path.join(self._readLockDirPath, readerFileName)
+			fields = readerFileName.rsplit('_', 4)
+			if len(fields) == 5 and fields[1].isdigit() and _isProcessDead(fields[0], int(fields[1]), None if fields[2] == 'None' else fields[2]):
+				logging.warning('Removed a stale read lock file %s.' % repr(readerFileName))
+				self.__removeReader(readerFilePath)
+			elif self.__hasReaderLeaseExpired(readerFilePath):
+				logging.warning('Removed a read lock file %s whose lease had expired.' % repr(readerFileName))
+				_forgetLease(readerFilePath)
+				self.__removeReader(readerFilePath)
+			else:
+				hasReaders = True
+		return hasReaders
+
+	def __hasReaderLeaseExpired(self, readerFilePath):
+		"""
+		共有ロックのファイルに記録された所有者のリースが切れていればTrueを返す。リースのない共有ロックならFalseを返す。
+		"""
+		owner = _readOwnerFile(readerFilePath)
+		if owner is None:
+			return False
+		leaseSec = _getLeaseSec(owner)
+		return not leaseSec is None and _hasLeaseExpired(readerFilePath, owner, leaseSec)
+
+	def __getReaderFileNames(self):
+		"""
+		共有ロックを持つプロセスのファイル名（ホスト名_PID_起動時刻_スレッドID_乱数）のリストを返す。
+		"""
+		try:
+			return os.listdir(self._readLockDirPath)
+		except OSError:
+			return []
+
 
 #============================================================================
 #============================================================================
@@ -83,10 +807,236 @@ class FileLockWait(_FileLockBase):
 	def __enter__(self):
 
 		startTime = datetime.datetime.now()
-		while(datetime.datetime.now() - startTime < self._timeLimit):
-			if not os.path.exists(self._lockFilePath):
-				break
-			time.sleep(self._SLEEP_SEC)
+		waiter = _LockWaiter(self._lockFilePath, self._SLEEP_SEC)
+		try:
+			while(datetime.datetime.now() - startTime < self._timeLimit):
+				if not os.path.exists(self._lockFilePath) or _breakStaleLock(self._lockFilePath):
+					break
+				waiter.wait(self._getRemainingSec(startTime))
+		finally:
+			waiter.close()
 
 	def __exit__(self, exc_type, exc_value, traceback):
 		return True
+
+
+#============================================================================
+#============================================================================
+class FlockFileLock(_FileLockBase):
+	"""
+	カーネルのアドバイザリロック（flock）を用いるファイルロック機構。使い方はFileLockと同じで、sharedをTrueにすると読み込み用の共有ロックになる。
+	ロックファイルは削除せずに残し、ロックを取得するときにそのファイルをflockする。
+	FileLockに比べ取得と解放にかかるファイルシステムの操作が少なく、プロセスが異常終了してもカーネルが自動的に解放するのでロックファイルが残ってブロックし続けることがない。
+	ロックを待つ場合はポーリングせずにブロックし、timeLimitSecを過ぎれば例外を送出する。
+	共有ロックを用いる場合は、排他ロックを待つプロセスを優先するためのゲートのファイルも作る。同じファイルに共有ロックも用いるなら排他ロックはsharedLockingをTrueにすること。
+	注：fcntlが使えない環境（Windows等）では使えない。
+	注：NFSでのflockはサーバーとクライアントがロックをサポートしている場合のみ有効。FileLockとは互いに排他されないので、同じファイルには同じ種類のロックを用いること。
+	"""
+
+	__PREFIX = '.flock_'
+	"""
+	ロックファイルの名前につけるプレフィックス。
+	"""
+
+	__GATE_PREFIX = '.flockgate_'
+	"""
+	共有ロックを用いる場合に、排他ロックを待つプロセスを優先するためのファイルの名前につけるプレフィックス。
+	"""
+
+	def __init__(self, filePath, timeLimitSec=5.0, shared=False, sharedLocking=False):
+		super(FlockFileLock, self).__init__(filePath, timeLimitSec)
+		self._shared = shared
+
+		self.__usesGate = shared or sharedLocking
+		"""
+		ロックを取得する間にゲートを排他ロックするならTrue。
+		共有ロックはゲートを用いるので、同じファイルに共有ロックも用いる場合は排他ロックのsharedLockingをTrueにすること。
+		Falseでも排他制御は正しく行われるが、共有ロックが続くと排他ロックが待たされ続けることがある。
+		"""
+
+		self.__gateFilePath = os.path.join(os.path.dirname(self._filePath), self.__GATE_PREFIX + os.path.basename(self._filePath))
+
+	def __enter__(self):
+		fcntl = _getFcntl()
+		startTime = datetime.datetime.now()
+
+		#ロックを取得する間はゲートを排他ロックする。排他ロックを待つプロセスがゲートを持つので、その後に来た共有ロックは待たされる。
+		#flockは読み込み専用で開いたファイルにもかけられるので、他のユーザーが作ったロックファイルも用いることができる。
+		gateFd = None
+		if self.__usesGate:
+			gateFd = os.open(self.__gateFilePath, os.O_RDONLY | os.O_CREAT, 0o666)
+			if not _flock(gateFd, fcntl.LOCK_EX, self._getRemainingSec(startTime)):
+				msg = 'Could not lock file ' + repr(self._filePath)
+				if self._timeLimit:
+					logging.error(msg)
+				raise MyException(msg)
+		try:
+			fd = os.open(self._lockFilePath, os.O_RDONLY | os.O_CREAT, 0o666)
+			if not _flock(fd, fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX, self._getRemainingSec(startTime)):
+				msg = 'Could not lock file ' + repr(self._filePath)
+				if self._timeLimit:
+					logging.error(msg)
+				raise MyException(msg)
+		finally:
+			if not gateFd is None:
+				os.close(gateFd)
+		self.__fd = fd
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		#閉じればロックも解放される。
+		try:
+			os.close(self.__fd)
+		except:
+			msg = 'Could not unlock a lock file ' + repr(self._lockFilePath)
+			logging.warning(msg)
+		return True
+
+	@classmethod
+	def isLocked(cls, filePath):
+		try:
+			fd = os.open(cls.getLockFilePath(filePath), os.O_RDONLY)
+		except OSError:
+			#ロックファイルがない。
+			return False
+		fcntl = _getFcntl()
+		try:
+			fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+			return False
+		except IOError:
+			return True
+		finally:
+			os.close(fd)
+
+	@classmethod
+	def getLockFilePath(cls, filePath):
+		return os.path.join(os.path.dirname(filePath), cls.__PREFIX + os.path.basename(filePath))
+
+
+#============================================================================
+#============================================================================
+class FileLockSet(object):
+	"""
+	複数のファイルのロックをまとめて取得する。全てのロックを取得するまでの時間をtimeLimitSecで制限する。
+
+	使い方。with内では全てのファイルがロックされている。
+		with FileLockSet([filePath1, filePath2]):
+			...
+	FileLockと異なり、with内で送出された例外はロックを解放した後にそのまま送出される。
+
+	ロックは正規化したパスの順に取得する。何も保持していない間だけ一つのロックの解放を待ち、他のロックは待たずに試す。
+	一つでも取得できなければ全て解放し、ジッターをつけて待ってから取得できなかったロックの解放を待ってやり直す。
+	ロックを保持したまま待つことがないので、他の順でロックを取得するプロセスがあってもデッドロックしない。
+	待たずに試すロックは、ディレクトリが複数あればディレクトリごとに並列に取得する（NFS等でファイル操作の遅延が大きい場合に速くなる）。
+
+	lockClass(path, timeLimitSec)でロックを作る。FileLock、FlockFileLock、または同じ引数でロックを返す関数。
+	ロックはtimeLimitSecを過ぎればMyExceptionを送出し、0なら待たずに一度だけ試すものとする。
+	"""
+
+	def __init__(self, paths, timeLimitSec=5.0, lockClass=FileLock):
+		self.__timeLimit = datetime.timedelta(seconds=timeLimitSec)
+		self.__lockClass = lockClass
+
+		pathByKey = {}
+		for path in paths:
+			pathByKey.setdefault(os.path.abspath(os.path.normpath(path)), path)
+		self.__paths = [pathByKey[key] for key in sorted(pathByKey)]
+		"""
+		ロックを取得する順に並べたパス。重複は除く。
+		"""
+
+		self.__locks = []
+		"""
+		取得したロック。
+		"""
+
+	def __enter__(self):
+		if not self.__paths:
+			return self
+
+		startTime = datetime.datetime.now()
+		sleepSec = 0.001
+		waitIndex = 0
+		while True:
+			#何も保持していないので待ってよい。
+			remainingSec = max((self.__timeLimit - (datetime.datetime.now() - startTime)).total_seconds(), 0.0)
+			lock = self.__lockClass(self.__paths[waitIndex], remainingSec)
+			try:
+				lock.__enter__()
+			except MyException:
+				msg = 'Could not lock files. %s is locked by another process.' % repr(self.__paths[waitIndex])
+				logging.error(msg)
+				raise MyException(msg)
+			self.__locks = [lock]
+
+			failedIndex = self.__tryLocks([i for i in range(len(self.__paths)) if i != waitIndex])
+			if failedIndex is None:
+				return self
+
+			self.__release()
+			waitIndex = failedIndex
+			if datetime.datetime.now() - startTime > self.__timeLimit:
+				msg = 'Could not lock files. %s is locked by another process.' % repr(self.__paths[waitIndex])
+				logging.error(msg)
+				raise MyException(msg)
+			time.sleep(random.uniform(sleepSec / 2.0, sleepSec))
+			sleepSec = min(sleepSec * 2, _FileLockBase._SLEEP_SEC)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.__release()
+		return False
+
+	def getPaths(self):
+		"""
+		ロックを取得する順に並べたパスのリストを返す。
+		"""
+		return list(self.__paths)
+
+	def __tryLocks(self, indices):
+		"""
+		indicesのロックを待たずに取得し、self.__locksに加える。取得できないロックがあればそのインデックス（最小のもの）を返す。
+		"""
+		indicesByDir = {}
+		for i in indices:
+			indicesByDir.setdefault(os.path.dirname(os.path.abspath(self.__paths[i])), []).append(i)
+		groups = [indicesByDir[dirPath] for dirPath in sorted(indicesByDir)]
+
+		results = [None] * len(groups)
+		def tryGroup(groupIndex):
+			locks = []
+			try:
+				for i in groups[groupIndex]:
+					lock = self.__lockClass(self.__paths[i], 0)
+					try:
+						lock.__enter__()
+					except MyException:
+						results[groupIndex] = (locks, i, None)
+						return
+					locks.append(lock)
+				results[groupIndex] = (locks, None, None)
+			except Exception as e:
+				results[groupIndex] = (locks, None, e)
+
+		threads = [threading.Thread(target=tryGroup, args=(groupIndex,)) for groupIndex in range(1, len(groups))]
+		for thread in threads:
+			thread.start()
+		if groups:
+			tryGroup(0)
+		for thread in threads:
+			thread.join()
+
+		failedIndices = []
+		error = None
+		for locks, failedIndex, e in results:
+			self.__locks.extend(locks)
+			if not failedIndex is None:
+				failedIndices.append(failedIndex)
+			error = error or e
+		if error:
+			self.__release()
+			raise error
+		return min(failedIndices) if failedIndices else None
+
+	def __release(self):
+		locks, self.__locks = self.__locks, []
+		for lock in reversed(locks):
+			lock.__exit__(None, None, None)
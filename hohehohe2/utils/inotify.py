@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Linuxのinotifyをctypesで扱うモジュール。
+inotifyが使えない環境（Linux以外、libcがない等）ではisAvailable()がFalseを返すので、呼び出し側はポーリング等にフォールバックすること。
+注：NFS等のネットワークファイルシステムでは他のホストによる変更は通知されない。
+"""
+
+import os, errno, select, struct, logging
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_CHANGED = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+"""
+ディレクトリ内のファイルの作成、変更、削除、リネームを全て含むマスク。
+"""
+
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+
+_EVENT_HEADER = struct.Struct('iIII')
+"""
+struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+"""
+
+_READ_BUFFER_SIZE = 64 * 1024
+
+_libc = None
+"""
+inotifyの関数を持つlibc。使えない環境ではFalse。未初期化ならNone。
+"""
+
+
+#============================================================================
+#============================================================================
+def _getLibc():
+	global _libc
+	if _libc is None:
+		_libc = False
+		try:
+			import sys, ctypes, ctypes.util
+			if sys.platform.startswith('linux'):
+				libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+				libc.inotify_init1.argtypes = [ctypes.c_int]
+				libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+				libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+				_libc = libc
+		except:
+			logging.debug('inotify is not available.')
+	return _libc
+
+
+#============================================================================
+#============================================================================
+def isAvailable():
+	"""
+	inotifyが使える環境であればTrueを返す。
+	"""
+	return bool(_getLibc())
+
+
+#============================================================================
+#============================================================================
+class Inotify(object):
+	"""
+	inotifyインスタンス。
+
+	使い方。
+		inotify = Inotify()
+		try:
+			inotify.addWatch(dirPath, IN_CHANGED)
+			for wd, mask, cookie, name in inotify.readEvents(timeoutSec=1.0):
+				...
+		finally:
+			inotify.close()
+	"""
+
+	def __init__(self):
+		libc = _getLibc()
+		if not libc:
+			raise OSError(errno.ENOSYS, 'inotify is not available')
+
+		self.__libc = libc
+		self.__fd = libc.inotify_init1(_IN_CLOEXEC | _IN_NONBLOCK)
+		if self.__fd < 0:
+			import ctypes
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+	def fileno(self):
+		return self.__fd
+
+	def addWatch(self, path, mask):
+		"""
+		pathを監視対象に加えwatch descriptorを返す。同じpathを再度加えた場合は同じwatch descriptorが返る。
+		"""
+		if isinstance(path, unicode):
+			import sys
+			path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+		wd = self.__libc.inotify_add_watch(self.__fd, path, mask)
+		if wd < 0:
+			import ctypes
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), path)
+		return wd
+
+	def removeWatch(self, wd):
+		"""
+		監視を解除する。既に解除されていても何もしない。
+		"""
+		self.__libc.inotify_rm_watch(self.__fd, wd)
+
+	def readEvents(self, timeoutSec=None):
+		"""
+		イベントを読み(wd, mask, cookie, name)のリストを返す。
+		timeoutSecの間イベントがなければ空リストを返す。Noneの場合はイベントがあるまで待つ。
+		"""
+		try:
+			readable, writable, exceptional = select.select([self.__fd], [], [], timeoutSec)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		if not readable:
+			return []
+
+		try:
+			data = os.read(self.__fd, _READ_BUFFER_SIZE)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EINTR):
+				return []
+			raise
+
+		events = []
+		offset = 0
+		while offset + _EVENT_HEADER.size <= len(data):
+			wd, mask, cookie, nameLength = _EVENT_HEADER.unpack_from(data, offset)
+			offset += _EVENT_HEADER.size
+			name = data[offset:offset + nameLength].rstrip('\0')
+			offset += nameLength
+			events.append((wd, mask, cookie, name))
+		return events
+
+	def close(self):
+		if self.__fd >= 0:
+			os.close(self.__fd)
+			self.__fd = -1
+
+	def __del__(self):
+		try:
+			self.close()
+		except:
+			#インタープリタ終了時等。
+			pass
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+同じホストのプロセス間で共有するpropertyの永続キャッシュ。
+新しく起動したプロセスでも、propertyファイルのstampが一致すればファイルを読まずにキャッシュのdictを用いるので、statだけで済む。
+データベースはSQLiteで、読み込みはメモリマップされる。
+
+使い方。
+	PropertyHolder.enablePersistentCache()
+
+注：データベースファイルはNFS等のネットワークファイルシステムではなくローカルディスクに置くこと。
+注：データはmarshalで読み込むので、他のユーザーが書き込めるデータベースは用いない。デフォルトのデータベースはユーザーだけが読み書きできるディレクトリに置かれ、
+注：それ以外の場所でも他のユーザーが所有しているか他のユーザーが書き込めるデータベースファイルは開かない。
+"""
+
+import os, logging, threading, marshal, sqlite3
+
+
+#============================================================================
+#============================================================================
+def getDefaultDbPath():
+	"""
+	ユーザーごとのデフォルトのデータベースファイルのパス（~/.cache/hohe2/propertyCache.db）を返す。
+	XDG_CACHE_HOMEが設定されていればその下に置く。ディレクトリはユーザーだけが読み書きできるよう作られる。
+	"""
+	cacheDirPath = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(cacheDirPath, 'hohe2', 'propertyCache.db')
+
+
+#============================================================================
+#============================================================================
+def _isPrivateFile(filePath):
+	"""
+	filePathが存在しないか、このユーザーが所有し他のユーザーが書き込めないファイルであればTrueを返す。
+	ユーザーIDのないプラットフォーム（Windows）では常にTrueを返す。
+	"""
+	if not hasattr(os, 'getuid'):
+		return True
+	try:
+		fileStat = os.lstat(filePath)
+	except OSError:
+		return not os.path.lexists(filePath)
+	import stat
+	return stat.S_ISREG(fileStat.st_mode) and fileStat.st_uid == os.getuid() and not fileStat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+#============================================================================
+#============================================================================
+class PersistentPropertyCache(object):
+	"""
+	{path: (stamp, propDict)}をSQLiteデータベースに保存するキャッシュ。
+	キャッシュなので、データベースが使えない場合や他のプロセスが書き込み中で待たされる場合はキャッシュミスとして扱い、例外は送出しない。
+	"""
+
+	__PRUNE_INTERVAL = 1000
+	"""
+	この回数set()するごとにmaxEntriesを超えた古いエントリを削除する。
+	"""
+
+	def __init__(self, dbPath=None, maxEntries=100000, mmapSizeBytes=256 * 1024 * 1024, timeLimitSec=0.1):
+		self.__dbPath = os.path.abspath(os.path.normpath(dbPath or getDefaultDbPath()))
+		"""
+		データベースファイルのパス。
+		"""
+
+		self.__maxEntries = maxEntries
+		"""
+		エントリ数の上限。超えると書き込まれたのが古いものから削除される。
+		"""
+
+		self.__mmapSizeBytes = mmapSizeBytes
+		"""
+		データベースファイルをメモリマップするバイト数。
+		"""
+
+		self.__timeLimitSec = timeLimitSec
+		"""
+		他のプロセスが書き込み中のときに待つ秒数。
+		"""
+
+		self.__local = threading.local()
+		"""
+		スレッドごとのデータベース接続。
+		"""
+
+		self.__numSets = 0
+
+		self.__isUnsafe = False
+		"""
+		データベースファイルが他のユーザーに書き込まれ得るため用いないならTrue。
+		"""
+
+	def get(self, path, stamp):
+		"""
+		pathのキャッシュのstampが一致すればdictを返す。なければNoneを返す。
+		"""
+		try:
+			row = self.__getConnection().execute('SELECT stamp, data FROM entries WHERE path = ?', (path,)).fetchone()
+			if not row or marshal.loads(str(row[0])) != stamp:
+				return None
+			return marshal.loads(str(row[1]))
+		except (sqlite3.Error, ValueError, EOFError, TypeError):
+			logging.debug('Persistent property cache read failed ' + repr(path))
+			return None
+
+	def set(self, path, stamp, propDict):
+		"""
+		pathのキャッシュを更新する。
+		"""
+		try:
+			data = (path, sqlite3.Binary(marshal.dumps(tuple(stamp), 2)), sqlite3.Binary(marshal.dumps(propDict, 2)))
+		except ValueError:
+			#marshalできない値を含む。
+			return
+
+		try:
+			connection = self.__getConnection()
+			connection.execute('INSERT OR REPLACE INTO entries (path, stamp, data) VALUES (?, ?, ?)', data)
+
+			self.__numSets += 1
+			if self.__numSets % self.__PRUNE_INTERVAL == 0:
+				#書き込まれた順にrowidが大きくなるので、新しいmaxEntries個以外を削除する。
+				connection.execute('DELETE FROM entries WHERE rowid <= (SELECT MAX(rowid) FROM entries) - ?', (self.__maxEntries,))
+		except sqlite3.Error:
+			logging.debug('Persistent property cache write failed ' + repr(path))
+
+	def remove(self, path):
+		"""
+		pathのキャッシュを削除する。
+		"""
+		try:
+			self.__getConnection().execute('DELETE FROM entries WHERE path = ?', (path,))
+		except sqlite3.Error:
+			logging.debug('Persistent property cache remove failed ' + repr(path))
+
+	def clear(self):
+		"""
+		全てのキャッシュを削除する。
+		"""
+		try:
+			self.__getConnection().execute('DELETE FROM entries')
+		except sqlite3.Error:
+			logging.debug('Persistent property cache clear failed')
+
+	def __getConnection(self):
+		connection = getattr(self.__local, 'connection', None)
+		if connection is None:
+			if self.__isUnsafe:
+				raise sqlite3.DatabaseError('Unsafe persistent property cache ' + repr(self.__dbPath))
+
+			dirPath = os.path.dirname(self.__dbPath)
+			if not os.path.isdir(dirPath):
+				try:
+					os.makedirs(dirPath, 0o700)
+				except OSError:
+					#他のプロセスが作った。
+					if not os.path.isdir(dirPath):
+						raise sqlite3.OperationalError('Could not create a directory ' + repr(dirPath))
+
+			#ユーザーのumaskによらず、他のユーザーが書き込めないファイルを作る。
+			try:
+				os.close(os.open(self.__dbPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+			except OSError:
+				pass
+
+			#一文ごとにコミットする。
+			connection = sqlite3.connect(self.__dbPath, timeout=self.__timeLimitSec, isolation_level=None)
+
+			#開いたファイルが他のユーザーに作られたり書き込めたりするものでないか、読み込む前に確認する。
+			if not all(_isPrivateFile(self.__dbPath + suffix) for suffix in ('', '-wal', '-shm')):
+				connection.close()
+				self.__isUnsafe = True
+				logging.warning('Persistent property cache %s is not used since it is writable by other users.' % repr(self.__dbPath))
+				raise sqlite3.DatabaseError('Unsafe persistent property cache ' + repr(self.__dbPath))
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=OFF') #キャッシュなのでクラッシュ時に失われても構わない。
+			connection.execute('PRAGMA mmap_size=%d' % int(self.__mmapSizeBytes))
+			connection.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, stamp BLOB NOT NULL, data BLOB NOT NULL)')
+			self.__local.connection = connection
+		return connection
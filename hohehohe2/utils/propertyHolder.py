@@ -6,11 +6,1263 @@ propertyは各種オブジェクトに付属するkey-valueペアで、keyはASC
 オブジェクトはparentを持ち継承をサポートする。
 """
 
-import os, logging, time, datetime, json
-from hohehohe2.utils.fileLock import FileLock
+import os, re, logging, time, datetime, json, threading, collections
+from hohehohe2.utils.fileLock import FileLock, FileLockSet
 from hohehohe2.utils.myException import MyException
 
 
+#============================================================================
+#============================================================================
+def _replaceFile(srcFilePath, dstFilePath):
+	"""
+	dstFilePathをsrcFilePathのファイルでアトミックに置き換える。他のプロセスからは置き換え前か後のファイルのどちらかが見える。
+	"""
+	if hasattr(os, 'replace'):
+		os.replace(srcFilePath, dstFilePath)
+	elif os.name == 'nt':
+		#Windowsではos.renameは置き換え先が存在すると失敗する。
+		import ctypes
+		MOVEFILE_REPLACE_EXISTING = 0x1
+		MOVEFILE_WRITE_THROUGH = 0x8
+		if not ctypes.windll.kernel32.MoveFileExW(unicode(srcFilePath), unicode(dstFilePath), MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+			raise ctypes.WinError()
+	else:
+		os.rename(srcFilePath, dstFilePath)
+
+
+#============================================================================
+#============================================================================
+class PropertyCodec(object):
+	"""
+	propertyファイルのフォーマット。FilePropertyStorageに渡して用いる。
+	headerが空でないフォーマットはファイル先頭のheaderで判別されるので、読み込み時はどのフォーマットで書かれたファイルも読める。
+	"""
+
+	header = ''
+	"""
+	ファイル先頭に書き込まれるフォーマット識別用のバイト列。
+	"""
+
+	def dumps(self, propDict):
+		"""
+		propDictをheaderを含むバイト列に変換する。
+		"""
+		raise NotImplementedError
+
+	def loads(self, data):
+		"""
+		headerを含むバイト列をdictに変換する。データが壊れている場合は例外を送出する。
+		"""
+		raise NotImplementedError
+
+
+#============================================================================
+#============================================================================
+class JsonPropertyCodec(PropertyCodec):
+	"""
+	JSONフォーマット。デフォルトのフォーマット。headerはない。
+	"""
+
+	def dumps(self, propDict):
+		return json.dumps(propDict)
+
+	def loads(self, data):
+		return json.loads(data)
+
+
+#============================================================================
+#============================================================================
+class MarshalPropertyCodec(PropertyCodec):
+	"""
+	marshalによるバイナリフォーマット。読み込みはJSONより数倍速い。
+	JSONと同じデータを扱えるよう、書き込めるのはdict（keyは文字列）、list、文字列、数値、bool、Noneのみ。tupleはlistとして書き込まれる。
+	書き込み時はこの型の確認をPythonで行うので、書き込みはJSONと同程度で、小さなdictやlistを多数含む場合はJSONより遅い。読み込みの多いpropertyに用いること。
+	注：marshalは壊れたデータや悪意のあるデータに対して安全ではないので、信頼できないユーザーが書き込める場所では用いないこと。
+	"""
+
+	header = '\x00HPM2\n'
+
+	__SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+	__KEY_TYPES = frozenset([str, unicode])
+
+	def dumps(self, propDict):
+		import marshal
+		#ほとんどのpropertyはtupleや書き込めない型を含まないので、型をまとめて確認できればそのまま書き込む。
+		if not self.__isPlain(propDict):
+			propDict = self.__normalize(propDict)
+		return self.header + marshal.dumps(propDict, 2)
+
+	def loads(self, data):
+		import marshal
+		propDict = marshal.loads(data[len(self.header):])
+		if not isinstance(propDict, dict):
+			raise ValueError('Property data is not a dict.')
+		return propDict
+
+	def __isPlain(self, value):
+		"""
+		valueがdict（keyは文字列）、list、書き込めるスカラーのみからなればTrueを返す。
+		__normalize()と違い新しいdictやlistを作らず、再帰もしない。
+		"""
+		scalarTypes = self.__SCALAR_TYPES
+		keyTypes = self.__KEY_TYPES
+		stack = [value]
+		while stack:
+			value = stack.pop()
+			valueType = type(value)
+			if valueType is dict:
+				for key in value:
+					if not type(key) in keyTypes:
+						return False
+				items = value.itervalues()
+			elif valueType is list:
+				items = value
+			else:
+				return valueType in scalarTypes
+			for item in items:
+				itemType = type(item)
+				if itemType in scalarTypes:
+					continue
+				if itemType is dict or itemType is list:
+					stack.append(item)
+					continue
+				return False
+		return True
+
+	def __normalize(self, value):
+		"""
+		書き込めない型が含まれていれば例外を送出する。tupleはlistに変換する。
+		"""
+		valueType = type(value)
+		if valueType in self.__SCALAR_TYPES:
+			return value
+
+		if isinstance(value, dict):
+			normalizedDict = {}
+			for key, item in value.iteritems():
+				if not isinstance(key, basestring):
+					raise MyException('Property dict key %s is not a string.' % repr(key))
+				normalizedDict[key] = self.__normalize(item)
+			return normalizedDict
+
+		if isinstance(value, (list, tuple)):
+			return [self.__normalize(item) for item in value]
+
+		raise MyException('Property value %s of type %s can not be written.' % (repr(value), valueType.__name__))
+
+
+#============================================================================
+#============================================================================
+class JournalPropertyCodec(PropertyCodec):
+	"""
+	ジャーナル（追記型）フォーマット。JournaledFilePropertyStorageが用いる。
+	最初の行は'#HPJ2 'と世代のIDで、以降は一行一レコードのJSON。最初のレコードがベースとなるdict、以降のレコードが[更新するdict, 削除するkeyのリスト]の差分。
+	世代のIDはdumps()で書き込むたびに（ジャーナルではコンパクションのたびに）新しく作られる。inode番号は置き換え後すぐに再利用されることがあるので、置き換えの検知にはこれを用いる。
+	最後の行が改行で終わっていない場合は書き込み途中とみなして無視する。
+	世代のIDのない'#HPJ1'のファイルも読める。
+	"""
+
+	header = '#HPJ'
+
+	__VERSION2_PREFIX = '#HPJ2 '
+
+	def dumps(self, propDict):
+		import random
+		return '%s%016x\n%s\n' % (self.__VERSION2_PREFIX, random.getrandbits(64), json.dumps(propDict))
+
+	def dumpRecord(self, updates, removals):
+		"""
+		差分のレコードを一行のバイト列にする。
+		"""
+		return json.dumps([updates, removals]) + '\n'
+
+	def loads(self, data):
+		propDict, end = self.replay(data, self.getBaseOffset(data), None)
+		return propDict
+
+	def getBaseOffset(self, data):
+		"""
+		ベースのレコードの始まりの位置（最初の行の次）を返す。
+		"""
+		end = data.find('\n')
+		if end < 0:
+			raise ValueError('Journal header is incomplete.')
+		return end + 1
+
+	def getGeneration(self, data):
+		"""
+		最初の行から世代のIDを返す。dataは最初の行を含んでいればよい。世代のIDのないフォーマットや最初の行が不完全な場合はNoneを返す。
+		"""
+		end = data.find('\n')
+		if end < 0 or not data.startswith(self.__VERSION2_PREFIX):
+			return None
+		return data[len(self.__VERSION2_PREFIX):end]
+
+	def replay(self, data, offset, propDict):
+		"""
+		data[offset:]のレコードをpropDictに順に適用し、(propDict, 適用した最後のレコードの終わりの位置)を返す。
+		propDictがNoneならoffsetの行をベースとして読む。propDictは直接変更される。
+		"""
+		if propDict is None:
+			end = data.find('\n', offset)
+			if end < 0:
+				raise ValueError('Journal base record is incomplete.')
+			propDict = json.loads(data[offset:end])
+			if not isinstance(propDict, dict):
+				raise ValueError('Journal base record is not a dict.')
+			offset = end + 1
+
+		while True:
+			end = data.find('\n', offset)
+			if end < 0:
+				break
+			updates, removals = json.loads(data[offset:end])
+			propDict.update(updates)
+			for key in removals:
+				propDict.pop(key, None)
+			offset = end + 1
+
+		return propDict, offset
+
+
+_jsonCodec = JsonPropertyCodec()
+"""
+デフォルトのフォーマット。
+"""
+
+_journalCodec = JournalPropertyCodec()
+
+_headerCodecs = [MarshalPropertyCodec(), _journalCodec]
+"""
+読み込み時にheaderで判別するフォーマット。
+"""
+
+
+#============================================================================
+#============================================================================
+def _loadPropertyData(data):
+	"""
+	ファイル先頭のheaderでフォーマットを判別してdictに変換する。どのheaderにも一致しなければJSONとして読む。
+	"""
+	for codec in _headerCodecs:
+		if data.startswith(codec.header):
+			return codec.loads(data)
+	return _jsonCodec.loads(data)
+
+
+#============================================================================
+#============================================================================
+class _LazyPropertyDict(collections.Mapping):
+	"""
+	JSONファイルのトップレベルのdictを、参照されたkeyのvalueだけデコードする読み込み専用のMapping。
+	最初にkeyごとのvalueの位置のインデックスを作り、valueは参照されるまでバイト列のまま置いておく。
+	"""
+
+	__STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+	__SCALAR = r'[^,\]}\s"\[{]+'
+
+	__OBJECT_START = re.compile(r'\s*\{\s*')
+
+	__KEY = re.compile(r'(' + __STRING + r')\s*:\s*')
+
+	__SEPARATOR = re.compile(r'\s*([,}])\s*')
+
+	__CONTAINER_TOKEN = re.compile(__STRING + r'|[\[\]{}]')
+	"""
+	__PAIRで読み飛ばせない深さのコンテナの括弧の対応を数えるためのトークン。文字列の中の括弧を数えないよう文字列もトークンとする。
+	"""
+
+	__PAIR = None
+	"""
+	key、value、区切りを一度にマッチする正規表現。valueが3段までのコンテナであれば正規表現一回で読み飛ばす。最初に使うときに作る。
+	"""
+
+	@classmethod
+	def __makePairPattern(cls, depth):
+		"""
+		key、value、区切りを一度にマッチする正規表現を作る。valueはdepthの深さまでのコンテナにマッチする。
+		"""
+		value = '(?:%s|%s)' % (cls.__STRING, cls.__SCALAR)
+		for i in range(depth):
+			value = r'(?:%s|%s|\[\s*(?:%s(?:\s*,\s*%s)*)?\s*\]|\{\s*(?:%s\s*:\s*%s(?:\s*,\s*%s\s*:\s*%s)*)?\s*\})' % (cls.__STRING, cls.__SCALAR, value, value, cls.__STRING, value, cls.__STRING, value)
+		return re.compile(r'(%s)\s*:\s*(%s)\s*([,}])\s*' % (cls.__STRING, value))
+
+	def __init__(self, data):
+		self.__data = data
+		"""
+		JSONのバイト列。
+		他のプロセスが書き換えるファイルをメモリマップしたものは用いないこと（書き換えられると参照時にSIGBUSでプロセスが落ちる）。
+		"""
+
+		self.__index = self.__buildIndex(data)
+		"""
+		{key: (valueの開始位置, valueの終了位置)}
+		"""
+
+		self.__values = {}
+		"""
+		デコード済みのvalue。
+		"""
+
+	def __getitem__(self, key):
+		try:
+			return self.__values[key]
+		except KeyError:
+			start, end = self.__index[key]
+		value = json.loads(self.__data[start:end])
+		self.__values[key] = value
+		return value
+
+	def __contains__(self, key):
+		return key in self.__index
+
+	def __iter__(self):
+		return iter(self.__index)
+
+	def __len__(self):
+		return len(self.__index)
+
+	def copy(self):
+		"""
+		全てデコードしたdictを返す。デコード済みのvalueはそのまま用い、デコードしたvalueはこのオブジェクトには残さない。
+		"""
+		if len(self.__values) * 2 < len(self.__index):
+			#ほとんどデコードしていなければ、keyごとにデコードするより全体を一度にデコードする方が速い。
+			propDict = json.loads(self.__data[:])
+			propDict.update(self.__values)
+			return propDict
+
+		propDict = dict(self.__values)
+		for key, (start, end) in self.__index.iteritems():
+			if not key in propDict:
+				propDict[key] = json.loads(self.__data[start:end])
+		return propDict
+
+	@classmethod
+	def __buildIndex(cls, data):
+		"""
+		トップレベルのdictのkeyごとのvalueの位置を返す。JSONのdictでなければValueErrorを送出する。
+		"""
+		match = cls.__OBJECT_START.match(data)
+		if not match:
+			raise ValueError('Not a JSON object.')
+		pos = match.end()
+		index = {}
+		if data[pos:pos + 1] == '}':
+			return index
+
+		if cls.__PAIR is None:
+			cls.__PAIR = cls.__makePairPattern(3)
+		pairPattern = cls.__PAIR
+		while True:
+			#ほとんどのkeyとvalueは正規表現一回で読み飛ばせる。
+			match = pairPattern.match(data, pos)
+			if match:
+				keyToken = match.group(1)
+				start, end = match.span(2)
+			else:
+				#深くネストしたvalue。
+				match = cls.__KEY.match(data, pos)
+				if not match:
+					raise ValueError('Invalid JSON object key at %d.' % pos)
+				keyToken = match.group(1)
+				start = match.end()
+				end = cls.__skipContainer(data, start)
+				match = cls.__SEPARATOR.match(data, end)
+				if not match:
+					raise ValueError('Invalid JSON object separator at %d.' % end)
+
+			index[json.loads(keyToken) if '\\' in keyToken else keyToken[1:-1].decode('utf-8')] = (start, end)
+
+			pos = match.end()
+			if match.group(match.lastindex) == '}':
+				return index
+
+	@classmethod
+	def __skipContainer(cls, data, start):
+		"""
+		startから始まるコンテナの終わりの位置を返す。
+		"""
+		if not data[start:start + 1] in ('{', '['):
+			raise ValueError('Invalid JSON value at %d.' % start)
+		depth = 0
+		for token in cls.__CONTAINER_TOKEN.finditer(data, start):
+			c = token.group()[0]
+			if c in '{[':
+				depth += 1
+			elif c in '}]':
+				depth -= 1
+				if depth == 0:
+					return token.end()
+		raise ValueError('Unterminated JSON value at %d.' % start)
+
+
+#============================================================================
+#============================================================================
+class _PropertyView(collections.Mapping):
+	"""
+	継承チェーン上の各オブジェクトのpropertyのキャッシュを重ねた読み込み専用のMapping。
+	キャッシュをコピーせずに参照するので、作成のコストはほとんどかからない。変更はできず、変更可能なdictが必要な場合はcopy()を用いる。
+	注：valueがlistやdictの場合、その中身を変更するとキャッシュが壊れるので変更しないこと。
+	"""
+
+	def __init__(self, layers):
+		self.__layers = layers
+		"""
+		子から順に並べた各オブジェクトのpropertyのキャッシュ。
+		"""
+
+	def __getitem__(self, key):
+		for layer in self.__layers:
+			if key in layer:
+				return layer[key]
+		raise KeyError(key)
+
+	def __contains__(self, key):
+		for layer in self.__layers:
+			if key in layer:
+				return True
+		return False
+
+	def __iter__(self):
+		if len(self.__layers) == 1:
+			return iter(self.__layers[0])
+		return iter(set().union(*self.__layers))
+
+	def __len__(self):
+		if len(self.__layers) == 1:
+			return len(self.__layers[0])
+		return len(set().union(*self.__layers))
+
+	def __repr__(self):
+		return '%s(%s)' % (self.__class__.__name__, repr(self.copy()))
+
+	def copy(self):
+		"""
+		継承を含めたpropertyの変更可能なdictを返す。
+		"""
+		propDict = {}
+		for layer in reversed(self.__layers):
+			propDict.update(layer.copy() if isinstance(layer, _LazyPropertyDict) else layer)
+		return propDict
+
+
+#============================================================================
+#============================================================================
+def _getScandir():
+	"""
+	os.scandir、なければscandirモジュールのscandirを返す。どちらもなければNoneを返す。
+	"""
+	try:
+		from os import scandir
+	except ImportError:
+		try:
+			from scandir import scandir
+		except ImportError:
+			return None
+	return scandir
+
+
+#============================================================================
+#============================================================================
+def _getAsyncio():
+	"""
+	asyncioモジュールを返す。Python 2ではtrolliusを用いる。どちらもなければ例外を送出する。
+	"""
+	try:
+		import asyncio
+	except ImportError:
+		try:
+			import trollius as asyncio
+		except ImportError:
+			msg = 'asyncio (or trollius on Python 2) is required for the asynchronous property API.'
+			logging.error(msg)
+			raise MyException(msg)
+	return asyncio
+
+
+#============================================================================
+#============================================================================
+class _NoLock(object):
+	"""
+	何もしないロック。
+	"""
+
+	def __enter__(self):
+		pass
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+
+#============================================================================
+#============================================================================
+class _PropertyMetrics(object):
+	"""
+	propertyの読み書きの計測値。PropertyHolder.enableMetrics()で有効にする。
+	無効な間は呼び出し側がenabledを確認して何も記録しないので、オーバーヘッドはほぼない。
+
+	記録する項目。
+		cacheHits, cacheMisses: キャッシュのヒット、ミスの回数。
+		stats: propertyファイルをstatした回数。
+		directoryScans: キャッシュの有効性をまとめて確認するためにディレクトリを読んだ回数。
+		reads, bytesRead, parseSec: propertyファイルを読み込みデコードした回数、バイト数、秒数。
+		readRetries: 読み込みに失敗して再トライした回数。
+		lockAcquisitions, lockWaitSec: 書き込みのためにロックを取得した回数、取得を待った秒数。
+	"""
+
+	__NAMES = ('cacheHits', 'cacheMisses', 'stats', 'directoryScans', 'reads', 'bytesRead', 'parseSec', 'readRetries', 'lockAcquisitions', 'lockWaitSec')
+
+	def __init__(self):
+		self.enabled = False
+		"""
+		Trueなら記録する。
+		"""
+
+		self.__perPath = False
+		"""
+		Trueならpropertyファイルごとにも記録する。
+		"""
+
+		self.__lock = threading.Lock()
+		self.__total = dict.fromkeys(self.__NAMES, 0)
+		self.__totalsByPath = {}
+
+		self.__logThread = None
+		self.__logStopEvent = None
+
+	def enable(self, perPath=False, logIntervalSec=None):
+		"""
+		記録を開始する。logIntervalSecを指定すると、その間隔で計測値をログに出力する。
+		"""
+		self.disable()
+		self.__perPath = perPath
+		self.enabled = True
+		if logIntervalSec:
+			self.__logStopEvent = threading.Event()
+			self.__logThread = threading.Thread(target=self.__logPeriodically, args=(logIntervalSec, self.__logStopEvent), name='PropertyMetricsLogger')
+			self.__logThread.daemon = True
+			self.__logThread.start()
+
+	def disable(self):
+		"""
+		記録を終了する。計測値は残る。
+		"""
+		self.enabled = False
+		if self.__logThread:
+			self.__logStopEvent.set()
+			self.__logThread = None
+			self.__logStopEvent = None
+
+	def add(self, path, name, value=1):
+		"""
+		pathのnameの計測値にvalueを加える。
+		"""
+		with self.__lock:
+			self.__total[name] += value
+			if self.__perPath:
+				if not path in self.__totalsByPath:
+					self.__totalsByPath[path] = dict.fromkeys(self.__NAMES, 0)
+				self.__totalsByPath[path][name] += value
+
+	def snapshot(self, perPath=False):
+		"""
+		計測値を{'total': {項目名: 値}}で返す。perPathがTrueなら'perPath': {path: {項目名: 値}}も含める。
+		"""
+		with self.__lock:
+			result = {'total': dict(self.__total)}
+			if perPath:
+				result['perPath'] = dict((path, dict(totals)) for path, totals in self.__totalsByPath.iteritems())
+		return result
+
+	def reset(self):
+		"""
+		計測値を0にする。
+		"""
+		with self.__lock:
+			self.__total = dict.fromkeys(self.__NAMES, 0)
+			self.__totalsByPath = {}
+
+	def __logPeriodically(self, intervalSec, stopEvent):
+		while not stopEvent.wait(intervalSec):
+			total = self.snapshot()['total']
+			logging.info('Property metrics: ' + ', '.join('%s=%s' % (name, total[name]) for name in self.__NAMES))
+
+
+_metrics = _PropertyMetrics()
+
+
+#============================================================================
+#============================================================================
+class _MeasuredLock(object):
+	"""
+	ロックの取得を待った時間を記録するためにPropertyStorage.lock()の戻り値をラップする。
+	"""
+
+	def __init__(self, lock, path):
+		self.__lock = lock
+		self.__path = path
+
+	def __enter__(self):
+		startTime = time.time()
+		result = self.__lock.__enter__()
+		_metrics.add(self.__path, 'lockWaitSec', time.time() - startTime)
+		_metrics.add(self.__path, 'lockAcquisitions')
+		return result
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return self.__lock.__exit__(exc_type, exc_value, traceback)
+
+
+#============================================================================
+#============================================================================
+def _getStorageLock(storage, path, timeLimitSec=5.0):
+	"""
+	storage.lock(path, timeLimitSec)を返す。計測中であれば待った時間を記録する。
+	"""
+	lock = storage.lock(path, timeLimitSec)
+	if _metrics.enabled:
+		return _MeasuredLock(lock, path)
+	return lock
+
+
+#============================================================================
+#============================================================================
+class PropertyStorage(object):
+	"""
+	propertyの保存先の基底クラス。PropertyHolder._getPropertyStorage()で返すことでオブジェクトごとに保存先を選べる。
+	各メソッドのpathはPropertyHolder._getPropertyFilePath()を正規化したもので、保存先の中でオブジェクトを識別するために用いられる。
+	stampはキャッシュの更新チェックに用いる値で、保存されているpropertyが更新されると変わる。
+	sizeはキャッシュの容量管理に用いる推定バイト数。
+	"""
+
+	stampIsRevision = False
+	"""
+	stampが更新回数等、一度変わると以前の値に戻らないものであればTrue。
+	Falseの保存先（ファイルの更新時刻、サイズ、inode番号等）では、更新を繰り返すと以前と同じstampに戻ることがある。
+	PropertyHolderはTrueの場合のみ、書き込み時にstampがキャッシュと一致すれば読み直しを省き、バージョンをstampだけで確認する。
+	"""
+
+	def read(self, path, readTimeLimit):
+		"""
+		保存されているpropertyを読み(propDict, stamp, size)を返す。キャッシュは使わない。propertyがなければ({}, None, 0)を返す。
+		readTimeLimitは読み込みに失敗したとき再トライを続ける時間（datetime.timedelta）。
+		"""
+		raise NotImplementedError
+
+	def stat(self, path):
+		"""
+		保存されているpropertyの(stamp, size)を返す。propertyがなければNoneを返す。
+		"""
+		raise NotImplementedError
+
+	def lock(self, path, timeLimitSec=5.0):
+		"""
+		pathのpropertyの読み込みと書き込みをアトミックに行うためのロックを返す。withで用いる。
+		timeLimitSecを過ぎても取得できなければMyExceptionを送出し、0なら待たずに一度だけ試すこと。
+		"""
+		return _NoLock()
+
+	def sharedLock(self, path):
+		"""
+		PropertyHolderがpathのpropertyを読み込む間に取得する共有ロックを返す。不要であればNoneを返す。
+		"""
+		return None
+
+	def applyChanges(self, path, updates, removals, cleared, readTimeLimit, currentDict=None, expectedVersion=None):
+		"""
+		保存されているpropertyを、clearedがTrueなら全て削除し、updatesで更新し、removalsのkeyを削除して保存する。
+		呼び出し側でlock()を取得しておくこと。更新後の(propDict, stamp, size)を返す。
+		currentDictは呼び出し側がキャッシュ等から保存されている現在のpropertyを知っている場合に渡すdictで、読み込みを省くために用いてよい。渡されたdictは変更して構わない。
+		expectedVersionを指定した場合、現在のバージョン（stat()のstamp、propertyがなければ0）が異なれば何も書き込まずPropertyVersionConflictErrorを送出する。
+		lock()で読み込みと書き込みをアトミックにできる保存先では、呼び出し側がロック中にstat()で確認するので無視してよい。
+		lock()を用いない保存先では書き込みとアトミックに確認すること。
+		"""
+		raise NotImplementedError
+
+
+#============================================================================
+#============================================================================
+class FilePropertyStorage(PropertyStorage):
+	"""
+	オブジェクトごとに一つのファイルにpropertyを保存する。デフォルトの保存先。
+	pathはpropertyファイルのパス。
+	書き込みはcodecのフォーマット（デフォルトはJSON）で行う。読み込みはファイル先頭で判別するので、フォーマットが混在していても構わない。
+	"""
+
+	__READ_INTERVAL = 0.5
+	"""
+	ファイルリードが失敗した時に次にトライするまでの間隔。
+	"""
+
+	__TEMP_FILE_PREFIX = '.tmp_'
+	"""
+	アトミックな書き込みに用いる一時ファイルの名前につけるプレフィックス。
+	"""
+
+	def __init__(self, atomicWrite=True, fsyncOnWrite=False, codec=None, lazyThresholdBytes=None, lockClass=None, sharedReadLock=False):
+		self.__codec = codec or _jsonCodec
+		"""
+		書き込みに用いるフォーマット（PropertyCodec）。
+		"""
+
+		self.__lazyThresholdBytes = lazyThresholdBytes
+		"""
+		JSONのpropertyファイルがこのバイト数以上なら、ファイルを読み込んでkeyごとの位置だけを調べ、参照されたkeyのvalueだけデコードする。Noneなら常に全体をデコードする。
+		valueが大きく、一部のkeyしか参照しないpropertyファイルの読み込みが速くなり、メモリ使用量も減る。小さなvalueが多数ある場合は全体をデコードする方が速い。
+		"""
+
+		self.__atomicWrite = atomicWrite
+		"""
+		Trueならpropertyファイルを同じディレクトリの一時ファイルに書き込んでから置き換える。他のプロセス（ユーザー）が書き込み途中のファイルを読むことがなくなる。
+		Falseならpropertyファイルに直接上書きする。
+		"""
+
+		self.__fsyncOnWrite = fsyncOnWrite
+		"""
+		Trueなら置き換える前に一時ファイルをfsyncする。マシンがクラッシュしても空や書き込み途中のpropertyファイルが残らなくなるが書き込みは遅くなる。
+		atomicWriteがTrueの場合のみ有効。
+		"""
+
+		self.__lockClass = lockClass
+		"""
+		propertyファイルのロックに用いるクラス（FileLock、FlockFileLock等）。NoneならFileLock。
+		同じpropertyファイルを扱う全てのプロセス（ユーザー）で同じ種類のロックを用いること。
+		"""
+
+		self.__sharedReadLock = sharedReadLock
+		"""
+		Trueならpropertyファイルを読み込む間に共有ロックを取得し、書き込み中のファイルを読まないようにする。共有ロック同士は互いに待たない。
+		書き込み時の排他ロックはlockClassのsharedLockingをTrueにして取得する。
+		atomicWriteがFalseの場合に読み込みの再トライをなくすために用いる。atomicWriteがTrueであれば書き込み途中のファイルは見えないので不要。
+		注：同じスレッドで同じpropertyファイルの排他ロックを持ったまま読み込むと、排他ロックの解放を待ち続けるので注意。
+		"""
+
+	def read(self, path, readTimeLimit):
+
+		#読み込む前にタイムスタンプを取得しておく。読み込み中に更新された場合は次のチェックでキャッシュが古いことがわかる。
+		fileStamp = self.stat(path)
+		if fileStamp is None:
+			return {}, None, 0
+
+		#読み込みに失敗すればreadTimeLimitの時間だけ再トライを続ける。
+		startTime = datetime.datetime.now()
+		while(datetime.datetime.now() - startTime < readTimeLimit):
+			if _metrics.enabled:
+				parseStartTime = time.time()
+			#JSONフォーマットでdictを読み込むので正常なファイルでは{と}のペアが対応しており、他プロセス（他ユーザー）の書き込み途中に読み込んだ場合特殊な場合を除いて例外を送出する。
+			#他プロセス（他ユーザー）によるライト途中の読み込みはJSON読み込みの失敗で検知できるものとし、ファイルロックやロックファイル有無の確認は行わない。
+			#atomicWriteによる書き込みでは書き込み途中のファイルは見えないので、再トライは直接上書きするプロセスが混在する場合等のためのフォールバック。
+			#JSON以外のフォーマットも途中までのデータでは例外を送出する。
+			try:
+				with open(path, 'rb') as f:
+					if not self.__lazyThresholdBytes is None and fileStamp[1] >= self.__lazyThresholdBytes:
+						propertyDict = self.__loadLazily(f)
+					else:
+						propertyDict = _loadPropertyData(f.read())
+				if _metrics.enabled:
+					_metrics.add(path, 'reads')
+					_metrics.add(path, 'bytesRead', fileStamp[1])
+					_metrics.add(path, 'parseSec', time.time() - parseStartTime)
+				break #読み込み成功。
+			except:
+				if not os.path.exists(path):
+					#読み込もうとしている最中に他プロセス（ユーザー）によってファイルが削除された。
+					return {}, None, 0
+				import traceback
+				exc = traceback.format_exc() #ロギング用にtraceback表示の記録。
+				if _metrics.enabled:
+					_metrics.add(path, 'readRetries')
+				time.sleep(self.__READ_INTERVAL)
+
+		else:
+			#読み込み失敗。
+			msg = 'Failed reading property file ' + repr(path)
+			logging.error(msg)
+			logging.error(exc)
+			raise MyException(msg)
+
+		stamp, size = fileStamp
+		return propertyDict, stamp, size
+
+	def stat(self, path):
+		"""
+		stampはpropertyファイルの(更新時刻, サイズ, inode番号)。
+		"""
+		if _metrics.enabled:
+			_metrics.add(path, 'stats')
+		try:
+			fileStat = os.stat(path)
+		except OSError:
+			if not os.path.exists(path):
+				return None
+			logging.error('Unknown property file stat error ' + repr(path))
+			import traceback
+			logging.error(traceback.format_exc())
+			raise
+		return (fileStat.st_mtime, fileStat.st_size, fileStat.st_ino), fileStat.st_size
+
+	def statDirectory(self, dirPath, fileNames):
+		"""
+		ディレクトリを一度読み、fileNamesのうち存在するファイルの{ファイル名: (stamp, size)}を返す。存在しないファイルは含まれない。
+		statの結果はstat()と同じ。ディレクトリがなければ空dictを返す。
+		NFSではディレクトリを読むときに各ファイルの属性も取得されるので、ファイルごとにstat()するより通信が少ない。
+		"""
+		if _metrics.enabled:
+			_metrics.add(dirPath, 'directoryScans')
+
+		fileNames = set(fileNames)
+		stamps = {}
+		scandir = _getScandir()
+		try:
+			if scandir:
+				for entry in scandir(dirPath):
+					if entry.name in fileNames:
+						fileStat = entry.stat()
+						stamps[entry.name] = (fileStat.st_mtime, fileStat.st_size, fileStat.st_ino), fileStat.st_size
+			else:
+				for fileName in fileNames.intersection(os.listdir(dirPath)):
+					fileStamp = self.stat(os.path.join(dirPath, fileName))
+					if not fileStamp is None:
+						stamps[fileName] = fileStamp
+		except OSError:
+			if not os.path.isdir(dirPath):
+				return {}
+			raise
+		return stamps
+
+	def lock(self, path, timeLimitSec=5.0):
+		if self.__sharedReadLock:
+			#共有ロックを待つ間に来た共有ロックより先に取得されるようにする。
+			return (self.__lockClass or FileLock)(path, timeLimitSec, sharedLocking=True)
+		return (self.__lockClass or FileLock)(path, timeLimitSec)
+
+	def sharedLock(self, path):
+		if not self.__sharedReadLock:
+			return None
+		return (self.__lockClass or FileLock)(path, shared=True)
+
+	def applyChanges(self, path, updates, removals, cleared, readTimeLimit, currentDict=None, expectedVersion=None):
+
+		#現在のpropertyをファイルからロード。
+		if cleared:
+			currentDict = {}
+		elif currentDict is None:
+			currentDict, stamp, size = self.read(path, readTimeLimit)
+			if isinstance(currentDict, _LazyPropertyDict):
+				currentDict = currentDict.copy()
+
+		#updatesをマージしremovalsを削除。
+		currentDict.update(updates)
+		for key in removals:
+			currentDict.pop(key, None)
+
+		if not currentDict:
+			#空dictならPropertyファイルを削除。
+			if os.path.exists(path):
+				os.remove(path)
+			return {}, None, 0
+
+		#Propertyファイルライト。
+		try:
+			self.__writePropertyFile(path, currentDict)
+		except (IOError, OSError):
+			msg = 'Property file write IO error ' + repr(path) + '.'
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise
+		except:
+			msg = 'Unexpected property write error ' + repr(path) + '.'
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise
+
+		#ロック中なので他のプロセス（ユーザー）に更新されることはない。
+		stamp, size = self.stat(path)
+		return currentDict, stamp, size
+
+	def __loadLazily(self, f):
+		"""
+		ファイルを読み込み_LazyPropertyDictを返す。JSON以外のフォーマットであれば全体をデコードする。
+		ファイルはメモリマップせずに読み込んだバイト列を持つので、キャッシュ中に他のプロセス（ユーザー）がファイルを上書きしたり置き換えたりしても影響を受けない。
+		"""
+		data = f.read()
+		for codec in _headerCodecs:
+			if data.startswith(codec.header):
+				return codec.loads(data)
+		return _LazyPropertyDict(data)
+
+	def __writePropertyFile(self, filePath, propDict):
+		"""
+		propDictをpropertyファイルに書き込む。
+		"""
+		data = self.__codec.dumps(propDict)
+
+		if not self.__atomicWrite:
+			with open(filePath, 'wb') as f:
+				f.write(data)
+			return
+
+		#同じディレクトリの一時ファイルに書き込んでから置き換える。
+		import socket, random
+		tmpFilePath = os.path.join(os.path.dirname(filePath), '%s%s_%s_%d_%08x' % (self.__TEMP_FILE_PREFIX, os.path.basename(filePath), socket.gethostname(), os.getpid(), random.getrandbits(32)))
+		fd = os.open(tmpFilePath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+				if self.__fsyncOnWrite:
+					f.flush()
+					os.fsync(f.fileno())
+
+			#置き換え前のファイルのパーミッションを引き継ぐ。
+			try:
+				import stat
+				os.chmod(tmpFilePath, stat.S_IMODE(os.stat(filePath).st_mode))
+			except OSError:
+				pass
+
+			_replaceFile(tmpFilePath, filePath)
+		except:
+			if os.path.exists(tmpFilePath):
+				os.remove(tmpFilePath)
+			raise
+
+
+#============================================================================
+#============================================================================
+class _JournalState(object):
+	"""
+	JournaledFilePropertyStorageがジャーナルファイルをどこまで読んだか。
+	"""
+
+	def __init__(self, ino, generation, offset, baseStart, baseEnd, propDict):
+		self.ino = ino
+		self.generation = generation
+		"""
+		ジャーナルファイルのinode番号と世代のID（JournalPropertyCodec.getGeneration()）。コンパクションで置き換えられると変わる。
+		inode番号は再利用されることがあるので、両方が一致する場合のみ同じファイルとみなす。世代のIDのないフォーマットならNone。
+		"""
+
+		self.offset = offset
+		"""
+		適用済みの最後のレコードの終わりの位置。
+		"""
+
+		self.baseStart = baseStart
+		self.baseEnd = baseEnd
+		"""
+		ベースのレコードの始まりと終わりの位置。
+		"""
+
+		self.propDict = propDict
+		"""
+		offsetまでのレコードを適用したdict。変更しないこと。
+		"""
+
+
+#============================================================================
+#============================================================================
+class JournaledFilePropertyStorage(FilePropertyStorage):
+	"""
+	propertyファイルをジャーナル（JournalPropertyCodec）フォーマットで保存するFilePropertyStorage。
+	更新はファイル全体を書き直さず、FileLockを取得して差分のレコードを追記する。
+	追記された差分の大きさがベースのcompactionRatio倍を超えると、現在のdictをベースとするファイルにアトミックに置き換える（コンパクション）。
+	読み込み時は前回読んだ位置以降に追記されたレコードだけを読んで適用する。ファイルが置き換えられていないことはinode番号と世代のIDで確認する。
+	JSONやmarshalのpropertyファイル、世代のIDのない古いジャーナルフォーマットのファイルも読め、最初の更新でジャーナルフォーマットに変換される。
+	"""
+
+	__HEAD_BYTES = 64
+	"""
+	世代のIDを得るために読むファイル先頭のバイト数。
+	"""
+
+	def __init__(self, compactionRatio=1.0, fsyncOnWrite=False, maxJournalStates=1024, lockClass=None):
+		super(JournaledFilePropertyStorage, self).__init__(atomicWrite=True, fsyncOnWrite=fsyncOnWrite, codec=_journalCodec, lockClass=lockClass)
+
+		self.__compactionRatio = compactionRatio
+		"""
+		差分の合計バイト数がベースのバイト数のこの倍数を超えたらコンパクションする。
+		"""
+
+		self.__fsyncOnWrite = fsyncOnWrite
+
+		self.__maxJournalStates = maxJournalStates
+		"""
+		読み込み位置を覚えておくファイル数の上限。古いものから忘れる。
+		"""
+
+		self.__states = collections.OrderedDict()
+		"""
+		{path: _JournalState}
+		"""
+
+		self.__lock = threading.Lock()
+
+	def read(self, path, readTimeLimit):
+
+		fileStamp = self.stat(path)
+		if fileStamp is None:
+			self.__setState(path, None)
+			return {}, None, 0
+
+		#前回読んだ位置からの差分だけを適用する。読めなければ通常の読み込み（再トライあり）にフォールバックする。
+		try:
+			state = self.__readJournal(path)
+		except (IOError, OSError, ValueError):
+			state = None
+			logging.debug('Falling back to a full read of property file ' + repr(path))
+
+		if state is None:
+			self.__setState(path, None)
+			return super(JournaledFilePropertyStorage, self).read(path, readTimeLimit)
+
+		stamp, size = fileStamp
+		return dict(state.propDict), stamp, size
+
+	def applyChanges(self, path, updates, removals, cleared, readTimeLimit, currentDict=None, expectedVersion=None):
+
+		if cleared:
+			currentDict = {}
+		elif currentDict is None:
+			currentDict, stamp, size = self.read(path, readTimeLimit)
+			currentDict = currentDict.copy()
+
+		currentDict.update(updates)
+		removals = [key for key in removals if not key in updates]
+		for key in removals:
+			currentDict.pop(key, None)
+
+		if currentDict and not cleared:
+			with self.__lock:
+				state = self.__states.get(path)
+			if not state is None and not state.generation is None and self.__appendRecord(path, state, currentDict, _journalCodec.dumpRecord(updates, removals)):
+				stamp, size = self.stat(path)
+				return currentDict, stamp, size
+
+		#コンパクション。ファイル全体を書き直す。
+		currentDict, stamp, size = super(JournaledFilePropertyStorage, self).applyChanges(path, currentDict, (), True, readTimeLimit)
+		state = None
+		if not stamp is None:
+			#書き込んだファイルの世代のIDを得る。ロック中なので他のプロセス（ユーザー）に置き換えられることはない。
+			try:
+				with open(path, 'rb') as f:
+					head = f.read(self.__HEAD_BYTES)
+					fileStat = os.fstat(f.fileno())
+				baseStart = _journalCodec.getBaseOffset(head)
+				state = _JournalState(fileStat.st_ino, _journalCodec.getGeneration(head), fileStat.st_size, baseStart, fileStat.st_size, dict(currentDict))
+			except (IOError, OSError, ValueError):
+				logging.debug('Could not read the journal header of ' + repr(path))
+		self.__setState(path, state)
+		return currentDict, stamp, size
+
+	def __appendRecord(self, path, state, currentDict, record):
+		"""
+		ロック中にrecordをジャーナルファイルに追記する。コンパクションが必要な場合は何もせずFalseを返す。
+		"""
+		baseSize = state.baseEnd - state.baseStart
+		if state.offset + len(record) - state.baseEnd > baseSize * self.__compactionRatio:
+			return False
+
+		try:
+			#O_APPENDでも読み込みはファイル先頭から行われる。
+			fd = os.open(path, os.O_RDWR | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+		except OSError:
+			return False
+
+		try:
+			#読み込み後に置き換えられたり、書き込み途中のレコードが残っていればコンパクションする。
+			fileStat = os.fstat(fd)
+			if fileStat.st_ino != state.ino or fileStat.st_size != state.offset or _journalCodec.getGeneration(os.read(fd, self.__HEAD_BYTES)) != state.generation:
+				return False
+
+			os.write(fd, record)
+			if self.__fsyncOnWrite:
+				os.fsync(fd)
+		finally:
+			os.close(fd)
+
+		self.__setState(path, _JournalState(state.ino, state.generation, state.offset + len(record), state.baseStart, state.baseEnd, dict(currentDict)))
+		return True
+
+	def __readJournal(self, path):
+		"""
+		ジャーナルファイルを前回読んだ位置から読み、更新した_JournalStateを返す。ジャーナルフォーマットでなければNoneを返す。
+		"""
+		with self.__lock:
+			state = self.__states.get(path)
+
+		with open(path, 'rb') as f:
+			fileStat = os.fstat(f.fileno())
+			if state is None or state.generation is None or state.ino != fileStat.st_ino or fileStat.st_size < state.offset or _journalCodec.getGeneration(f.read(self.__HEAD_BYTES)) != state.generation:
+				#初めて読むか置き換えられた。世代のIDのないフォーマットでは置き換えを検知できないので毎回全体を読む。
+				f.seek(0)
+				data = f.read()
+				if not data.startswith(_journalCodec.header):
+					return None
+				baseStart = _journalCodec.getBaseOffset(data)
+				baseEnd = data.find('\n', baseStart) + 1
+				propDict, offset = _journalCodec.replay(data, baseStart, None)
+				state = _JournalState(fileStat.st_ino, _journalCodec.getGeneration(data), offset, baseStart, baseEnd, propDict)
+
+			elif fileStat.st_size > state.offset:
+				#追記された差分だけを読む。
+				f.seek(state.offset)
+				data = f.read()
+				propDict, offset = _journalCodec.replay(data, 0, dict(state.propDict))
+				state = _JournalState(state.ino, state.generation, state.offset + offset, state.baseStart, state.baseEnd, propDict)
+
+		self.__setState(path, state)
+		return state
+
+	def __setState(self, path, state):
+		with self.__lock:
+			self.__states.pop(path, None)
+			if state is None:
+				return
+			self.__states[path] = state
+			while len(self.__states) > self.__maxJournalStates:
+				self.__states.popitem(last=False)
+
+
+_defaultStorage = FilePropertyStorage()
+"""
+PropertyHolder._getPropertyStorage()のデフォルトの戻り値。
+"""
+
+
+#============================================================================
+#============================================================================
+class _PropertyFileWatcher(object):
+	"""
+	propertyファイルのあるディレクトリをinotifyで監視し、ディレクトリ内のファイルが作成、変更、削除されたらfileCallbackを呼ぶ。
+	fileCallbackの引数は変更されたファイルのパス。
+	ディレクトリ自体が削除された場合はresetCallbackがそのディレクトリパスを引数として呼ばれ、以降そのディレクトリは監視されない。
+	イベントの取りこぼしが発生した場合はresetCallbackがNoneを引数として呼ばれる。
+	コールバックは監視スレッドから呼ばれる。
+	"""
+
+	__STOP_CHECK_INTERVAL = 1.0
+	"""
+	監視スレッドが停止要求をチェックする間隔（秒）。
+	"""
+
+	def __init__(self, fileCallback, resetCallback):
+		from hohehohe2.utils import inotify
+		self.__inotify = inotify.Inotify()
+		self.__fileCallback = fileCallback
+		self.__resetCallback = resetCallback
+		self.__dirPathByWd = {}
+		self.__wdByDirPath = {}
+		self.__running = True
+		self.__thread = threading.Thread(target=self.__run, name='PropertyFileWatcher')
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	def watch(self, dirPath):
+		"""
+		dirPathを監視対象に加える。監視できればTrueを返す。ディレクトリが存在しない場合やinotifyの監視数上限に達した場合はFalseを返す。
+		"""
+		if dirPath in self.__wdByDirPath:
+			return True
+
+		from hohehohe2.utils import inotify
+		try:
+			wd = self.__inotify.addWatch(dirPath, inotify.IN_CHANGED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
+		except OSError:
+			return False
+
+		self.__dirPathByWd[wd] = dirPath
+		self.__wdByDirPath[dirPath] = wd
+		return True
+
+	def isWatching(self, dirPath):
+		return dirPath in self.__wdByDirPath
+
+	def stop(self):
+		"""
+		監視スレッドを停止する。
+		"""
+		self.__running = False
+		self.__thread.join()
+		self.__inotify.close()
+
+	def __run(self):
+		from hohehohe2.utils import inotify
+		while self.__running:
+			try:
+				events = self.__inotify.readEvents(self.__STOP_CHECK_INTERVAL)
+			except:
+				logging.error('Property file watcher stopped by an unexpected error.')
+				import traceback
+				logging.error(traceback.format_exc())
+				self.__wdByDirPath = {}
+				self.__resetCallback(None)
+				return
+
+			for wd, mask, cookie, name in events:
+				if mask & inotify.IN_Q_OVERFLOW:
+					#イベントを取りこぼした。
+					self.__resetCallback(None)
+					continue
+
+				dirPath = self.__dirPathByWd.get(wd)
+				if dirPath is None:
+					continue
+
+				if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+					#ディレクトリ自体が削除、移動された。以降このディレクトリは監視されない。
+					del self.__dirPathByWd[wd]
+					del self.__wdByDirPath[dirPath]
+					self.__resetCallback(dirPath)
+					continue
+
+				if isinstance(dirPath, unicode):
+					import sys
+					name = name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+				self.__fileCallback(os.path.join(dirPath, name))
+
+
+#============================================================================
+#============================================================================
+class _InFlightLoad(object):
+	"""
+	_PropertyCache.getOrLoad()で読み込み中のpropertyファイル。同じファイルを待つスレッドに読み込み結果を渡す。
+	"""
+
+	def __init__(self):
+		self.__event = threading.Event()
+		self.__result = None
+		self.__exception = None
+
+	def setResult(self, result):
+		self.__result = result
+		self.__event.set()
+
+	def setException(self, exception):
+		self.__exception = exception
+		self.__event.set()
+
+	def wait(self):
+		"""
+		読み込みが終わるまで待って結果を返す。読み込みに失敗していれば同じ例外を送出する。
+		"""
+		self.__event.wait()
+		if not self.__exception is None:
+			raise self.__exception
+		return self.__result
+
+
+#============================================================================
+#============================================================================
+class _ThreadToken(object):
+	"""
+	スレッドローカルに置き、スレッドの終了をweakrefで検知するためのオブジェクト。
+	"""
+
+
 #============================================================================
 #============================================================================
 class _PropertyCache(object):
@@ -25,22 +1277,258 @@ class _PropertyCache(object):
 	この時間内では他プロセス（他ユーザー）によるPropertyの変更が反映されなくなる。自分自身による更新は常に反映される。
 	"""
 
+	__BULK_REVALIDATION_MIN_ENTRIES = 8
+	"""
+	キャッシュの有効性を確認するとき、同じディレクトリにこの数以上の確認が必要なキャッシュがあればファイルごとにstatせずディレクトリをまとめて確認する。
+	"""
+
+	__PROTECTED_RATIO = 0.8
+	"""
+	容量制限があるとき、2回以上参照されたキャッシュ（protected）に割り当てる容量の割合。
+	残りは1回しか参照されていないキャッシュ（probation）に使われ、多数のファイルを1回ずつ読むスキャンで頻繁に使われるキャッシュが追い出されないようにする。
+	"""
+
+	__HITS, __MISSES, __MERGED_HITS, __MERGED_MISSES, __COALESCED_LOADS = range(5)
+	"""
+	スレッドごとの統計情報のカウンタのインデックス。
+	"""
+
 	def __init__(self):
+		self.__lock = threading.RLock()
+		"""
+		キャッシュ更新時のロック。キャッシュの参照はロックせずに行う。
+		"""
+
+		self.__inFlightLock = threading.Lock()
+		"""
+		__inFlightLoadsのロック。キャッシュ更新時のロックとは別にし、読み込みの登録でキャッシュの更新を待たないようにする。
+		"""
+
+		self.__inFlightLoads = {}
+		"""
+		{filePath: _InFlightLoad} getOrLoad()で読み込み中のpropertyファイル。
+		"""
+
 		self.__cache = {}
 		"""
 		{filePath: (cache, cacheTimeStamp, timeStampObtainedTime)}
 		keyはファイルパス。
 		valueはキャッシュデータ、キャッシュファイルのタイムスタンプ、最後にタイムスタンプを取得したときの時刻。
-		キャッシュファイルのタイムスタンプはファイル更新チェックのため用いられる。
+		キャッシュファイルのタイムスタンプ（PropertyStorage.stat()で得られるstamp）はファイル更新チェックのため用いられる。
 		ファイル更新チェックもディスクアクセスが発生するため最後にチェックしたときから一定時間内ならファイル更新されていないものとしてチェックを省く。
 		最後にタイムスタンプを取得したときの時刻はそのために用いられる。
 		"""
 
+		self.__storages = {}
+		"""
+		{filePath: storage}
+		デフォルト以外のPropertyStorageに保存されているpropertyのキャッシュの保存先。
+		"""
+
+		self.__mergedCache = {}
+		"""
+		{filePaths: (mergedCache, layerCaches, timeStampObtainedTime)}
+		継承を含めたpropertyのキャッシュ。keyはルートから順に並べた継承チェーン上の全propertyファイルパスのtuple。
+		valueは継承をマージしたdict、マージに用いた各ファイルのキャッシュ（self.__cacheの値そのもの）、その中で最も古いタイムスタンプ取得時刻。
+		いずれかのファイルのキャッシュが更新されるとそのファイルを含むエントリーは削除される。
+		"""
+
+		self.__mergedKeysByFilePath = {}
+		"""
+		{filePath: set(filePaths)}
+		ファイルパスからそのファイルを含むself.__mergedCacheのkeyを引くための逆引きテーブル。
+		"""
+
+		self.__watcher = None
+		"""
+		enableWatcher()で作られる_PropertyFileWatcher。Noneならポーリングによるチェックのみ行う。
+		"""
+
+		self.__filePathsByDirPath = {}
+		"""
+		{ディレクトリのパス: そのディレクトリにあるキャッシュのファイルパスのset}
+		ディレクトリごとにキャッシュの有効性をまとめて確認するためのインデックス。
+		"""
+
+		self.__directoryScannedTimes = {}
+		"""
+		{ディレクトリのパス: 最後にまとめて確認した時刻}
+		一定時間内に同じディレクトリをまとめて確認し直さないようにする。
+		"""
+
+		self.__watchedFilePaths = set()
+		"""
+		ディレクトリがself.__watcherで監視されているキャッシュのファイルパス。
+		これらのキャッシュは他のプロセス（ユーザー）による更新があればすぐに削除されるのでタイムスタンプのチェックを省く。
+		"""
+
+		self.__maxEntries = None
+		self.__maxBytes = None
+		self.__maxNegativeEntries = None
+		"""
+		容量制限。それぞれ空でないキャッシュの数、空でないキャッシュの推定バイト数の合計、空のキャッシュ（ファイルがないこと）の数の上限。Noneなら無制限。
+		推定バイト数はpropertyファイルのサイズ。
+		"""
+
+		self.__probation = collections.OrderedDict()
+		self.__protected = collections.OrderedDict()
+		"""
+		{filePath: estimatedBytes}
+		空でないキャッシュの参照順。古いものが先頭。
+		キャッシュは1回しか参照されていなければprobation、2回以上参照されるとprotectedに入り、容量を超えるとprobationの古いものから追い出される。
+		"""
+
+		self.__negative = collections.OrderedDict()
+		"""
+		{filePath: None}
+		空のキャッシュの参照順。古いものが先頭。
+		"""
+
+		self.__bytes = 0
+		self.__protectedBytes = 0
+		"""
+		空でないキャッシュ、およびそのうちprotectedにあるものの推定バイト数の合計。
+		"""
+
+		self.__local = threading.local()
+		self.__threadCounters = {}
+		"""
+		{スレッドの_ThreadTokenへのweakref: カウンタ}
+		参照時の統計情報のスレッドごとのカウンタ。ロックせずに数えるためスレッドごとに分け、getStats()で合計する。
+		"""
+
+		self.__endedThreadCounters = []
+		self.__endedThreadCounts = [0] * 5
+		"""
+		終了したスレッドのカウンタと、getStats()でそれらを合計したもの。
+		スレッドプール等でスレッドが作られ続けてもカウンタが増え続けないよう、終了したスレッドのカウンタは合計に移す。
+		"""
+
+		self.__evictions = 0
+		self.__negativeEvictions = 0
+		"""
+		統計情報。getStats()で取得できる。
+		"""
+
+	def setLimits(self, maxEntries=None, maxBytes=None, maxNegativeEntries=None):
+		"""
+		容量制限を設定する。Noneを指定した項目は無制限になる。
+		maxEntriesは空でないキャッシュの数、maxBytesはその推定バイト数（propertyファイルのサイズ）の合計、maxNegativeEntriesは空のキャッシュ（ファイルがないこと）の数の上限。
+		制限を超えると参照されていない期間が長いものから削除される。
+		"""
+		with self.__lock:
+			self.__maxEntries = maxEntries
+			self.__maxBytes = maxBytes
+			self.__maxNegativeEntries = maxNegativeEntries
+			self.__evict()
+
+	def getStats(self):
+		"""
+		キャッシュの統計情報をdictで返す。
+			entries: 空でないキャッシュの数。
+			negativeEntries: 空のキャッシュ（ファイルがないこと）の数。
+			bytes: 空でないキャッシュの推定バイト数（propertyファイルのサイズ）の合計。
+			mergedEntries: 継承を含めたキャッシュの数。
+			hits, misses, hitRatio: get()でキャッシュが見つかった回数、見つからなかった回数、見つかった割合。
+			mergedHits, mergedMisses: getMerged()でキャッシュが見つかった回数、見つからなかった回数。
+			coalescedLoads: getOrLoad()で他のスレッドの読み込みを待って結果を受け取った回数。
+			evictions, negativeEvictions: 容量制限により削除された空でないキャッシュの数、空のキャッシュの数。
+		"""
+		with self.__lock:
+			self.__foldEndedThreadCounters()
+			hits, misses, mergedHits, mergedMisses, coalescedLoads = [sum(values) for values in zip(self.__endedThreadCounts, *self.__threadCounters.values())]
+			lookups = hits + misses
+			return {
+				'entries': len(self.__probation) + len(self.__protected),
+				'negativeEntries': len(self.__negative),
+				'bytes': self.__bytes,
+				'mergedEntries': len(self.__mergedCache),
+				'hits': hits,
+				'misses': misses,
+				'hitRatio': float(hits) / lookups if lookups else 0.0,
+				'mergedHits': mergedHits,
+				'mergedMisses': mergedMisses,
+				'coalescedLoads': coalescedLoads,
+				'evictions': self.__evictions,
+				'negativeEvictions': self.__negativeEvictions,
+			}
+
+	def resetStats(self):
+		"""
+		統計情報の回数をリセットする。
+		"""
+		with self.__lock:
+			self.__foldEndedThreadCounters()
+			for counters in self.__threadCounters.values():
+				counters[:] = [0] * len(counters)
+			self.__endedThreadCounts = [0] * 5
+			self.__evictions = self.__negativeEvictions = 0
+
+	def __getCounters(self):
+		"""
+		このスレッドの統計情報のカウンタを返す。
+		"""
+		try:
+			return self.__local.counters
+		except AttributeError:
+			import weakref
+			token = _ThreadToken()
+			counters = [0] * 5
+			with self.__lock:
+				self.__threadCounters[weakref.ref(token, self.__onThreadEnd)] = counters
+			self.__local.token = token
+			self.__local.counters = counters
+			return counters
+
+	def __onThreadEnd(self, tokenRef):
+		"""
+		スレッドが終了してスレッドローカルの_ThreadTokenが削除されたときに呼ばれる。
+		どのスレッドから呼ばれるかわからないのでロックは取らず、GILで保護される操作だけを行う。
+		"""
+		counters = self.__threadCounters.pop(tokenRef, None)
+		if not counters is None:
+			self.__endedThreadCounters.append(counters)
+
+	def __foldEndedThreadCounters(self):
+		"""
+		終了したスレッドのカウンタを合計に移す。ロック中に呼ぶこと。
+		"""
+		while self.__endedThreadCounters:
+			counters = self.__endedThreadCounters.pop()
+			self.__endedThreadCounts = [a + b for a, b in zip(self.__endedThreadCounts, counters)]
+
 	def get(self, filePath):
 		"""
 		filePathで指定されたpropertyのキャッシュを得る。
 		キャッシュがない場合はNoneを返す。
 		"""
+		cache = self.__get(filePath)
+
+		if cache is None:
+			self.__getCounters()[self.__MISSES] += 1
+			if _metrics.enabled:
+				_metrics.add(filePath, 'cacheMisses')
+			return None
+
+		self.__getCounters()[self.__HITS] += 1
+		if _metrics.enabled:
+			_metrics.add(filePath, 'cacheHits')
+		if self.__maxEntries is not None or self.__maxBytes is not None or self.__maxNegativeEntries is not None:
+			with self.__lock:
+				self.__touch(filePath)
+		return cache
+
+	def peek(self, filePath):
+		"""
+		filePathで指定されたpropertyの(キャッシュ, キャッシュのタイムスタンプ)を、有効性を確認せずに返す。キャッシュがない場合はNoneを返す。
+		空のキャッシュ（ファイルがないこと）のタイムスタンプは0。
+		"""
+		entry = self.__cache.get(filePath)
+		if entry is None:
+			return None
+		return entry[:2]
+
+	def __get(self, filePath):
 		cache, cacheTimeStamp, timeStampObtainedTime = self.__cache.get(filePath, (None, None, None))
 		if timeStampObtainedTime is None:
 			#キャッシュがない。
@@ -50,90 +1538,639 @@ class _PropertyCache(object):
 		if datetime.datetime.now() - timeStampObtainedTime < self.__CACHE_VALIDITY_UN_CHECK_DURATION:
 			return cache
 
-		#Propertyファイルが存在しないのでキャッシュとタイムスタンプを更新して終了。
-		if not os.path.exists(filePath):
+		#監視されているファイルは更新されればキャッシュが削除されているのでチェック不要。
+		if filePath in self.__watchedFilePaths:
+			return cache
+
+		storage = self.__storages.get(filePath, _defaultStorage)
+
+		#同じディレクトリに確認が必要なキャッシュが多数あれば、ディレクトリを一度読んでまとめて確認する。
+		dirPath = os.path.dirname(filePath)
+		if isinstance(storage, FilePropertyStorage) and self.__hasManyStaleEntries(dirPath):
+			self.__refreshDirectory(dirPath, True)
+			cache, cacheTimeStamp, timeStampObtainedTime = self.__cache.get(filePath, (None, None, None))
+			return cache
+
+		try:
+			fileStamp = storage.stat(filePath)
+		except:
+			logging.error('Unknown cache read error ' + repr(filePath))
+			import traceback
+			exc = traceback.format_exc() #ロギング用にtraceback表示の記録。
+			logging.error(exc)
+			raise
+
+		if fileStamp is None:
+			if not cache:
+				#ファイルがないままだった。キャッシュのdictと継承を含めたキャッシュはそのままで、次のチェックまでの時間を延長する。
+				with self.__lock:
+					if filePath in self.__cache:
+						self.__cache[filePath] = (cache, cacheTimeStamp, datetime.datetime.now())
+				return cache
+
 			#別プロセス（他ユーザー）によりファイル自体削除されていた。キャッシュとタイムスタンプ等を更新して終了。
-			self.set(filePath, {})
+			self.set(filePath, {}, None, 0, storage)
 			return {}
 
 		#別プロセス（他ユーザー）によるpropertyファイルの更新チェック。キャッシュを保存した時からタイムスタンプが更新されていなければそのキャッシュを用いる。
+		if cache and fileStamp[0] == cacheTimeStamp:
+			#更新されていなかった。次のチェックまでの時間を延長する。
+			with self.__lock:
+				if filePath in self.__cache:
+					self.__cache[filePath] = (cache, cacheTimeStamp, datetime.datetime.now())
+			return cache
+		else:
+			#ファイルが更新されていた。キャッシュを取り除いておく。
+			self.remove(filePath)
+			return None
+
+	def set(self, filePath, cache, cacheTimeStamp, estimatedBytes=0, storage=None):
+		"""
+		filePathで指定されたpropertyのキャッシュを保存する。
+		cacheTimeStamp、estimatedBytesはstorage（Noneならデフォルトの保存先）のPropertyStorage.read()等で得たstampとsize。
+		"""
+
+		#NOTE: datetime.now()で取得した時刻とファイルのタイムスタンプを比較しないこと。
+		#NOTE: そのようなコードはファイルサーバーの時刻とローカルマシンの時刻が同期されていなければ正常動作しない。
+		#NOTE:　またサーバーとの通信やファイル書き込み時間などのため挙動が安定しない。
+
+		now = datetime.datetime.now()
+
+		if storage is None:
+			storage = _defaultStorage
+
+		if not cache:
+			#Propertyファイルがなくても空dictをキャッシュに入れておき「Propertyがないこと」を覚えておく。
+			cacheTimeStamp = 0 #ダミー。値は使われない。
+			estimatedBytes = 0
+
+		#監視を始める前のタイムスタンプ取得後に更新されていないか確認してから監視対象とする。更新されていればタイムスタンプによるチェックに任せる。
+		isWatched = False
+		if self.__watcher and isinstance(storage, FilePropertyStorage) and self.__watcher.watch(os.path.dirname(filePath)):
+			fileStamp = storage.stat(filePath)
+			if cache:
+				isWatched = fileStamp is not None and fileStamp[0] == cacheTimeStamp
+			else:
+				isWatched = fileStamp is None
+
+		with self.__lock:
+			self.__cache[filePath] = (cache, cacheTimeStamp, now)
+			self.__filePathsByDirPath.setdefault(os.path.dirname(filePath), set()).add(filePath)
+			self.__removeMerged(filePath)
+
+			if storage is _defaultStorage:
+				self.__storages.pop(filePath, None)
+			else:
+				self.__storages[filePath] = storage
+
+			if isWatched:
+				self.__watchedFilePaths.add(filePath)
+			else:
+				self.__watchedFilePaths.discard(filePath)
+
+			#容量管理。新しいキャッシュは1回しか参照されていないものとして扱う。
+			self.__forget(filePath)
+			if cache:
+				self.__probation[filePath] = estimatedBytes
+				self.__bytes += estimatedBytes
+			else:
+				self.__negative[filePath] = None
+			self.__evict()
+
+	def getOrLoad(self, filePath, load):
+		"""
+		filePathで指定されたpropertyのキャッシュを得る。キャッシュがない場合はload()で読み込んでキャッシュする。
+		load()は(cache, cacheTimeStamp, estimatedBytes, storage)を返す関数。
+		複数のスレッドが同時に同じpropertyファイルを読み込もうとした場合、load()を呼ぶのは一つのスレッドだけで、他のスレッドはその結果を受け取る。
+		"""
+		cache = self.get(filePath)
+		if not cache is None:
+			return cache
+
+		with self.__inFlightLock:
+			inFlightLoad = self.__inFlightLoads.get(filePath)
+			isLoader = inFlightLoad is None
+			if isLoader:
+				inFlightLoad = self.__inFlightLoads[filePath] = _InFlightLoad()
+
+		if not isLoader:
+			#他のスレッドが読み込み中。
+			self.__getCounters()[self.__COALESCED_LOADS] += 1
+			return inFlightLoad.wait()
+
 		try:
-			if os.stat(filePath).st_mtime == cacheTimeStamp:
-				return cache
+			cache, cacheTimeStamp, estimatedBytes, storage = load()
+			self.set(filePath, cache, cacheTimeStamp, estimatedBytes, storage)
+		except:
+			#待っているスレッドにも同じ例外を送出させる。
+			import sys
+			inFlightLoad.setException(sys.exc_info()[1])
+			raise
+		finally:
+			with self.__inFlightLock:
+				del self.__inFlightLoads[filePath]
+
+		inFlightLoad.setResult(cache)
+		return cache
+
+	def refreshDirectory(self, dirPath):
+		"""
+		dirPathにあるpropertyファイルのキャッシュの有効性を、ディレクトリを一度読んでまとめて確認する。
+		更新されていないキャッシュは次のチェックまでの時間を延長し、更新または削除されたファイルのキャッシュは取り除く。
+		FilePropertyStorageに保存されるpropertyのみが対象。
+		"""
+		self.__refreshDirectory(os.path.abspath(os.path.normpath(dirPath)), False)
+
+	def __hasManyStaleEntries(self, dirPath):
+		"""
+		dirPathに有効性の確認が必要なキャッシュが__BULK_REVALIDATION_MIN_ENTRIES以上あり、まとめて確認すべきであればTrueを返す。
+		"""
+		if not self.__CACHE_VALIDITY_UN_CHECK_DURATION:
+			#確認を省く時間がなければ、まとめて確認しても次の参照でまた確認が必要になる。
+			return False
+
+		now = datetime.datetime.now()
+		with self.__lock:
+			scannedTime = self.__directoryScannedTimes.get(dirPath)
+			if not scannedTime is None and now - scannedTime < self.__CACHE_VALIDITY_UN_CHECK_DURATION:
+				#最近まとめて確認したディレクトリ。
+				return False
+
+			staleCount = 0
+			for filePath in self.__filePathsByDirPath.get(dirPath, ()):
+				cache, cacheTimeStamp, timeStampObtainedTime = self.__cache[filePath]
+				if now - timeStampObtainedTime >= self.__CACHE_VALIDITY_UN_CHECK_DURATION and not filePath in self.__watchedFilePaths:
+					staleCount += 1
+					if staleCount >= self.__BULK_REVALIDATION_MIN_ENTRIES:
+						return True
+		return False
+
+	def __refreshDirectory(self, dirPath, staleOnly):
+		"""
+		refreshDirectory()を行う。staleOnlyがTrueなら有効性の確認が必要なキャッシュのファイルだけを確認する。
+		"""
+		#保存先ごとにまとめる。
+		filePathsByStorage = {}
+		now = datetime.datetime.now()
+		with self.__lock:
+			self.__directoryScannedTimes[dirPath] = now
+			for filePath in self.__filePathsByDirPath.get(dirPath, ()):
+				if staleOnly and (now - self.__cache[filePath][2] < self.__CACHE_VALIDITY_UN_CHECK_DURATION or filePath in self.__watchedFilePaths):
+					continue
+				storage = self.__storages.get(filePath, _defaultStorage)
+				if isinstance(storage, FilePropertyStorage):
+					filePathsByStorage.setdefault(storage, []).append(filePath)
+
+		for storage, filePaths in filePathsByStorage.iteritems():
+			entries = [(filePath, self.__cache.get(filePath)) for filePath in filePaths]
+			try:
+				stamps = storage.statDirectory(dirPath, [os.path.basename(filePath) for filePath in filePaths])
+			except:
+				logging.error('Unknown property directory read error ' + repr(dirPath))
+				import traceback
+				logging.error(traceback.format_exc())
+				raise
+
+			now = datetime.datetime.now()
+			for filePath, entry in entries:
+				if entry is None:
+					continue
+				cache, cacheTimeStamp, timeStampObtainedTime = entry
+				fileStamp = stamps.get(os.path.basename(filePath))
+				if (cache and fileStamp and fileStamp[0] == cacheTimeStamp) or (not cache and fileStamp is None):
+					#更新されていなかった。次のチェックまでの時間を延長する。
+					with self.__lock:
+						if self.__cache.get(filePath) is entry:
+							self.__cache[filePath] = (cache, cacheTimeStamp, now)
+				elif fileStamp is None:
+					#別プロセス（他ユーザー）によりファイル自体削除されていた。
+					self.set(filePath, {}, None, 0, storage)
+				else:
+					#ファイルが更新されていた。キャッシュを取り除いておく。
+					with self.__lock:
+						if self.__cache.get(filePath) is entry:
+							self.remove(filePath)
+
+	def remove(self, filePath):
+		"""
+		filePathで指定されたpropertyのキャッシュを削除する。
+		"""
+		with self.__lock:
+			self.__discard(filePath)
+			self.__forget(filePath)
+
+	def clear(self):
+		"""
+		キャッシュを削除する。
+		"""
+		with self.__lock:
+			self.__cache = {}
+			self.__filePathsByDirPath = {}
+			self.__directoryScannedTimes = {}
+			self.__storages = {}
+			self.__mergedCache = {}
+			self.__mergedKeysByFilePath = {}
+			self.__watchedFilePaths = set()
+			self.__probation = collections.OrderedDict()
+			self.__protected = collections.OrderedDict()
+			self.__negative = collections.OrderedDict()
+			self.__bytes = 0
+			self.__protectedBytes = 0
+
+	def __touch(self, filePath):
+		"""
+		参照されたキャッシュを最も新しいものにする。probationにあればprotectedに移す。
+		"""
+		if filePath in self.__protected:
+			self.__protected[filePath] = self.__protected.pop(filePath)
+		elif filePath in self.__probation:
+			estimatedBytes = self.__probation.pop(filePath)
+			self.__protected[filePath] = estimatedBytes
+			self.__protectedBytes += estimatedBytes
+			self.__evict()
+		elif filePath in self.__negative:
+			self.__negative[filePath] = self.__negative.pop(filePath)
+
+	def __forget(self, filePath):
+		"""
+		容量管理の情報からfilePathを削除する。
+		"""
+		if filePath in self.__probation:
+			self.__bytes -= self.__probation.pop(filePath)
+		elif filePath in self.__protected:
+			estimatedBytes = self.__protected.pop(filePath)
+			self.__bytes -= estimatedBytes
+			self.__protectedBytes -= estimatedBytes
+		else:
+			self.__negative.pop(filePath, None)
+
+	def __evict(self):
+		"""
+		容量制限を超えている分のキャッシュを削除する。
+		"""
+		#protectedがあふれたら古いものをprobationに戻す。
+		if self.__maxEntries is not None:
+			while len(self.__protected) > self.__maxEntries * self.__PROTECTED_RATIO:
+				self.__demote()
+		if self.__maxBytes is not None:
+			while self.__protected and self.__protectedBytes > self.__maxBytes * self.__PROTECTED_RATIO:
+				self.__demote()
+
+		#probationの古いものから削除。probationが空ならprotectedの古いものから削除。
+		while (self.__maxEntries is not None and len(self.__probation) + len(self.__protected) > self.__maxEntries) or (self.__maxBytes is not None and self.__bytes > self.__maxBytes):
+			if self.__probation:
+				filePath, estimatedBytes = self.__probation.popitem(last=False)
+			elif self.__protected:
+				filePath, estimatedBytes = self.__protected.popitem(last=False)
+				self.__protectedBytes -= estimatedBytes
 			else:
-				#ファイルが更新されていた。キャッシュを取り除いておく。
-				del self.__cache[filePath]
+				break
+			self.__bytes -= estimatedBytes
+			self.__discard(filePath)
+			self.__evictions += 1
+
+		if self.__maxNegativeEntries is not None:
+			while len(self.__negative) > self.__maxNegativeEntries:
+				filePath, dummy = self.__negative.popitem(last=False)
+				self.__discard(filePath)
+				self.__negativeEvictions += 1
+
+	def __demote(self):
+		filePath, estimatedBytes = self.__protected.popitem(last=False)
+		self.__protectedBytes -= estimatedBytes
+		self.__probation[filePath] = estimatedBytes
+
+	def __discard(self, filePath):
+		"""
+		容量管理の情報以外からfilePathのキャッシュを削除する。
+		"""
+		self.__cache.pop(filePath, None)
+		self.__storages.pop(filePath, None)
+		self.__watchedFilePaths.discard(filePath)
+		self.__removeMerged(filePath)
+
+		dirPath = os.path.dirname(filePath)
+		filePaths = self.__filePathsByDirPath.get(dirPath)
+		if filePaths:
+			filePaths.discard(filePath)
+			if not filePaths:
+				del self.__filePathsByDirPath[dirPath]
+				self.__directoryScannedTimes.pop(dirPath, None)
+
+	def enableWatcher(self):
+		"""
+		inotifyによるpropertyファイルの監視を開始する。以降キャッシュされたファイルのディレクトリが監視され、
+		他のプロセス（ユーザー）によりファイルが更新、削除されるとすぐにキャッシュが削除される。監視されているファイルのタイムスタンプチェックは行われない。
+		inotifyが使えない環境では何もせずFalseを返し、従来通りタイムスタンプによるチェックを行う。
+		注：NFS等では他のホストによる更新は通知されないので、他のホストから更新されるファイルを扱う場合は用いないこと。
+		"""
+		if self.__watcher:
+			return True
+
+		from hohehohe2.utils import inotify
+		if not inotify.isAvailable():
+			return False
+
+		try:
+			self.__watcher = _PropertyFileWatcher(self.__onWatchedFileChanged, self.__onWatchReset)
+		except OSError:
+			logging.warning('Could not start property file watcher. Falling back to polling.')
+			return False
+		return True
+
+	def disableWatcher(self):
+		"""
+		inotifyによるpropertyファイルの監視を終了し、タイムスタンプによるチェックに戻す。
+		"""
+		if not self.__watcher:
+			return
+		self.__watcher.stop()
+		self.__watcher = None
+		with self.__lock:
+			self.__watchedFilePaths = set()
+
+	def __onWatchedFileChanged(self, filePath):
+		"""
+		監視しているディレクトリ内のファイルが作成、変更、削除されたときに監視スレッドから呼ばれる。
+		"""
+		cache, cacheTimeStamp, timeStampObtainedTime = self.__cache.get(filePath, (None, None, None))
+		if timeStampObtainedTime is None:
+			#キャッシュされていないファイル（ロックファイル等）。
+			return
+
+		#自分自身による更新の場合はset()で新しいタイムスタンプが保存されているのでキャッシュを残す。
+		try:
+			fileStamp = _defaultStorage.stat(filePath)
+		except OSError:
+			fileStamp = None
+
+		if cache and fileStamp is not None and fileStamp[0] == cacheTimeStamp:
+			return
+		if not cache and fileStamp is None:
+			return
+
+		self.remove(filePath)
+
+	def __onWatchReset(self, dirPath):
+		"""
+		ディレクトリが監視できなくなった、またはイベントを取りこぼしたときに監視スレッドから呼ばれる。
+		"""
+		if dirPath is None:
+			#どのキャッシュが古いかわからないので全て削除する。
+			self.clear()
+			return
+
+		#このディレクトリのファイルはタイムスタンプによるチェックに戻す。
+		with self.__lock:
+			for filePath in [filePath for filePath in self.__watchedFilePaths if os.path.dirname(filePath) == dirPath]:
+				self.__watchedFilePaths.discard(filePath)
+
+	def getMerged(self, filePaths):
+		"""
+		filePathsで指定された継承チェーンの継承を含めたpropertyのキャッシュを得る。
+		filePathsはルートから順に並べたpropertyファイルパスのtuple。キャッシュがない場合はNoneを返す。
+		"""
+		mergedCache, layerCaches, timeStampObtainedTime = self.__mergedCache.get(filePaths, (None, None, None))
+		if timeStampObtainedTime is None:
+			#キャッシュがない。
+			self.__getCounters()[self.__MERGED_MISSES] += 1
+			return None
+
+		#チェーン上の全ファイルが一定時間内にチェックされていれば各ファイルのキャッシュを見ずにそのまま返す。
+		if datetime.datetime.now() - timeStampObtainedTime < self.__CACHE_VALIDITY_UN_CHECK_DURATION:
+			self.__getCounters()[self.__MERGED_HITS] += 1
+			return mergedCache
+
+		#各ファイルのキャッシュがマージした時と同じものであればマージ結果も有効。
+		for filePath, layerCache in zip(filePaths, layerCaches):
+			if not self.get(filePath) is layerCache:
+				#ファイルが更新されていた。self.get()またはself.set()によりこのエントリーは削除済み。
+				self.__getCounters()[self.__MERGED_MISSES] += 1
 				return None
 
-		except:
+		with self.__lock:
+			oldestTimeStampObtainedTime = self.__getOldestTimeStampObtainedTime(filePaths)
+			if oldestTimeStampObtainedTime is None or not filePaths in self.__mergedCache:
+				#チェック中に容量制限によりキャッシュが削除された。
+				self.__getCounters()[self.__MERGED_MISSES] += 1
+				return None
+			self.__mergedCache[filePaths] = (mergedCache, layerCaches, oldestTimeStampObtainedTime)
 
-			if not os.path.exists(filePath):
-				#上の処理の途中で別プロセス（他ユーザー）がファイルを削除するとここにくる場合がある。キャッシュとタイムスタンプ等を更新して終了。
-				self.set(filePath, {})
-				return {}
+		self.__getCounters()[self.__MERGED_HITS] += 1
+		return mergedCache
 
-			logging.error('Unknown cache read error ' + repr(filePath))
-			import traceback
-			exc = traceback.format_exc() #ロギング用にtraceback表示の記録。
-			logging.error(exc)
-			raise
+	def setMerged(self, filePaths, mergedCache, layerCaches):
+		"""
+		filePathsで指定された継承チェーンの継承を含めたpropertyのキャッシュを保存する。
+		layerCachesはマージに用いた各ファイルのキャッシュで、get()で得たものでなければならない。
+		"""
+		with self.__lock:
+			for filePath, layerCache in zip(filePaths, layerCaches):
+				cache, cacheTimeStamp, timeStampObtainedTime = self.__cache.get(filePath, (None, None, None))
+				if not cache is layerCache:
+					#マージ中に他スレッドによりキャッシュが更新された、または容量制限により削除された。古いデータなので保存しない。
+					return
+
+			self.__mergedCache[filePaths] = (mergedCache, tuple(layerCaches), self.__getOldestTimeStampObtainedTime(filePaths))
+			for filePath in filePaths:
+				self.__mergedKeysByFilePath.setdefault(filePath, set()).add(filePaths)
+
+	def __getOldestTimeStampObtainedTime(self, filePaths):
+		"""
+		継承チェーン上のキャッシュの最も古いタイムスタンプ取得時刻を返す。キャッシュがないファイルがあればNoneを返す。
+		監視されているファイルは更新されればすぐにキャッシュが削除されるので現在時刻とみなす。
+		"""
+		oldest = datetime.datetime.now()
+		for filePath in filePaths:
+			if filePath in self.__watchedFilePaths:
+				continue
+			cache, cacheTimeStamp, timeStampObtainedTime = self.__cache.get(filePath, (None, None, None))
+			if timeStampObtainedTime is None:
+				return None
+			oldest = min(oldest, timeStampObtainedTime)
+		return oldest
+
+	def __removeMerged(self, filePath):
+		"""
+		filePathを含む継承を含めたpropertyのキャッシュを削除する。filePathより上位の継承チェーンのキャッシュには影響しない。
+		"""
+		for filePaths in self.__mergedKeysByFilePath.pop(filePath, ()):
+			self.__mergedCache.pop(filePaths, None)
+			for otherFilePath in filePaths:
+				if otherFilePath != filePath:
+					self.__mergedKeysByFilePath.get(otherFilePath, set()).discard(filePaths)
+
+
+#============================================================================
+#============================================================================
+class PropertyVersionConflictError(MyException):
+	"""
+	PropertyHolder.updateDict()等でexpectedVersionを指定したとき、propertyが他のプロセス（ユーザー）により更新されていた場合に送出される例外。
+	"""
+	pass
+
+
+#============================================================================
+#============================================================================
+class PropertyHolder(object):
+	"""
+	propertyを保持できるオブジェクト。
+	"""
+
+	__cache = _PropertyCache()
+	"""
+	継承を含めないpropertyのキャッシュ。クラスメンバとして全オブジェクトで共有されるようにしておく。
+	"""
+
+	__PREFETCH_POOL_SIZE = 16
+	"""
+	getDictMany()でpropertyファイルを並列に読み込むスレッド数のデフォルト値。
+	"""
+
+	__persistentCache = None
+	"""
+	プロセス間で共有する永続キャッシュ（PersistentPropertyCache）。無効ならNone。
+	"""
+
+	__inFlightLoads = {}
+	"""
+	agetDict()等で実行中の読み込み。{(イベントループ, 親を含めたpropertyファイルのパスのtuple): future}
+	イベントループのスレッドからのみアクセスされる。
+	"""
 
-	def set(self, filePath, cache):
+	@classmethod
+	def clearAllCaches(cls):
+		"""
+		全てのキャッシュを削除する。
+		"""
+		cls.__cache.clear()
+
+	@classmethod
+	def enableCacheWatcher(cls):
 		"""
-		filePathで指定されたpropertyのキャッシュを保存する。cacheが空dictでなければファイルは存在していなければならない。
+		inotifyによるpropertyファイルの監視を開始する。他のプロセス（ユーザー）による更新がすぐにキャッシュに反映され、タイムスタンプのチェックが不要になる。
+		inotifyが使えない環境ではFalseを返し、従来通りタイムスタンプによるチェックを行う。
 		"""
+		return cls.__cache.enableWatcher()
 
-		#NOTE: datetime.now()で取得した時刻とファイルのタイムスタンプを比較しないこと。
-		#NOTE: そのようなコードはファイルサーバーの時刻とローカルマシンの時刻が同期されていなければ正常動作しない。
-		#NOTE:　またサーバーとの通信やファイル書き込み時間などのため挙動が安定しない。
+	@classmethod
+	def setCacheLimits(cls, maxEntries=None, maxBytes=None, maxNegativeEntries=None):
+		"""
+		全オブジェクトで共有されるキャッシュの容量制限を設定する。Noneを指定した項目は無制限になる。
+		maxEntriesはpropertyファイルのキャッシュの数、maxBytesはそのpropertyファイルのサイズの合計、maxNegativeEntriesはpropertyファイルがないことのキャッシュの数の上限。
+		制限を超えると参照されていない期間が長いものから削除される。一度しか参照されていないものは優先して削除されるため、多数のファイルを一度ずつ読んでも頻繁に使われるキャッシュは残る。
+		"""
+		cls.__cache.setLimits(maxEntries, maxBytes, maxNegativeEntries)
 
-		now = datetime.datetime.now()
+	@classmethod
+	def getCacheStats(cls):
+		"""
+		キャッシュのサイズ、ヒット率、容量制限による削除数などの統計情報をdictで返す。
+		"""
+		return cls.__cache.getStats()
 
-		if cache:
-			cacheTimeStamp = os.stat(filePath).st_mtime
-		else:
-			#Propertyファイルがなくても空dictをキャッシュに入れておき「Propertyがないこと」を覚えておく。
-			cacheTimeStamp = 0 #ダミー。値は使われない。
+	@classmethod
+	def refreshCacheDirectory(cls, dirPath):
+		"""
+		dirPathにあるpropertyファイルのキャッシュが他のプロセス（ユーザー）により更新されていないか、ディレクトリを一度読んでまとめて確認する。
+		多数のオブジェクトのpropertyファイルがあるディレクトリをまとめて読む前に呼ぶと、ファイルごとのstatが不要になる。
+		同じディレクトリに多数のキャッシュがあればキャッシュの確認時に自動的に行われる。
+		"""
+		cls.__cache.refreshDirectory(dirPath)
 
-		self.__cache[filePath] = (cache, cacheTimeStamp, now)
+	@classmethod
+	def disableCacheWatcher(cls):
+		"""
+		inotifyによるpropertyファイルの監視を終了する。
+		"""
+		cls.__cache.disableWatcher()
 
-	def remove(self, filePath):
+	@classmethod
+	def enableMetrics(cls, perPath=False, logIntervalSec=None):
 		"""
-		filePathで指定されたpropertyのキャッシュを削除する。
+		キャッシュのヒット率、stat回数、読み込みとデコードの時間、ロック待ちの時間、再トライ回数等の計測を開始する。
+		perPathがTrueならpropertyファイルごとにも記録する。logIntervalSecを指定するとその間隔で計測値をログに出力する。
 		"""
-		if filePath in self.__cache:
-			del self.__cache[filePath]
+		_metrics.enable(perPath, logIntervalSec)
 
-	def clear(self):
+	@classmethod
+	def disableMetrics(cls):
 		"""
-		キャッシュを削除する。
+		計測を終了する。計測値は残る。
 		"""
-		self.__cache = {}
+		_metrics.disable()
 
+	@classmethod
+	def getMetrics(cls, perPath=False):
+		"""
+		計測値を{'total': {項目名: 値}}のdictで返す。perPathがTrueなら'perPath': {propertyファイルのパス: {項目名: 値}}も含める。
+		"""
+		return _metrics.snapshot(perPath)
 
-#============================================================================
-#============================================================================
-class PropertyHolder(object):
-	"""
-	propertyを保持できるオブジェクト。
-	"""
+	@classmethod
+	def resetMetrics(cls):
+		"""
+		計測値を0にする。
+		"""
+		_metrics.reset()
 
-	__READ_INTERVAL = 0.5
-	"""
-	ファイルリードが失敗した時に次にトライするまでの間隔。
-	"""
+	@classmethod
+	def enablePersistentCache(cls, dbPath=None, maxEntries=100000):
+		"""
+		同じホストのプロセス間で共有する永続キャッシュを有効にする。
+		キャッシュにないpropertyファイルを読むとき、永続キャッシュのstampが一致すればファイルを読まずにそのdictを用いる。新しく起動したプロセスでのpropertyファイルの読み込みが速くなる。
+		dbPathは永続キャッシュのデータベースファイルのパスで、Noneならユーザーだけが読み書きできるディレクトリ（~/.cache/hohe2）のファイルを用いる。
+		FilePropertyStorageに保存されるpropertyのみが対象。
+		"""
+		from hohehohe2.utils.persistentPropertyCache import PersistentPropertyCache
+		PropertyHolder.__persistentCache = PersistentPropertyCache(dbPath, maxEntries)
 
-	__cache = _PropertyCache()
-	"""
-	継承を含めないpropertyのキャッシュ。クラスメンバとして全オブジェクトで共有されるようにしておく。
-	"""
+	@classmethod
+	def disablePersistentCache(cls):
+		"""
+		永続キャッシュを無効にする。データベースファイルは削除しない。
+		"""
+		PropertyHolder.__persistentCache = None
 
 	@classmethod
-	def clearAllCaches(cls):
+	def getDictMany(cls, holders, poolSize=None):
 		"""
-		全てのキャッシュを削除する。
+		複数オブジェクトの継承を含めたpropertyのdictをholdersと同じ順番のリストで返す。
+		親を含め必要なpropertyファイルのうちキャッシュにないものをスレッドプールで並列に読み込み、共有キャッシュに入れる。
+		ファイルサーバー上の多数のオブジェクトのpropertyを読む場合、getDict()を一つずつ呼ぶよりも高速。
+		poolSizeは同時に読み込むファイル数の上限。
 		"""
-		cls.__cache.clear()
+		if poolSize is None:
+			poolSize = cls.__PREFETCH_POOL_SIZE
+
+		#親を含め読み込むpropertyファイルを重複なく集める。
+		holderByFilePath = {}
+		for holder in holders:
+			while holder:
+				filePath = os.path.abspath(os.path.normpath(holder._getPropertyFilePath()))
+				holderByFilePath.setdefault(filePath, holder)
+				holder = holder.__parent
+
+		#キャッシュにないものだけ読み込む。
+		missingFilePaths = [filePath for filePath in holderByFilePath if cls.__cache.get(filePath) is None]
+
+		def load(filePath):
+			holderByFilePath[filePath].__getCachedDictWithoutInheritance(filePath)
+
+		if len(missingFilePaths) > 1 and poolSize > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(poolSize, len(missingFilePaths)))
+			try:
+				pool.map(load, missingFilePaths)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			for filePath in missingFilePaths:
+				load(filePath)
+
+		#全てキャッシュに入っているので通常ファイルアクセスは発生しない。
+		return [holder.getDict() for holder in holders]
 
 	def __init__(self, parent, readTimeLimitSec=3.0):
 		self.__parent = parent
@@ -154,23 +2191,169 @@ class PropertyHolder(object):
 			logging.error(msg)
 			raise MyException(msg)
 
-		return self.getDict().get(key, default)
+		if not self.__parent:
+			return self.__getCachedDictWithoutInheritance(filePath).get(key, default)
+
+		holders, filePaths = self.__getInheritanceChain()
+		mergedPropDict = self.__cache.getMerged(filePaths)
+		if not mergedPropDict is None:
+			#キャッシュがみつかった。
+			return mergedPropDict.get(key, default)
+
+		layerDicts = [holder.__getCachedDictWithoutInheritance(filePath) for holder, filePath in zip(holders, filePaths)]
+		if any(isinstance(propDict, _LazyPropertyDict) for propDict in layerDicts):
+			#全てのvalueをデコードしないよう、継承したdictを作らずに子から順に探す。
+			for propDict in reversed(layerDicts):
+				if key in propDict:
+					return propDict[key]
+			return default
+
+		return self.__mergeLayers(filePaths, layerDicts).get(key, default)
 
 	def getDict(self):
 		"""
 		継承を含めたpropertyのdictを返す。
+		返されるdictはキャッシュのコピーなので変更しても構わない。
 		"""
+		return self.__getMergedDict().copy()
 
-		propDict = self.getDictWithoutInheritance()
-
+	def __getMergedDict(self):
+		"""
+		継承を含めたpropertyのdictを返す。キャッシュそのものを返すので変更してはならない。
+		"""
 		if not self.__parent:
-			return propDict
+			return self.__getDecodedDictWithoutInheritance(os.path.abspath(os.path.normpath(self._getPropertyFilePath())))
+
+		holders, filePaths = self.__getInheritanceChain()
+		mergedPropDict = self.__cache.getMerged(filePaths)
+		if not mergedPropDict is None:
+			#キャッシュがみつかった。
+			return mergedPropDict
+
+		layerDicts = [holder.__getCachedDictWithoutInheritance(filePath) for holder, filePath in zip(holders, filePaths)]
+		return self.__mergeLayers(filePaths, layerDicts)
+
+	def __getInheritanceChain(self):
+		"""
+		ルートから順に継承チェーン上のオブジェクトを並べ、(オブジェクトのリスト, propertyファイルのパスのtuple)を返す。
+		"""
+		holders = []
+		holder = self
+		while holder:
+			holders.append(holder)
+			holder = holder.__parent
+		holders.reverse()
+		filePaths = tuple(os.path.abspath(os.path.normpath(holder._getPropertyFilePath())) for holder in holders)
+		return holders, filePaths
+
+	def __mergeLayers(self, filePaths, layerDicts):
+		"""
+		継承したdictを作りキャッシュする。
+		"""
+		mergedPropDict = {}
+		for propDict in layerDicts:
+			if isinstance(propDict, _LazyPropertyDict):
+				#デコードしたvalueを_LazyPropertyDictに残さない。
+				propDict = propDict.copy()
+			mergedPropDict.update(propDict)
+
+		#キャッシュ更新。
+		self.__cache.setMerged(filePaths, mergedPropDict, layerDicts)
 
-		#継承。
-		mergedPropDict = self.__parent.getDict()
-		mergedPropDict.update(propDict)
 		return mergedPropDict
 
+	def aget(self, key, default=None, loop=None):
+		"""
+		get()の非同期版。結果を返すasyncioのfutureを返す。
+		ファイルの読み込みやロック待ちはイベントループのデフォルトのexecutorで行うので、イベントループを止めない。
+		同じオブジェクトのpropertyを同時に読み込む要求はまとめて一度だけ読み込む。
+		"""
+		if not isinstance(key, basestring):
+			filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
+			msg = 'Bug found. Tried to get a property with non-string key "%s" from file %s' % (repr(key), repr(filePath))
+			logging.error(msg)
+			raise MyException(msg)
+		return self.__runCoalescedLoad(loop, lambda propDict: propDict.get(key, default))
+
+	def agetDict(self, loop=None):
+		"""
+		getDict()の非同期版。結果を返すasyncioのfutureを返す。
+		"""
+		return self.__runCoalescedLoad(loop, dict)
+
+	def aupdateDict(self, propDict, loop=None, expectedVersion=None):
+		"""
+		updateDict()の非同期版。結果を返すasyncioのfutureを返す。
+		書き込みとFileLockの取得待ちはexecutorで行う。PropertyTransactionの中で呼んでもトランザクションには含まれない。
+		"""
+		loop = loop or _getAsyncio().get_event_loop()
+		return loop.run_in_executor(None, self.updateDict, propDict, expectedVersion)
+
+	def __runCoalescedLoad(self, loop, transform):
+		"""
+		getDict()をexecutorで実行し、結果をtransformで変換した値を返すfutureを返す。
+		同じpropertyファイルの組み合わせを読み込み中であれば、新たに読み込まずにその結果を用いる。
+		"""
+		asyncio = _getAsyncio()
+		loop = loop or asyncio.get_event_loop()
+
+		filePaths = []
+		holder = self
+		while holder:
+			filePaths.append(os.path.abspath(os.path.normpath(holder._getPropertyFilePath())))
+			holder = holder.__parent
+		inFlightKey = (loop, tuple(filePaths))
+
+		inFlightLoads = PropertyHolder.__inFlightLoads
+		loadFuture = inFlightLoads.get(inFlightKey)
+		if loadFuture is None:
+			loadFuture = loop.run_in_executor(None, self.getDict)
+			inFlightLoads[inFlightKey] = loadFuture
+			loadFuture.add_done_callback(lambda f: inFlightLoads.pop(inFlightKey, None))
+
+		#読み込み結果を共有する呼び出し側がそれぞれ別のdictを受け取るようにする。
+		future = asyncio.Future(loop=loop)
+
+		def onLoaded(f):
+			if future.cancelled():
+				return
+			if f.cancelled():
+				future.cancel()
+			elif not f.exception() is None:
+				future.set_exception(f.exception())
+			else:
+				future.set_result(transform(f.result()))
+
+		loadFuture.add_done_callback(onLoaded)
+		return future
+
+	def getView(self):
+		"""
+		継承を含めたpropertyの読み込み専用のMappingを返す。
+		キャッシュをコピーしないのでgetDict()より速い。変更はできず、変更可能なdictが必要な場合はcopy()を用いる。
+		返されたMappingは作成時のキャッシュを参照し続けるので、その後の更新は反映されない。
+		"""
+		if not self.__parent:
+			return self.getViewWithoutInheritance()
+
+		holders, filePaths = self.__getInheritanceChain()
+		mergedPropDict = self.__cache.getMerged(filePaths)
+		if not mergedPropDict is None:
+			#キャッシュがみつかった。
+			return _PropertyView((mergedPropDict,))
+
+		#継承したdictは作らず、各オブジェクトのキャッシュを重ねる。
+		layerDicts = [holder.__getCachedDictWithoutInheritance(filePath) for holder, filePath in zip(holders, filePaths)]
+		layerDicts.reverse()
+		return _PropertyView(tuple(layerDicts))
+
+	def getViewWithoutInheritance(self):
+		"""
+		継承を含めないpropertyの読み込み専用のMappingを返す。getView()を参照。
+		"""
+		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
+		return _PropertyView((self.__getCachedDictWithoutInheritance(filePath),))
+
 	def getWithoutInheritance(self, key, default=None):
 		"""
 		継承を含めないpropertyのkeyをとってvalueを返す。 keyに対するvalueがなければdefaultを返す。
@@ -181,75 +2364,109 @@ class PropertyHolder(object):
 			msg = 'Bug found. Tried to get a property with non-string key "%s" from file %s' % (repr(key), repr(filePath))
 			logging.error(msg)
 			raise MyException(msg)
-		return self.getDictWithoutInheritance().get(key, default)
+		return self.__getCachedDictWithoutInheritance(filePath).get(key, default)
 
 	def getDictWithoutInheritance(self):
 		"""
 		継承を含めないpropertyのdictを返す。
+		返されるdictはキャッシュのコピーなので変更しても構わない。コピーが不要な場合はgetViewWithoutInheritance()を用いること。
 		"""
 		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
+		return self.__getDecodedDictWithoutInheritance(filePath).copy()
 
-		cache = self.__cache.get(filePath)
-		if not cache is None:
-			#キャッシュがみつかった。
-			return cache
-
-		#Propertyファイル読み込み。
-		propertyDict = self.__getDictWithoutInheritance(filePath)
-
-		#キャッシュ更新。
-		self.__cache.set(filePath, propertyDict)
+	def __getDecodedDictWithoutInheritance(self, filePath):
+		"""
+		継承を含めないpropertyを全てデコードしたdictを返す。キャッシュそのものを返すので変更してはならない。
+		_LazyPropertyDictであれば、呼ぶたびにデコードし直さないようデコードしたdictを継承チェーンと同様にキャッシュする。
+		"""
+		propDict = self.__getCachedDictWithoutInheritance(filePath)
+		if not isinstance(propDict, _LazyPropertyDict):
+			return propDict
 
-		return propertyDict
+		filePaths = (filePath,)
+		mergedPropDict = self.__cache.getMerged(filePaths)
+		if not mergedPropDict is None:
+			#キャッシュがみつかった。
+			return mergedPropDict
+		return self.__mergeLayers(filePaths, [propDict])
 
-	def __getDictWithoutInheritance(self, filePath):
+	def getVersion(self):
 		"""
-		Propertyファイルリード。キャッシュは使わない。
+		このオブジェクトのpropertyのバージョンを返す。propertyが更新されると変わる値で、updateDict()等のexpectedVersionに用いる。
+		値はキャッシュしたときの保存先のstamp（PropertyStorage.stat()）で、propertyがなければ0。
+		stampが以前の値に戻ることがある保存先（PropertyStorage.stampIsRevisionがFalse）では、書き込み時にキャッシュと保存されている内容も比較する。
 		"""
+		return self._getCacheEntry()[1]
 
-		if not os.path.exists(filePath):
-			return {}
-
-		#読み込みに失敗すればself.__readTimeLimitの時間だけ再トライを続ける。
-		startTime = datetime.datetime.now()
-		while(datetime.datetime.now() - startTime < self.__readTimeLimit):
-			#JSONフォーマットでdictを読み込むので正常なファイルでは{と}のペアが対応しており、他プロセス（他ユーザー）の書き込み途中に読み込んだ場合特殊な場合を除いて例外を送出する。
-			#他プロセス（他ユーザー）によるライト途中の読み込みはJSON読み込みの失敗で検知できるものとし、ファイルロックやロックファイル有無の確認は行わない。
-			try:
-				with open(filePath, 'r') as f:
-					propertyDict = json.load(f)
-				break #読み込み成功。
-			except:
-				if not os.path.exists(filePath):
-					#読み込もうとしている最中に他プロセス（ユーザー）によってファイルが削除された。
-					return {}
-				import traceback
-				exc = traceback.format_exc() #ロギング用にtraceback表示の記録。
-				time.sleep(self.__READ_INTERVAL)
+	def __getCachedDictWithoutInheritance(self, filePath):
+		"""
+		キャッシュを用いてpropertyファイルを読む。
+		"""
+		def load():
+			#Propertyファイル読み込み。
+			propertyDict, stamp, size = self.__readStorage(filePath)
+			return propertyDict, stamp, size, self._getPropertyStorage()
 
-		else:
-			#読み込み失敗。
-			msg = 'Failed reading property file ' + repr(filePath)
-			logging.error(msg)
-			logging.error(exc)
-			raise MyException(msg)
+		#キャッシュがなければ読み込んでキャッシュを更新する。他のスレッドが読み込み中であればその結果を用いる。
+		return self.__cache.getOrLoad(filePath, load)
 
-		return propertyDict
+	def __readStorage(self, filePath):
+		"""
+		保存先からpropertyを読み(propDict, stamp, size)を返す。
+		永続キャッシュが有効ならstampが一致する間は永続キャッシュのdictを用いる。
+		"""
+		storage = self._getPropertyStorage()
+		persistentCache = PropertyHolder.__persistentCache
+		if persistentCache is None or not isinstance(storage, FilePropertyStorage):
+			return self.__readStorageShared(storage, filePath)
+
+		fileStamp = storage.stat(filePath)
+		if fileStamp is None:
+			return {}, None, 0
+
+		stamp, size = fileStamp
+		propertyDict = persistentCache.get(filePath, stamp)
+		if not propertyDict is None:
+			return propertyDict, stamp, size
+
+		propertyDict, stamp, size = self.__readStorageShared(storage, filePath)
+		if not stamp is None:
+			persistentCache.set(filePath, stamp, propertyDict)
+		return propertyDict, stamp, size
+
+	def __readStorageShared(self, storage, filePath):
+		"""
+		保存先の共有ロックを取得してからpropertyを読む。
+		"""
+		lock = storage.sharedLock(filePath)
+		if lock is None:
+			return storage.read(filePath, self.__readTimeLimit)
+
+		#FileLockはwith内の例外を送出しないので、読み込みの失敗を送出できるよう直接呼ぶ。
+		if _metrics.enabled:
+			lock = _MeasuredLock(lock, filePath)
+		lock.__enter__()
+		try:
+			return storage.read(filePath, self.__readTimeLimit)
+		finally:
+			lock.__exit__(None, None, None)
 
-	def update(self, key, value):
+	def update(self, key, value, expectedVersion=None):
 		"""
 		このオブジェクトのpropertyをkey-valueで更新する。
 		キーはASCII文字列でなければならない。
 		何度も呼ぶ場合は都度ファイルアクセスが発生しないようupdateDict()を用いること。
-		更新されたpropertyのdictを返す。
+		更新されたpropertyのdictを返す。expectedVersionはupdateDict()を参照。
 		"""
-		return self.updateDict({key:value})
+		return self.updateDict({key:value}, expectedVersion)
 
-	def updateDict(self, propDict):
+	def updateDict(self, propDict, expectedVersion=None):
 		"""
 		このオブジェクトのpropertyをdictで更新する。
 		dictのキーはASCII文字列でなければならない。
 		更新されたpropertyのdictを返す。
+		トランザクション中であればファイルには書き込まず、トランザクション終了時にまとめて書き込む。
+		expectedVersionを指定すると、ロック中のpropertyのバージョンがgetVersion()で得たこの値と異なれば何も書き込まずPropertyVersionConflictErrorを送出する。
 		"""
 
 		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
@@ -261,54 +2478,19 @@ class PropertyHolder(object):
 				logging.error(msg)
 				raise MyException(msg)
 
-		#propertyファイル更新。
-		with FileLock(filePath): #propertyファイルのリードとライトをアトミックに行う。
-			currentDict = self.__updateDict(propDict)
-
-		#キャッシュ更新。
-		self.__cache.set(filePath, currentDict)
-
-		return currentDict
-
-	def __updateDict(self, propDict):
-
-		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
-
-		#現在のpropertyをファイルからロード。
-		currentDict = self.__getDictWithoutInheritance(filePath)
-
-		#propDictをマージ。
-		currentDict.update(propDict)
-
-		if not currentDict:
-			#空dictならPropertyファイルを削除。
-			self.__clear(filePath)
-			return {}
-
-		#Propertyファイルライト。
-		try:
-			with open(filePath, 'w') as f:
-				json.dump(currentDict, f)
-		except IOError:
-			msg = 'Property file write IO error ' + repr(filePath) + '.'
-			logging.error(msg)
-			import traceback
-			logging.error(traceback.format_exc())
-			raise
-		except:
-			msg = 'Unexpected property write error.' % repr(filePath)
-			logging.error(msg)
-			import traceback
-			logging.error(traceback.format_exc())
-			raise
+		transaction = PropertyTransaction._getCurrent()
+		if transaction:
+			return transaction._updateDict(self, filePath, propDict, expectedVersion)
 
-		return currentDict
+		#propertyファイル更新。
+		return self.__commitChangesLocked(filePath, propDict, (), False, expectedVersion)
 
 	def remove(self, key):
 		"""
 		このオブジェクトのkeyで指定されたpropertyを削除する。存在しなければ何もしない。
 		キーはASCII文字列でなければならない。
 		更新されたpropertyのdictを返す。
+		トランザクション中であればファイルには書き込まず、トランザクション終了時にまとめて書き込む。
 		"""
 		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
 
@@ -317,67 +2499,323 @@ class PropertyHolder(object):
 			logging.error(msg)
 			raise MyException(msg)
 
-		#propertyファイル更新。
-		with FileLock(filePath): #propertyファイルのリードとライトをアトミックに行う。
-			currentDict = self.__remove(key, filePath)
+		transaction = PropertyTransaction._getCurrent()
+		if transaction:
+			return transaction._remove(self, filePath, key)
 
-		#キャッシュ更新。
-		self.__cache.set(filePath, currentDict)
+		#propertyファイル更新。
+		return self.__commitChangesLocked(filePath, {}, (key,), False)
 
-		return currentDict
+	def clear(self):
+		"""
+		このオブジェクトのpropertyを削除する。
+		親オブジェクトのpropertyは削除しないので継承された値は削除されない。
+		トランザクション中であればファイルは削除せず、トランザクション終了時にまとめて削除する。
+		"""
+		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
 
-	def __remove(self, key, filePath):
+		transaction = PropertyTransaction._getCurrent()
+		if transaction:
+			transaction._clear(self, filePath)
+			return
 
-		#現在のpropertyをファイルからロード。
-		currentDict = self.__getDictWithoutInheritance(filePath)
+		self.__commitChangesLocked(filePath, {}, (), True)
 
-		#keyを削除。
-		if key in currentDict:
-			del currentDict[key]
+	@classmethod
+	def transaction(cls, lockTimeLimitSec=5.0):
+		"""
+		propertyの更新をまとめて行うトランザクションを返す。withで用いる。詳細はPropertyTransactionを参照。
+		このオブジェクトに限らず、with内で同じスレッドから行われた全てのPropertyHolderの更新がまとめられる。
+		lockTimeLimitSecは書き込み時に全てのファイルのロックを取得するまでの制限時間。
+		"""
+		return PropertyTransaction(lockTimeLimitSec)
 
-		if not currentDict:
-			#空dictならPropertyファイルを削除。
-			self.__clear(filePath)
-			return {}
+	def __commitChangesLocked(self, filePath, updates, removals, cleared, expectedVersion=None):
+		"""
+		保存先のロックを取得して_commitChanges()を行う。propertyファイルのリードとライトをアトミックに行う。
+		"""
+		#FileLockはwith内の例外を送出しないので、withを使わずに呼んで書き込みの失敗を送出する。
+		lock = _getStorageLock(self._getPropertyStorage(), filePath)
+		lock.__enter__()
+		try:
+			currentDict = self._commitChanges(filePath, updates, removals, cleared, expectedVersion)
+			#他のプロセスの更新と順序が入れ替わらないよう、ロック中にインデックスを更新する。
+			self._updateIndex(filePath, currentDict)
+			return currentDict
+		finally:
+			lock.__exit__(None, None, None)
+
+	def _commitChanges(self, filePath, updates, removals, cleared, expectedVersion=None):
+		"""
+		propertyを、clearedがTrueなら全て削除し、updatesで更新し、removalsのkeyを削除して保存しキャッシュを更新する。
+		呼び出し側で保存先のロックを取得しておくこと。更新されたpropertyのdictを返す。
+		expectedVersionを指定した場合、現在のバージョンと異なればPropertyVersionConflictErrorを送出する。
+		"""
+		storage = self._getPropertyStorage()
+
+		currentDict = None
+		if storage.stampIsRevision:
+			#ロック中にstampがキャッシュと一致すれば、保存されているpropertyを読み直さずにキャッシュを用いる。
+			entry = None if cleared else self.__cache.peek(filePath)
+			if entry or not expectedVersion is None:
+				version = self._checkVersion(filePath, expectedVersion)
+				if entry and version == entry[1]:
+					currentDict = entry[0].copy()
+		elif not expectedVersion is None:
+			#stampは以前の値に戻ることがあるので、キャッシュは用いずにロック中に読み直したものを用いる。
+			version, currentDict = self.__checkVersionLocked(filePath, expectedVersion)
 
-		#Propertyファイルライト。
 		try:
-			with open(filePath, 'w') as f:
-				json.dump(currentDict, f)
-		except IOError:
-			msg = 'Property file write IO error ' + repr(filePath) + '.'
-			logging.error(msg)
-			import traceback
-			logging.error(traceback.format_exc())
-			raise
-		except:
-			msg = 'Unexpected property write error.' % repr(filePath)
-			logging.error(msg)
-			import traceback
-			logging.error(traceback.format_exc())
+			currentDict, stamp, size = storage.applyChanges(filePath, updates, removals, cleared, self.__readTimeLimit, currentDict, expectedVersion)
+		except PropertyVersionConflictError:
+			#書き込みとアトミックにバージョンを確認する保存先で更新されていた。
+			self.__cache.remove(filePath)
 			raise
 
+		#キャッシュ更新。
+		self.__cache.set(filePath, currentDict, stamp, size, storage)
+
 		return currentDict
 
-	def clear(self):
+	def _updateIndex(self, filePath, propDict):
 		"""
-		このオブジェクトのpropertyを削除する。
-		親オブジェクトのpropertyは削除しないので継承された値は削除されない。
+		このオブジェクトのpropertyのインデックスをpropDictで置き換える。_commitChanges()の後、保存先のロック中に呼ぶこと。
+		propertyの書き込みは済んでいるので、インデックスの更新に失敗してもMyExceptionは送出せずに警告する。
+		"""
+		index = self._getPropertyIndex()
+		if index is None:
+			return
+		parentFilePath = os.path.abspath(os.path.normpath(self.__parent._getPropertyFilePath())) if self.__parent else None
+		try:
+			index.update(filePath, parentFilePath, propDict)
+		except MyException:
+			logging.warning('The property index is out of date for %s. Rebuild it with PropertyIndex.rebuild().' % repr(filePath))
+
+	def _getCacheEntry(self):
+		"""
+		このオブジェクトのpropertyの(継承を含めないdict, stamp)をキャッシュから返す。キャッシュがなければ読み込む。
+		dictはキャッシュそのものなので変更してはならない。stampはpropertyがなければ0。
+		"""
+		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
+		propDict = self.__getCachedDictWithoutInheritance(filePath)
+		entry = self.__cache.peek(filePath)
+		if entry:
+			propDict, stamp = entry
+		else:
+			#読み込み直後に追い出された。
+			stamp = 0
+		if isinstance(propDict, _LazyPropertyDict):
+			propDict = self.__getDecodedDictWithoutInheritance(filePath)
+		return propDict, stamp
+
+	def _setCacheEntry(self, propDict, stamp, size):
+		"""
+		このオブジェクトのpropertyのキャッシュを、保存先から読み込んだ(propDict, stamp, size)として保存する。
 		"""
 		filePath = os.path.abspath(os.path.normpath(self._getPropertyFilePath()))
+		self.__cache.set(filePath, propDict, stamp, size, self._getPropertyStorage())
 
-		with FileLock(filePath):
-			self.__clear(filePath)
+	def _checkVersion(self, filePath, expectedVersion):
+		"""
+		保存されている現在のpropertyのバージョンを返す。expectedVersionを指定した場合、異なればPropertyVersionConflictErrorを送出する。
+		呼び出し側で保存先のロックを取得しておくこと。
+		"""
+		return self.__checkVersionLocked(filePath, expectedVersion)[0]
 
-		self.__cache.set(filePath, {})
+	def __checkVersionLocked(self, filePath, expectedVersion):
+		"""
+		_checkVersion()を行い、(バージョン, 読み直したpropertyのdict)を返す。dictは読み直さなかった場合はNone。
+		stampが以前の値に戻ることがある保存先では、stampが一致すればpropertyを読み直し、expectedVersionを得たときのキャッシュと内容も比較する。
+		"""
+		storage = self._getPropertyStorage()
+		fileStamp = storage.stat(filePath)
+		version = 0 if fileStamp is None else fileStamp[0]
+		if expectedVersion is None:
+			return version, None
+
+		currentDict = None
+		rewritten = False
+		if version == expectedVersion and version != 0 and not storage.stampIsRevision:
+			currentDict, stamp, size = storage.read(filePath, self.__readTimeLimit)
+			if isinstance(currentDict, _LazyPropertyDict):
+				currentDict = currentDict.copy()
+			#キャッシュがexpectedVersionのものでなければ内容を確認できないので、更新されていたとみなす。
+			entry = self.__cache.peek(filePath)
+			cachedDict = entry[0] if entry and entry[1] == expectedVersion else None
+			if isinstance(cachedDict, _LazyPropertyDict):
+				cachedDict = cachedDict.copy()
+			rewritten = stamp != expectedVersion or cachedDict != currentDict
+
+		if version != expectedVersion or rewritten:
+			#キャッシュは古いので、getVersion()で新しいバージョンを得て再トライできるよう取り除く。
+			self.__cache.remove(filePath)
+			if rewritten:
+				msg = 'Property %s was rewritten by another process with the same version %s.' % (repr(filePath), repr(expectedVersion))
+			else:
+				msg = 'Property %s was updated by another process. expected version %s, found %s.' % (repr(filePath), repr(expectedVersion), repr(version))
+			logging.warning(msg)
+			raise PropertyVersionConflictError(msg)
+		return version, currentDict
 
-	def __clear(self, filePath):
-		if os.path.exists(filePath):
-			os.remove(filePath)
+	def _getParent(self):
+		"""
+		親のオブジェクトを返す。親がなければNoneを返す。
+		"""
+		return self.__parent
 
 	def _getPropertyFilePath(self):
 		"""
 		propertyファイルへのパスを返す。propertyファイルは存在していなくても構わない。
+		デフォルト以外の保存先を用いる場合は保存先の中でこのオブジェクトを識別するために用いられる。
 		"""
 		#Must be overridden at a subclass.
 		raise NotImplementedError
+
+	def _getPropertyStorage(self):
+		"""
+		propertyの保存先（PropertyStorage）を返す。デフォルトはオブジェクトごとのJSONファイル。
+		他の保存先を用いる場合はサブクラスでオーバーライドする。同じオブジェクトに対しては常に同じ保存先を返すこと。
+		"""
+		return _defaultStorage
+
+	def _getPropertyIndex(self):
+		"""
+		propertyを更新したときに更新するPropertyIndexを返す。Noneならインデックスを用いない。
+		"""
+		return None
+
+
+#============================================================================
+#============================================================================
+class PropertyTransaction(object):
+	"""
+	propertyの更新をまとめて書き込むトランザクション。
+
+	使い方。with内の更新はメモリ上に溜められ、withを抜けるときにファイルごとに1回だけロックを取ってまとめて書き込まれる。
+		with holder.transaction():
+			holder.update('someKey', 1)
+			holder.remove('someOtherKey')
+			anotherHolder.update('someKey', 2) #同じスレッドで行われた他のオブジェクトの更新も同じトランザクションに含まれる。
+
+	書き込み前に更新のある全てのファイルの保存先のロックをFileLockSetでまとめて取得するので、他のプロセス（ユーザー）の更新と混ざることはない。
+	全てのロックを取得するまでの時間はlockTimeLimitSecで制限され、取得できなければ何も書き込まずMyExceptionを送出する。
+	with内で例外が発生した場合は何も書き込まない。
+	with内の読み込みにはまだ書き込んでいない更新は反映されない。update()等の戻り値は書き込み後に予想されるpropertyのdict。
+	トランザクションを入れ子にした場合は一番外側のトランザクションにまとめられる。
+	update()等でexpectedVersionを指定した場合は全てのロックを取得してからバージョンを確認し、一つでも異なれば何も書き込まずPropertyVersionConflictErrorを送出する。
+	"""
+
+	__local = threading.local()
+	"""
+	スレッドごとの現在のトランザクション。
+	"""
+
+	def __init__(self, lockTimeLimitSec=5.0):
+		self.__lockTimeLimitSec = lockTimeLimitSec
+		"""
+		全てのファイルのロックを取得するまでの制限時間。入れ子の場合は一番外側のものを用いる。
+		"""
+
+		self.__changes = {}
+		"""
+		{filePath: [holder, updates, removals, cleared]}
+		ファイルごとの書き込み前の更新。
+		"""
+
+		self.__expectedVersions = {}
+		"""
+		{filePath: expectedVersion}
+		書き込み前に確認するバージョン。同じファイルに複数回指定された場合は最初のもの。
+		"""
+
+		self.__outer = None
+		"""
+		入れ子になっている場合の外側のトランザクション。
+		"""
+
+	@classmethod
+	def _getCurrent(cls):
+		"""
+		このスレッドで現在有効なトランザクションを返す。なければNoneを返す。
+		"""
+		return getattr(cls.__local, 'transaction', None)
+
+	def __enter__(self):
+		self.__outer = self._getCurrent()
+		if not self.__outer:
+			self.__local.transaction = self
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if self.__outer:
+			#外側のトランザクションで書き込まれる。
+			return
+
+		self.__local.transaction = None
+		if exc_type is None:
+			self.__commit()
+
+	def _updateDict(self, holder, filePath, propDict, expectedVersion=None):
+		if not expectedVersion is None:
+			self.__expectedVersions.setdefault(filePath, expectedVersion)
+		change = self.__getChange(holder, filePath)
+		change[1].update(propDict)
+		change[2].difference_update(propDict)
+		return self.__getExpectedDict(filePath)
+
+	def _remove(self, holder, filePath, key):
+		change = self.__getChange(holder, filePath)
+		change[1].pop(key, None)
+		change[2].add(key)
+		return self.__getExpectedDict(filePath)
+
+	def _clear(self, holder, filePath):
+		self.__changes[filePath] = [holder, {}, set(), True]
+
+	def __getChange(self, holder, filePath):
+		if not filePath in self.__changes:
+			self.__changes[filePath] = [holder, {}, set(), False]
+		return self.__changes[filePath]
+
+	def __getExpectedDict(self, filePath):
+		"""
+		書き込み後に予想されるpropertyのdictを返す。
+		"""
+		holder, updates, removals, cleared = self.__changes[filePath]
+		expectedDict = {} if cleared else holder.getDictWithoutInheritance()
+		expectedDict.update(updates)
+		for key in removals:
+			expectedDict.pop(key, None)
+		return expectedDict
+
+	def __commit(self):
+		changes = self.__changes
+		def getLock(filePath, timeLimitSec):
+			return _getStorageLock(changes[filePath][0]._getPropertyStorage(), filePath, timeLimitSec)
+
+		#デッドロックしないようFileLockSetでまとめてロックを取得する。
+		filePaths = sorted(self.__changes)
+		lockSet = FileLockSet(filePaths, self.__lockTimeLimitSec, getLock)
+		locked = False
+		try:
+			lockSet.__enter__()
+			locked = True
+
+			#一つでもバージョンが異なれば何も書き込まない。
+			for filePath, expectedVersion in self.__expectedVersions.iteritems():
+				self.__changes[filePath][0]._checkVersion(filePath, expectedVersion)
+
+			committedDicts = []
+			for filePath in filePaths:
+				holder, updates, removals, cleared = self.__changes[filePath]
+				#lock()を用いない保存先では書き込みとアトミックにもう一度確認する。
+				committedDicts.append(holder._commitChanges(filePath, updates, removals, cleared, self.__expectedVersions.get(filePath)))
+
+			#インデックスは全て書き込んでから更新する。
+			for filePath, committedDict in zip(filePaths, committedDicts):
+				self.__changes[filePath][0]._updateIndex(filePath, committedDict)
+		finally:
+			if locked:
+				lockSet.__exit__(None, None, None)
+			self.__changes = {}
+			self.__expectedVersions = {}
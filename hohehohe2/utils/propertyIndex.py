@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+propertyの値からオブジェクトを検索するための転置インデックス。
+(key, value)からpropertyファイルのパスを引くインデックスと、親のpropertyファイルのパスをSQLiteデータベースに保存する。
+
+使い方。
+	class MyPropertyHolder(PropertyHolder):
+		__index = PropertyIndex('/path/to/propertyIndex.db')
+
+		def _getPropertyIndex(self):
+			return self.__index
+
+	index.rebuild(allHolders) #既存のpropertyファイルからインデックスを作る。
+	filePaths = index.find('status', 'approved') #継承を含めて'status'が'approved'のオブジェクトのpropertyファイルのパス。
+
+PropertyHolderによる更新では自動的にインデックスも更新される。他の方法でpropertyファイルを書き換えた場合はrebuild()すること。
+valueはJSONとして比較されるので、1と1.0は別の値として扱われる。
+"""
+
+import os, json, logging, threading, sqlite3
+from hohehohe2.utils.myException import MyException
+
+
+#============================================================================
+#============================================================================
+def _canonicalize(value):
+	"""
+	valueをインデックスで比較するためのJSON文字列にする。
+	"""
+	return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+#============================================================================
+#============================================================================
+class PropertyIndex(object):
+	"""
+	(key, value)からpropertyファイルのパスを引くインデックス。
+	"""
+
+	def __init__(self, dbPath, timeLimitSec=5.0):
+		self.__dbPath = os.path.abspath(os.path.normpath(dbPath))
+		"""
+		データベースファイルのパス。
+		"""
+
+		self.__timeLimitSec = timeLimitSec
+		"""
+		他のプロセス（ユーザー）が書き込み中のときに待つ秒数。
+		"""
+
+		self.__local = threading.local()
+		"""
+		スレッドごとのデータベース接続。
+		"""
+
+	def update(self, filePath, parentFilePath, propDict):
+		"""
+		filePathのpropertyのインデックスをpropDictで置き換える。parentFilePathは親のpropertyファイルのパスで、親がなければNone。
+		"""
+		self.__execute(self.__update, [(filePath, parentFilePath, propDict)])
+
+	def remove(self, filePath):
+		"""
+		filePathのオブジェクトをインデックスから削除する。
+		"""
+		def remove(connection):
+			connection.execute('DELETE FROM entries WHERE path = ?', (filePath,))
+			connection.execute('DELETE FROM holders WHERE path = ?', (filePath,))
+		self.__execute(remove)
+
+	def rebuild(self, holders):
+		"""
+		インデックスを全て削除し、holdersとその親のpropertyからインデックスを作り直す。
+		"""
+		from hohehohe2.utils.propertyHolder import PropertyHolder
+
+		#並列に読み込んでキャッシュに入れておく。
+		PropertyHolder.getDictMany(holders)
+
+		records = {}
+		for holder in holders:
+			while holder:
+				filePath = os.path.abspath(os.path.normpath(holder._getPropertyFilePath()))
+				if filePath in records:
+					break
+				parent = holder._getParent()
+				parentFilePath = os.path.abspath(os.path.normpath(parent._getPropertyFilePath())) if parent else None
+				records[filePath] = (filePath, parentFilePath, holder.getDictWithoutInheritance())
+				holder = parent
+
+		def rebuild(connection):
+			connection.execute('DELETE FROM entries')
+			connection.execute('DELETE FROM holders')
+			self.__update(connection, records.values())
+		self.__execute(rebuild)
+
+	def find(self, key, value, inherit=True):
+		"""
+		propertyのkeyの値がvalueであるオブジェクトのpropertyファイルのパスのリストを返す。
+		inheritがTrueなら親から継承した値も含める。この場合インデックスに登録されている子孫のみが対象になる。
+		"""
+		if not isinstance(key, basestring):
+			msg = 'Bug found. Tried to find a property with non-string key "%s"' % repr(key)
+			logging.error(msg)
+			raise MyException(msg)
+
+		if not inherit:
+			query = 'SELECT path FROM entries WHERE key = ? AND value = ?'
+			args = (key, _canonicalize(value))
+		else:
+			#値を持つオブジェクトから、自身ではkeyを持たない子孫をたどる。
+			query = '''
+				WITH RECURSIVE matched(path) AS (
+					SELECT path FROM entries WHERE key = ? AND value = ?
+					UNION
+					SELECT holders.path FROM holders JOIN matched ON holders.parentPath = matched.path
+					WHERE NOT EXISTS (SELECT 1 FROM entries WHERE entries.path = holders.path AND entries.key = ?)
+				)
+				SELECT path FROM matched'''
+			args = (key, _canonicalize(value), key)
+
+		try:
+			return [row[0] for row in self.__getConnection().execute(query, args)]
+		except sqlite3.Error:
+			msg = 'Failed querying property index %s' % repr(self.__dbPath)
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise MyException(msg)
+
+	def __update(self, connection, records):
+		"""
+		records（(filePath, parentFilePath, propDict)のリスト）のインデックスを置き換える。
+		"""
+		for filePath, parentFilePath, propDict in records:
+			connection.execute('DELETE FROM entries WHERE path = ?', (filePath,))
+			connection.execute('INSERT OR REPLACE INTO holders (path, parentPath) VALUES (?, ?)', (filePath, parentFilePath))
+			connection.executemany('INSERT INTO entries (path, key, value) VALUES (?, ?, ?)', [(filePath, key, _canonicalize(value)) for key, value in propDict.iteritems()])
+
+	def __execute(self, func, *args):
+		"""
+		書き込みのトランザクションでfunc(connection, *args)を実行する。
+		"""
+		try:
+			connection = self.__getConnection()
+			connection.execute('BEGIN IMMEDIATE')
+			try:
+				func(connection, *args)
+			except:
+				connection.execute('ROLLBACK')
+				raise
+			connection.execute('COMMIT')
+		except sqlite3.Error:
+			msg = 'Failed writing property index %s' % repr(self.__dbPath)
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise MyException(msg)
+
+	def __getConnection(self):
+		connection = getattr(self.__local, 'connection', None)
+		if connection is None:
+			#トランザクションは明示的に開始する。
+			connection = sqlite3.connect(self.__dbPath, timeout=self.__timeLimitSec, isolation_level=None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('CREATE TABLE IF NOT EXISTS holders (path TEXT PRIMARY KEY, parentPath TEXT)')
+			connection.execute('CREATE INDEX IF NOT EXISTS holdersParentPath ON holders (parentPath)')
+			connection.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (path, key))')
+			connection.execute('CREATE INDEX IF NOT EXISTS entriesKeyValue ON entries (key, value)')
+			self.__local.connection = connection
+		return connection
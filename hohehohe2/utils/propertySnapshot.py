@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+PropertyHolderの階層のpropertyをまとめて一つのスナップショットファイルに書き出し、読み込む。
+プロジェクトの移行やアーカイブ、新しいマシンでのキャッシュの準備で、propertyファイルを一つずつ読む代わりにスナップショットファイルを一度読むだけで済む。
+
+使い方。
+	exportSnapshot(holders, '/path/to/snapshot.json') #holdersとその親のpropertyを書き出す。
+	importSnapshot('/path/to/snapshot.json', holders) #更新されていないpropertyをキャッシュに入れる。
+	importSnapshot('/path/to/snapshot.json', holders, writeBack=True) #スナップショットの内容を書き戻す。
+
+スナップショットファイルはJSONで、propertyファイルごとに(パス, stamp, 継承を含めないproperty)を保存する。
+"""
+
+import os, sys, json, logging
+from hohehohe2.utils.propertyHolder import PropertyHolder, FilePropertyStorage, _replaceFile
+from hohehohe2.utils.myException import MyException
+
+
+_FORMAT = 'hohe2PropertySnapshot'
+"""
+スナップショットファイルであることを示す値。
+"""
+
+_FORMAT_VERSION = 1
+"""
+スナップショットファイルのフォーマットのバージョン。
+"""
+
+
+#============================================================================
+#============================================================================
+def exportSnapshot(holders, snapshotPath, poolSize=16):
+	"""
+	holdersとその親のpropertyをスナップショットファイルに書き出す。書き出したpropertyファイルの数を返す。
+	キャッシュにないpropertyファイルはpoolSize個ずつ並列に読み込む。
+	"""
+	holderByFilePath = _collectHolders(holders)
+
+	#並列に読み込んでキャッシュに入れておく。
+	PropertyHolder.getDictMany(holders, poolSize)
+
+	entries = []
+	for filePath in sorted(holderByFilePath):
+		propDict, stamp = holderByFilePath[filePath]._getCacheEntry()
+		entries.append((filePath, stamp, propDict))
+
+	#同じディレクトリの一時ファイルに書き込んでから置き換える。
+	snapshotPath = os.path.abspath(os.path.normpath(snapshotPath))
+	tmpFilePath = '%s.tmp_%d' % (snapshotPath, os.getpid())
+	try:
+		with open(tmpFilePath, 'wb') as f:
+			json.dump({'format': _FORMAT, 'version': _FORMAT_VERSION, 'entries': entries}, f, separators=(',', ':'))
+		_replaceFile(tmpFilePath, snapshotPath)
+	except (IOError, OSError):
+		msg = 'Failed writing property snapshot ' + repr(snapshotPath)
+		logging.error(msg)
+		import traceback
+		logging.error(traceback.format_exc())
+		if os.path.exists(tmpFilePath):
+			os.remove(tmpFilePath)
+		raise MyException(msg)
+
+	return len(entries)
+
+
+#============================================================================
+#============================================================================
+def importSnapshot(snapshotPath, holders, writeBack=False, poolSize=16):
+	"""
+	スナップショットファイルを読み込み、holdersとその親のpropertyに用いる。スナップショットにないものやholdersに含まれないものは何もしない。
+	writeBackがFalseなら、保存されているpropertyのstampがスナップショットと一致するものだけをキャッシュに入れる。更新されていたものは通常通り読み込まれる。
+	stampはディレクトリごとにまとめて確認するので、propertyファイルを一つずつ読むより速い。
+	writeBackがTrueなら、保存されているpropertyをスナップショットの内容で置き換える。propertyファイルごとにロックを取得し、poolSize個ずつ並列に書き込む。
+	キャッシュに入れた、または書き込んだpropertyファイルの数を返す。
+	"""
+	holderByFilePath = _collectHolders(holders)
+	entries = [(filePath, stamp, propDict) for filePath, stamp, propDict in _readSnapshot(snapshotPath) if filePath in holderByFilePath]
+
+	if writeBack:
+		def write(entry):
+			filePath, stamp, propDict = entry
+			#一つのトランザクションで書き込み、削除と更新の間に他のプロセス（ユーザー）に読まれないようにする。
+			with PropertyHolder.transaction():
+				holder = holderByFilePath[filePath]
+				holder.clear()
+				if propDict:
+					holder.updateDict(propDict)
+		_map(write, entries, poolSize)
+		return len(entries)
+
+	#保存先とディレクトリごとにまとめる。
+	entriesByDir = {}
+	for entry in entries:
+		storage = holderByFilePath[entry[0]]._getPropertyStorage()
+		entriesByDir.setdefault((storage, os.path.dirname(entry[0])), []).append(entry)
+
+	numLoaded = 0
+	for (storage, dirPath), dirEntries in entriesByDir.iteritems():
+		fileNames = [os.path.basename(filePath) for filePath, stamp, propDict in dirEntries]
+		if isinstance(storage, FilePropertyStorage):
+			fileStamps = storage.statDirectory(dirPath, fileNames)
+		else:
+			fileStamps = dict((os.path.basename(filePath), storage.stat(filePath)) for filePath, stamp, propDict in dirEntries)
+
+		for filePath, stamp, propDict in dirEntries:
+			fileStamp = fileStamps.get(os.path.basename(filePath))
+			if fileStamp is None:
+				if propDict:
+					#スナップショットの後に削除された。
+					continue
+				holderByFilePath[filePath]._setCacheEntry({}, None, 0)
+			elif propDict and fileStamp[0] == stamp:
+				holderByFilePath[filePath]._setCacheEntry(propDict, stamp, fileStamp[1])
+			else:
+				#スナップショットの後に更新された。
+				continue
+			numLoaded += 1
+
+	return numLoaded
+
+
+#============================================================================
+#============================================================================
+def _collectHolders(holders):
+	"""
+	holdersとその親を重複なく集め、{propertyファイルのパス: holder}を返す。
+	"""
+	holderByFilePath = {}
+	for holder in holders:
+		while holder:
+			filePath = os.path.abspath(os.path.normpath(holder._getPropertyFilePath()))
+			if filePath in holderByFilePath:
+				break
+			holderByFilePath[filePath] = holder
+			holder = holder._getParent()
+	return holderByFilePath
+
+
+#============================================================================
+#============================================================================
+def _readSnapshot(snapshotPath):
+	"""
+	スナップショットファイルを読み込み、(propertyファイルのパス, stamp, property)のリストを返す。
+	"""
+	try:
+		with open(snapshotPath, 'rb') as f:
+			snapshot = json.load(f)
+	except (IOError, OSError, ValueError):
+		msg = 'Failed reading property snapshot ' + repr(snapshotPath)
+		logging.error(msg)
+		import traceback
+		logging.error(traceback.format_exc())
+		raise MyException(msg)
+
+	if not isinstance(snapshot, dict) or snapshot.get('format') != _FORMAT or snapshot.get('version') != _FORMAT_VERSION:
+		msg = 'Unsupported property snapshot format ' + repr(snapshotPath)
+		logging.error(msg)
+		raise MyException(msg)
+
+	#JSONではパスはunicodeに、stampのtupleはlistになっている。
+	encoding = sys.getfilesystemencoding() or 'utf-8'
+	entries = []
+	for filePath, stamp, propDict in snapshot['entries']:
+		if isinstance(filePath, unicode):
+			filePath = filePath.encode(encoding)
+		if isinstance(stamp, list):
+			stamp = tuple(stamp)
+		entries.append((filePath, stamp, propDict))
+	return entries
+
+
+#============================================================================
+#============================================================================
+def _map(func, items, poolSize):
+	"""
+	itemsの各要素にfuncをpoolSize個ずつ並列に適用する。
+	"""
+	if len(items) > 1 and poolSize > 1:
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(min(poolSize, len(items)))
+		try:
+			pool.map(func, items)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for item in items:
+			func(item)
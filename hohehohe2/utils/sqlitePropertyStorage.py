@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+SQLiteデータベースにpropertyを保存するPropertyStorage。
+多数のオブジェクトのpropertyを一つのデータベースファイルにまとめるので、オブジェクトごとにpropertyファイルとロックディレクトリを作る場合に比べファイル数やstatの回数が増えない。
+更新は変更されたkeyの行だけを書き換える。
+
+使い方。
+	class MyPropertyHolder(PropertyHolder):
+		__storage = SqlitePropertyStorage('/local/path/properties.db')
+
+		def _getPropertyFilePath(self):
+			return ... #データベース内でオブジェクトを識別するパス。
+
+		def _getPropertyStorage(self):
+			return self.__storage
+
+注：WALモードを用いるので、データベースファイルはNFS等のネットワークファイルシステムではなくローカルディスクに置くこと。
+"""
+
+import os, json, logging, threading, sqlite3
+from hohehohe2.utils.propertyHolder import PropertyStorage, PropertyVersionConflictError
+from hohehohe2.utils.myException import MyException
+
+
+#============================================================================
+#============================================================================
+class SqlitePropertyStorage(PropertyStorage):
+	"""
+	SQLiteデータベースにpropertyを保存するPropertyStorage。
+	propertyはオブジェクトのパスとkeyごとに一行ずつ、値はJSON文字列で保存される。
+	stampはオブジェクトごとの更新回数。
+	lock()は用いず、書き込みはSQLiteのトランザクションでアトミックに行う。expectedVersionの確認も同じトランザクションで行う。
+	"""
+
+	stampIsRevision = True
+
+	def __init__(self, dbPath, timeLimitSec=5.0):
+		self.__dbPath = os.path.abspath(os.path.normpath(dbPath))
+		"""
+		データベースファイルのパス。
+		"""
+
+		self.__timeLimitSec = timeLimitSec
+		"""
+		他のプロセス（ユーザー）が書き込み中のときに待つ秒数。
+		"""
+
+		self.__local = threading.local()
+		"""
+		スレッドごとのデータベース接続。
+		"""
+
+	def read(self, path, readTimeLimit):
+		connection = self.__getConnection()
+		try:
+			#読み込みとstampの取得を同じトランザクションで行う。
+			connection.execute('BEGIN')
+			try:
+				row = connection.execute('SELECT revision, size FROM holders WHERE path = ?', (path,)).fetchone()
+				rows = connection.execute('SELECT key, value FROM properties WHERE path = ?', (path,)).fetchall()
+			finally:
+				connection.execute('COMMIT')
+		except sqlite3.Error:
+			msg = 'Failed reading property database %s for %s' % (repr(self.__dbPath), repr(path))
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise MyException(msg)
+
+		if not row or not rows:
+			return {}, None, 0
+
+		revision, size = row
+		return dict((key, json.loads(value)) for key, value in rows), revision, size
+
+	def stat(self, path):
+		row = self.__getConnection().execute('SELECT revision, size FROM holders WHERE path = ?', (path,)).fetchone()
+		if not row or not row[1]:
+			return None
+		return row
+
+	def applyChanges(self, path, updates, removals, cleared, readTimeLimit, currentDict=None, expectedVersion=None):
+		#変更されたkeyの行だけを書き換えるので、currentDictは用いない。
+		connection = self.__getConnection()
+		try:
+			#書き込みロックを最初に取得し、他のプロセス（ユーザー）の更新と混ざらないようにする。
+			connection.execute('BEGIN IMMEDIATE')
+			try:
+				if not expectedVersion is None:
+					#stat()と同じく、propertyがなければバージョンは0。
+					row = connection.execute('SELECT revision, size FROM holders WHERE path = ?', (path,)).fetchone()
+					version = row[0] if row and row[1] else 0
+					if version != expectedVersion:
+						msg = 'Property %s was updated by another process. expected version %s, found %s.' % (repr(path), repr(expectedVersion), repr(version))
+						logging.warning(msg)
+						raise PropertyVersionConflictError(msg)
+
+				if cleared:
+					connection.execute('DELETE FROM properties WHERE path = ?', (path,))
+				connection.executemany('INSERT OR REPLACE INTO properties (path, key, value) VALUES (?, ?, ?)', [(path, key, json.dumps(value)) for key, value in updates.iteritems()])
+				connection.executemany('DELETE FROM properties WHERE path = ? AND key = ?', [(path, key) for key in removals if not key in updates])
+
+				rows = connection.execute('SELECT key, value FROM properties WHERE path = ?', (path,)).fetchall()
+				size = sum(len(key) + len(value) for key, value in rows)
+
+				#propertyが空になっても行は削除せず、更新回数が同じ値に戻らないようにする。
+				row = connection.execute('SELECT revision FROM holders WHERE path = ?', (path,)).fetchone()
+				revision = row[0] + 1 if row else 1
+				connection.execute('INSERT OR REPLACE INTO holders (path, revision, size) VALUES (?, ?, ?)', (path, revision, size))
+			except:
+				connection.execute('ROLLBACK')
+				raise
+			connection.execute('COMMIT')
+		except sqlite3.Error:
+			msg = 'Failed writing property database %s for %s' % (repr(self.__dbPath), repr(path))
+			logging.error(msg)
+			import traceback
+			logging.error(traceback.format_exc())
+			raise MyException(msg)
+
+		if not rows:
+			return {}, None, 0
+		return dict((key, json.loads(value)) for key, value in rows), revision, size
+
+	def __getConnection(self):
+		connection = getattr(self.__local, 'connection', None)
+		if connection is None:
+			#トランザクションは明示的に開始する。
+			connection = sqlite3.connect(self.__dbPath, timeout=self.__timeLimitSec, isolation_level=None)
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			connection.execute('CREATE TABLE IF NOT EXISTS holders (path TEXT PRIMARY KEY, revision INTEGER NOT NULL, size INTEGER NOT NULL)')
+			connection.execute('CREATE TABLE IF NOT EXISTS properties (path TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (path, key))')
+			self.__local.connection = connection
+		return connection
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""
+PropertyHolderのベンチマーク。unittestではないので直接実行する。
+
+	python benchPropertyHolder.py [--suites tree,write,codec,lazy,coldStart] [--depth 4] [--fanout 6] [--keys 100] ...
+	python benchPropertyHolder.py --json result.json
+	python benchPropertyHolder.py --baseline result.json --threshold 0.25
+
+結果は全て秒数（小さいほど速い）で、--jsonを指定するとJSONで書き出す。
+--baselineを指定すると以前の結果と比べ、threshold以上の割合で遅くなった項目があれば終了コード1で終了する。
+"""
+
+import os, sys, time, json, random, argparse, datetime, subprocess, tempfile, shutil
+from hohehohe2.utils.propertyHolder import PropertyHolder, FilePropertyStorage, JsonPropertyCodec, MarshalPropertyCodec, _PropertyCache
+
+SUITES = ('tree', 'write', 'codec', 'lazy', 'coldStart')
+
+
+#============================================================================
+#============================================================================
+class BenchPropertyHolder(PropertyHolder):
+	def __init__(self, dirPath, name, parent):
+		super(BenchPropertyHolder, self).__init__(parent)
+		self.dirPath = dirPath
+		self.name = name
+
+	def _getPropertyFilePath(self):
+		return os.path.join(self.dirPath, self.name)
+
+
+#============================================================================
+#============================================================================
+class LazyBenchPropertyHolder(BenchPropertyHolder):
+	__storage = FilePropertyStorage(lazyThresholdBytes=0)
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+def makePropertyDict(numKeys, valueSize=16, keyOffset=0):
+	"""
+	ベンチマーク用のpropertyのdictを作る。文字列のvalueはvalueSizeバイト。
+	"""
+	propDict = {}
+	for i in range(keyOffset, keyOffset + numKeys):
+		key = 'key%05d' % i
+		kind = i % 4
+		if kind == 0:
+			propDict[key] = i
+		elif kind == 1:
+			propDict[key] = ('value of %s ' % key * (valueSize // 17 + 1))[:valueSize]
+		elif kind == 2:
+			propDict[key] = [i * 0.5, None, True]
+		else:
+			propDict[key] = {'name': key, 'size': [i, i + 1], 'enabled': False}
+	return propDict
+
+
+#============================================================================
+#============================================================================
+def timeIt(func, repeat):
+	"""
+	funcをrepeat回実行した中で最も短い秒数を返す。
+	"""
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		func()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+#============================================================================
+#============================================================================
+def setCacheValidityUnCheckDuration(sec):
+	_PropertyCache._PropertyCache__CACHE_VALIDITY_UN_CHECK_DURATION = datetime.timedelta(seconds=sec)
+
+
+#============================================================================
+#============================================================================
+def makeTree(dirPath, depth, fanout, numKeys, valueSize):
+	"""
+	深さdepth、各オブジェクトがfanoutの子を持つオブジェクトのツリーを作り、葉のリストを返す。
+	各propertyファイルはnumKeysのkeyを持ち、半分は親と同じkeyを上書きする。propertyファイルがなければ書き込む。
+	"""
+	def make(name, parent, level):
+		holder = BenchPropertyHolder(dirPath, name, parent)
+		if not os.path.exists(holder._getPropertyFilePath()):
+			holder.updateDict(makePropertyDict(numKeys, valueSize, level * numKeys // 2))
+		if level == depth:
+			return [holder]
+		leaves = []
+		for i in range(fanout):
+			leaves += make('%s_%d' % (name, i), holder, level + 1)
+		return leaves
+
+	return make('node', None, 0)
+
+
+#============================================================================
+#============================================================================
+def benchTree(args):
+	"""
+	ツリーの葉のpropertyを読む秒数を測る。
+	"""
+	dirPath = tempfile.mkdtemp(prefix='benchPropertyHolder_')
+	try:
+		leaves = makeTree(dirPath, args.depth, args.fanout, args.keys, args.value_size)
+		key = 'key%05d' % (args.depth * args.keys // 2) #全ての階層で定義されているとは限らないkey。
+
+		def getDictAll():
+			for holder in leaves:
+				holder.getDict()
+
+		def getAll():
+			for holder in leaves:
+				holder.get(key)
+
+		def cold(func):
+			def run():
+				PropertyHolder.clearAllCaches()
+				func()
+			return run
+
+		results = {}
+		results['tree.coldGetDict'] = timeIt(cold(getDictAll), args.rounds)
+		results['tree.coldGet'] = timeIt(cold(getAll), args.rounds)
+		getDictAll()
+		results['tree.warmGetDict'] = timeIt(getDictAll, args.rounds)
+		results['tree.warmGet'] = timeIt(getAll, args.rounds)
+
+		#キャッシュが有効かどうか毎回statで確認する場合。
+		setCacheValidityUnCheckDuration(0)
+		try:
+			results['tree.revalidateGet'] = timeIt(getAll, args.rounds)
+		finally:
+			setCacheValidityUnCheckDuration(20)
+
+		results['tree.getDictMany'] = timeIt(cold(lambda: PropertyHolder.getDictMany(leaves)), args.rounds)
+		return results
+	finally:
+		PropertyHolder.clearAllCaches()
+		shutil.rmtree(dirPath)
+
+
+#============================================================================
+#============================================================================
+def writeMany(task):
+	"""
+	benchWrite()の子プロセスで、ランダムに選んだpropertyファイルにupdateDict()を繰り返す。
+	"""
+	dirPath, names, numWrites, seed = task
+	rand = random.Random(seed)
+	holders = [BenchPropertyHolder(dirPath, name, None) for name in names]
+	for i in range(numWrites):
+		rand.choice(holders).updateDict({'writer%d' % seed: i})
+
+
+#============================================================================
+#============================================================================
+def benchWrite(args):
+	"""
+	複数のプロセスが同じpropertyファイルの集合にupdateDict()する秒数を測る。
+	"""
+	import multiprocessing
+	dirPath = tempfile.mkdtemp(prefix='benchPropertyHolder_')
+	try:
+		names = ['hot%02d' % i for i in range(args.hot_files)]
+		for name in names:
+			BenchPropertyHolder(dirPath, name, None).updateDict(makePropertyDict(args.keys, args.value_size))
+
+		tasks = [(dirPath, names, args.writes, seed) for seed in range(args.writers)]
+		pool = multiprocessing.Pool(args.writers)
+		try:
+			start = time.time()
+			pool.map(writeMany, tasks)
+			elapsed = time.time() - start
+		finally:
+			pool.close()
+			pool.join()
+		return {'write.concurrentUpdateDict': elapsed}
+	finally:
+		shutil.rmtree(dirPath)
+
+
+#============================================================================
+#============================================================================
+def benchCodecs(args):
+	"""
+	各codecのdump、loadの秒数を測る。
+	"""
+	propDict = makePropertyDict(args.keys * 10, args.value_size)
+	results = {}
+	for codec in (JsonPropertyCodec(), MarshalPropertyCodec()):
+		data = codec.dumps(propDict)
+		name = codec.__class__.__name__
+		results['codec.%s.dump' % name] = timeIt(lambda: codec.dumps(propDict), args.repeat)
+		results['codec.%s.load' % name] = timeIt(lambda: codec.loads(data), args.repeat)
+	return results
+
+
+#============================================================================
+#============================================================================
+def benchLazyGet(args):
+	"""
+	valueが大きなpropertyファイルを読み込んで一つのkeyのvalueを得る秒数を、全体をデコードする場合と遅延デコードする場合で測る。
+	ファイルは100のkeyを持ち、それぞれのvalueはkeys * 10のkeyを持つdict。
+	"""
+	dirPath = tempfile.mkdtemp(prefix='benchPropertyHolder_')
+	try:
+		BenchPropertyHolder(dirPath, 'large', None).updateDict(dict(('key%05d' % i, makePropertyDict(args.keys * 10, args.value_size)) for i in range(100)))
+		results = {}
+		for name, holderClass in (('full', BenchPropertyHolder), ('lazy', LazyBenchPropertyHolder)):
+			holder = holderClass(dirPath, 'large', None)
+			def getOne():
+				PropertyHolder.clearAllCaches()
+				holder.get('key00003')
+			results['lazyGet.' + name] = timeIt(getOne, args.rounds)
+		return results
+	finally:
+		PropertyHolder.clearAllCaches()
+		shutil.rmtree(dirPath)
+
+
+#============================================================================
+#============================================================================
+def makeHolders(dirPath, numHolders, numKeys):
+	"""
+	親一つにつき100の子を持つオブジェクトのツリーを作り、子のリストを返す。propertyファイルがなければ書き込む。
+	"""
+	propDict = makePropertyDict(numKeys)
+	holders = []
+	parent = None
+	for i in range(numHolders):
+		if i % 100 == 0:
+			parent = BenchPropertyHolder(dirPath, 'parent%05d' % i, None)
+			if not os.path.exists(parent._getPropertyFilePath()):
+				parent.updateDict(propDict)
+		holder = BenchPropertyHolder(dirPath, 'child%05d' % i, parent)
+		if not os.path.exists(holder._getPropertyFilePath()):
+			holder.updateDict({'index': i})
+		holders.append(holder)
+	return holders
+
+
+#============================================================================
+#============================================================================
+def traverse(dirPath, numHolders, numKeys, persistentDbPath):
+	"""
+	新しいプロセスで全オブジェクトのpropertyを読む時間を測る。
+	"""
+	if persistentDbPath:
+		PropertyHolder.enablePersistentCache(persistentDbPath)
+	holders = makeHolders(dirPath, numHolders, numKeys)
+	start = time.time()
+	for holder in holders:
+		holder.getDict()
+	return time.time() - start
+
+
+#============================================================================
+#============================================================================
+def benchColdStart(args):
+	"""
+	args.holdersのオブジェクトを新しいプロセスで読む秒数を、永続キャッシュなし、ありで測る。
+	"""
+	dirPath = tempfile.mkdtemp(prefix='benchPropertyHolder_')
+	try:
+		dbPath = os.path.join(dirPath, 'persistentCache.db')
+		makeHolders(dirPath, args.holders, args.keys)
+
+		def run(persistentDbPath):
+			command = [sys.executable, os.path.abspath(__file__), '--traverse', dirPath, '--holders', str(args.holders), '--keys', str(args.keys)]
+			if persistentDbPath:
+				command += ['--persistent-db', persistentDbPath]
+			return float(subprocess.check_output(command))
+
+		results = {'coldStart.noPersistentCache': run(None)}
+		run(dbPath) #永続キャッシュに書き込む。
+		results['coldStart.persistentCache'] = run(dbPath)
+		return results
+	finally:
+		shutil.rmtree(dirPath)
+
+
+#============================================================================
+#============================================================================
+def compareResults(results, baselineResults, threshold):
+	"""
+	baselineResultsよりthreshold以上の割合で遅くなった項目の(名前, 以前の秒数, 今回の秒数)のリストを返す。
+	"""
+	regressions = []
+	for name in sorted(results):
+		if name in baselineResults and baselineResults[name] > 0 and results[name] > baselineResults[name] * (1.0 + threshold):
+			regressions.append((name, baselineResults[name], results[name]))
+	return regressions
+
+
+#============================================================================
+#============================================================================
+def main(argv):
+	parser = argparse.ArgumentParser(description='PropertyHolder benchmark.')
+	parser.add_argument('--suites', default=','.join(SUITES), help='comma separated benchmarks to run, from ' + ', '.join(SUITES))
+	parser.add_argument('--depth', type=int, default=4, help='depth of the synthetic tree')
+	parser.add_argument('--fanout', type=int, default=6, help='number of children of each holder in the synthetic tree')
+	parser.add_argument('--keys', type=int, default=100, help='number of keys in a property file')
+	parser.add_argument('--value-size', type=int, default=16, help='bytes of a string value')
+	parser.add_argument('--writers', type=int, default=4, help='number of concurrent writer processes')
+	parser.add_argument('--writes', type=int, default=100, help='number of updateDict() calls per writer')
+	parser.add_argument('--hot-files', type=int, default=4, help='number of property files the writers share')
+	parser.add_argument('--holders', type=int, default=10000, help='number of holders read in the cold start benchmark')
+	parser.add_argument('--rounds', type=int, default=3, help='number of repetitions of tree traversals, the best one is reported')
+	parser.add_argument('--repeat', type=int, default=50, help='number of repetitions of small operations, the best one is reported')
+	parser.add_argument('--json', help='write the results to this JSON file')
+	parser.add_argument('--baseline', help='JSON file written by a previous run to compare against')
+	parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown ratio against the baseline')
+	parser.add_argument('--traverse', help=argparse.SUPPRESS)
+	parser.add_argument('--persistent-db', help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+
+	if args.traverse:
+		#benchColdStart()から呼ばれる子プロセス。
+		print(traverse(args.traverse, args.holders, args.keys, args.persistent_db))
+		return 0
+
+	benchmarks = {'tree': benchTree, 'write': benchWrite, 'codec': benchCodecs, 'lazy': benchLazyGet, 'coldStart': benchColdStart}
+	results = {}
+	for suite in args.suites.split(','):
+		results.update(benchmarks[suite](args))
+
+	for name in sorted(results):
+		print('%-40s %12.3f msec' % (name, results[name] * 1000))
+
+	if args.json:
+		config = dict((key, value) for key, value in vars(args).items() if not key in ('json', 'baseline', 'traverse', 'persistent_db'))
+		with open(args.json, 'w') as f:
+			json.dump({'config': config, 'results': results}, f, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baselineResults = json.load(f)['results']
+		regressions = compareResults(results, baselineResults, args.threshold)
+		for name, baselineSec, sec in regressions:
+			print('REGRESSION %-29s %12.3f -> %.3f msec' % (name, baselineSec * 1000, sec * 1000))
+		if regressions:
+			return 1
+
+	return 0
+
+
+#============================================================================
+#============================================================================
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import os, unittest, inspect, time, threading
-from hohehohe2.utils.fileLock import FileLock
+import os, sys, shutil, tempfile, unittest, inspect, time, socket, threading, subprocess
+from hohehohe2.utils import fileLock
+from hohehohe2.utils.fileLock import FileLock, FlockFileLock, FileLockSet
 from hohehohe2.utils.myException import MyException
 
 
@@ -27,10 +28,12 @@ class TestFileLock(unittest.TestCase):
 			return f.read()
 
 	def __deleteFile(self):
-		try:
-			os.remove(self.__getFilePath())
-		except:
-			pass
+		gateFilePath = os.path.join(os.path.dirname(self.__getFilePath()), '.flockgate_' + os.path.basename(self.__getFilePath()))
+		for filePath in (self.__getFilePath(), FlockFileLock.getLockFilePath(self.__getFilePath()), gateFilePath):
+			try:
+				os.remove(filePath)
+			except:
+				pass
 
 	def __writeLockInThread(self, sleepFirst, sleepAfterWrite):
 		time.sleep(sleepFirst)
@@ -49,6 +52,20 @@ class TestFileLock(unittest.TestCase):
 		with FileLock(self.__getFilePath()):
 			self.assertEqual(self.__readFile(), 'tako')
 
+	def testLockHandoff(self):
+		releasedTimes = []
+		def holdLock():
+			with FileLock(self.__getFilePath()):
+				time.sleep(0.1)
+			releasedTimes.append(time.time())
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.03)
+		with FileLock(self.__getFilePath()):
+			acquiredTime = time.time()
+		th.join()
+		self.assertTrue(acquiredTime - releasedTimes[0] < 0.1) #Not a fixed 0.5 sec poll.
+
 	def testLockWaitTimeLimitFail(self):
 		try:
 			FileLock._SLEEP_SEC = 0
@@ -63,6 +80,264 @@ class TestFileLock(unittest.TestCase):
 		except:
 			del FileLock._SLEEP_SEC
 
+	def testFlockLock(self):
+		with FlockFileLock(self.__getFilePath()):
+			self.assertTrue(FlockFileLock.isLocked(self.__getFilePath()))
+			self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+		self.assertFalse(FlockFileLock.isLocked(self.__getFilePath()))
+		self.assertEqual([fileName for fileName in os.listdir(os.path.dirname(self.__getFilePath())) if fileName.startswith('.flockgate_')], []) #No gate without shared locks.
+
+	def testFlockTimeLimitFail(self):
+		def holdLock():
+			with FlockFileLock(self.__getFilePath()):
+				self.__writeFile('tako')
+				time.sleep(0.3)
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.05)
+		def failMethod():
+			with FlockFileLock(self.__getFilePath(), 0.05):
+				pass
+		startTime = time.time()
+		self.assertRaises(MyException, failMethod)
+		self.assertTrue(time.time() - startTime < 0.25)
+
+		#Waits without polling.
+		with FlockFileLock(self.__getFilePath()):
+			self.assertEqual(self.__readFile(), 'tako')
+		th.join()
+
+	def testFlockReleasedOnProcessDeath(self):
+		#The child process dies while holding the lock.
+		code = 'import os; from hohehohe2.utils.fileLock import FlockFileLock\nwith FlockFileLock(%s):\n\tos._exit(0)' % repr(self.__getFilePath())
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+		subprocess.check_call([sys.executable, '-c', code], env = env)
+		with FlockFileLock(self.__getFilePath(), 0): #No wait.
+			pass
+
+	def __checkSharedLock(self, lockClass):
+		with lockClass(self.__getFilePath(), shared=True):
+			with lockClass(self.__getFilePath(), shared=True): #Readers don't block each other.
+				def failMethod():
+					with lockClass(self.__getFilePath(), 0.05):
+						pass
+				self.assertRaises(MyException, failMethod)
+		with lockClass(self.__getFilePath(), 0):
+			pass
+
+	def __checkWriterPriority(self, lockClass):
+		events = []
+		def lockInThread(sleepFirst, shared, name):
+			time.sleep(sleepFirst)
+			with lockClass(self.__getFilePath(), shared=shared, sharedLocking=True):
+				events.append(name)
+				time.sleep(0.1)
+		threads = [threading.Thread(target = lockInThread, args = args) for args in ((0, True, 'reader'), (0.03, False, 'writer'), (0.06, True, 'lateReader'))]
+		for th in threads:
+			th.start()
+		for th in threads:
+			th.join()
+		self.assertEqual(events, ['reader', 'writer', 'lateReader'])
+
+	def testSharedLock(self):
+		self.__checkSharedLock(FileLock)
+		self.assertFalse(os.path.exists(FileLock.getReadLockDirPath(self.__getFilePath())))
+
+	def testSharedLockWriterPriority(self):
+		self.__checkWriterPriority(FileLock)
+
+	def testFlockSharedLock(self):
+		self.__checkSharedLock(FlockFileLock)
+
+	def testFlockSharedLockWriterPriority(self):
+		self.__checkWriterPriority(FlockFileLock)
+
+	def testStaleLockOfDeadProcess(self):
+		#The child process dies while holding the lock.
+		code = 'import os; from hohehohe2.utils.fileLock import FileLock\nwith FileLock(%s):\n\tos._exit(0)' % repr(self.__getFilePath())
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+		subprocess.check_call([sys.executable, '-c', code], env = env)
+		self.assertTrue(FileLock.isLocked(self.__getFilePath()))
+		with FileLock(self.__getFilePath(), 0): #Broken without waiting.
+			self.assertEqual(FileLock.getOwner(self.__getFilePath())['pid'], os.getpid())
+		self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+
+	def testLeaseExpiry(self):
+		def holdLock():
+			with FileLock(self.__getFilePath(), leaseSec = 0.1):
+				time.sleep(0.4)
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.05)
+		startTime = time.time()
+		with FileLock(self.__getFilePath()):
+			self.assertTrue(time.time() - startTime < 0.3)
+			th.join() #The expired owner doesn't delete this lock.
+			self.assertTrue(FileLock.isLocked(self.__getFilePath()))
+		self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+
+	def testLeaseMeasuredLocally(self):
+		#Held by a host whose clock is an hour behind.
+		lockFilePath = FileLock.getLockFilePath(self.__getFilePath())
+		os.mkdir(lockFilePath)
+		with open(os.path.join(lockFilePath, 'owner'), 'w') as f:
+			f.write('{"host": "otherHost", "pid": 1, "startTime": %f, "leaseSec": 0.3, "renewals": 0, "token": "other"}' % (time.time() - 3600))
+		def failMethod():
+			with FileLock(self.__getFilePath(), 0.1):
+				pass
+		self.assertRaises(MyException, failMethod)
+		startTime = time.time()
+		with FileLock(self.__getFilePath(), 2.0):
+			self.assertTrue(time.time() - startTime < 1.0)
+		self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+
+	def testReadLockLease(self):
+		#A reader on another host crashed while holding a shared lock with a lease.
+		readLockDirPath = FileLock.getReadLockDirPath(self.__getFilePath())
+		os.mkdir(readLockDirPath)
+		with open(os.path.join(readLockDirPath, 'otherHost_1_None_1_00000000'), 'w') as f:
+			f.write('{"host": "otherHost", "pid": 1, "leaseSec": 0.3, "renewals": 0, "token": "other"}')
+		def failMethod():
+			with FileLock(self.__getFilePath(), 0.1):
+				pass
+		self.assertRaises(MyException, failMethod)
+		with FileLock(self.__getFilePath(), 2.0):
+			self.assertFalse(os.path.exists(readLockDirPath))
+
+		#The heartbeat keeps the lease of a live reader.
+		def holdLock():
+			with FileLock(self.__getFilePath(), shared = True, leaseSec = 0.1, heartbeat = True):
+				time.sleep(0.4)
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.05)
+		def failMethod():
+			with FileLock(self.__getFilePath(), 0.25):
+				pass
+		self.assertRaises(MyException, failMethod)
+		th.join()
+		self.assertFalse(os.path.exists(readLockDirPath))
+
+	def testStaleLockReacquired(self):
+		#The stale owner is read, then the lock is released and acquired again before it is broken.
+		with FileLock(self.__getFilePath(), leaseSec = 60):
+			lockFilePath = FileLock.getLockFilePath(self.__getFilePath())
+			staleOwner = dict(FileLock.getOwner(self.__getFilePath()), token = 'stale', processStartTime = 'dead')
+			originalReadLockOwner = fileLock._readLockOwner
+			fileLock._readLockOwner = lambda path: staleOwner
+			try:
+				self.assertFalse(fileLock._breakStaleLock(lockFilePath))
+			finally:
+				fileLock._readLockOwner = originalReadLockOwner
+			self.assertNotEqual(FileLock.getOwner(self.__getFilePath())['token'], 'stale')
+			self.assertEqual(os.listdir(lockFilePath), ['owner'])
+		self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+
+	def testLeaseHeartbeat(self):
+		def holdLock():
+			with FileLock(self.__getFilePath(), leaseSec = 0.1, heartbeat = True):
+				time.sleep(0.4)
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.05)
+		owner = FileLock.getOwner(self.__getFilePath())
+		self.assertEqual((owner['host'], owner['pid']), (socket.gethostname(), os.getpid()))
+		def failMethod():
+			with FileLock(self.__getFilePath(), 0.25):
+				pass
+		self.assertRaises(MyException, failMethod)
+		th.join()
+		self.assertFalse(FileLock.isLocked(self.__getFilePath()))
+
+	def __getLockSetFilePaths(self):
+		#Two files in this directory and one in another directory.
+		otherDirPath = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, otherDirPath)
+		dirPath = os.path.dirname(self.__getFilePath())
+		return [os.path.join(dirPath, 'fileLockTestFile2.txt'), os.path.join(otherDirPath, 'fileLockTestFile.txt'), self.__getFilePath()]
+
+	def testLockSet(self):
+		filePaths = self.__getLockSetFilePaths()
+		lockSet = FileLockSet(filePaths + [filePaths[0]])
+		self.assertEqual(lockSet.getPaths(), sorted(filePaths))
+		with lockSet:
+			for filePath in filePaths:
+				self.assertTrue(FileLock.isLocked(filePath))
+		for filePath in filePaths:
+			self.assertFalse(FileLock.isLocked(filePath))
+
+	def testLockSetException(self):
+		filePaths = self.__getLockSetFilePaths()
+		def failMethod():
+			with FileLockSet(filePaths):
+				raise MyException('Error inside the lock set.')
+		self.assertRaises(MyException, failMethod)
+		for filePath in filePaths:
+			self.assertFalse(FileLock.isLocked(filePath))
+
+	def testLockSetRetry(self):
+		filePaths = self.__getLockSetFilePaths()
+		lockedWhileWaiting = []
+		def holdLock():
+			with FileLock(filePaths[2]):
+				time.sleep(0.2)
+				#The lock set doesn't hold other locks while waiting.
+				with FileLock(filePaths[0], 0):
+					lockedWhileWaiting.append(True)
+		th = threading.Thread(target = holdLock)
+		th.start()
+		time.sleep(0.05)
+		with FileLockSet(filePaths, 1.0):
+			th.join()
+			self.assertEqual(lockedWhileWaiting, [True])
+
+	def testLockSetTimeLimitFail(self):
+		filePaths = self.__getLockSetFilePaths()
+		def failMethod():
+			with FileLockSet(filePaths, 0.2):
+				pass
+		with FileLock(filePaths[1]):
+			startTime = time.time()
+			self.assertRaises(MyException, failMethod)
+			self.assertTrue(time.time() - startTime < 0.5) #One time limit for all locks.
+			self.assertFalse(FileLock.isLocked(filePaths[0]))
+			self.assertFalse(FileLock.isLocked(filePaths[2]))
+
+	def testLockSetNoDeadlock(self):
+		filePaths = self.__getLockSetFilePaths()
+		counts = []
+		def lockInThread(paths):
+			for i in range(20):
+				with FileLockSet(paths, 2.0):
+					counts.append(i)
+		def lockInReverseOrder():
+			#Nested locks in the reverse order must not deadlock with the lock sets.
+			for i in range(20):
+				with FileLock(filePaths[2], 2.0):
+					with FileLock(filePaths[0], 2.0):
+						counts.append(i)
+		threads = [threading.Thread(target = lockInThread, args = (paths,)) for paths in (filePaths, filePaths[::-1], filePaths[1:])]
+		threads.append(threading.Thread(target = lockInReverseOrder))
+		startTime = time.time()
+		for th in threads:
+			th.start()
+		for th in threads:
+			th.join()
+		self.assertEqual(len(counts), 80)
+		self.assertTrue(time.time() - startTime < 2.0)
+
+	def testFlockLockSet(self):
+		filePaths = self.__getLockSetFilePaths()
+		with FileLockSet(filePaths, lockClass = FlockFileLock):
+			for filePath in filePaths:
+				self.assertTrue(FlockFileLock.isLocked(filePath))
+		for filePath in filePaths:
+			self.assertFalse(FlockFileLock.isLocked(filePath))
+			gateFilePath = os.path.join(os.path.dirname(filePath), '.flockgate_' + os.path.basename(filePath))
+			for lockFilePath in (FlockFileLock.getLockFilePath(filePath), gateFilePath):
+				if os.path.exists(lockFilePath):
+					os.remove(lockFilePath)
+
 
 #============================================================================
 #============================================================================
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, unittest, inspect
-from hohehohe2.utils.propertyHolder import PropertyHolder
-from hohehohe2.utils.fileLock import FileLock
+import os, sys, unittest, inspect, datetime
+from hohehohe2.utils.propertyHolder import PropertyHolder, FilePropertyStorage, JournaledFilePropertyStorage, MarshalPropertyCodec, JournalPropertyCodec, PropertyVersionConflictError
+from hohehohe2.utils.fileLock import FileLock, FlockFileLock
 from hohehohe2.utils.myException import MyException
 
 
@@ -29,6 +29,89 @@ class MyPropertyHolder(PropertyHolder):
 			os.remove(self._getPropertyFilePath())
 
 
+#============================================================================
+#============================================================================
+class MarshalPropertyHolder(MyPropertyHolder):
+	__storage = FilePropertyStorage(codec=MarshalPropertyCodec())
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+class JournaledPropertyHolder(MyPropertyHolder):
+	storage = JournaledFilePropertyStorage(compactionRatio=2.0)
+
+	def _getPropertyStorage(self):
+		return self.storage
+
+
+#============================================================================
+#============================================================================
+class LazyPropertyHolder(MyPropertyHolder):
+	__storage = FilePropertyStorage(lazyThresholdBytes=0)
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+class FlockPropertyHolder(MyPropertyHolder):
+	__storage = FilePropertyStorage(lockClass=FlockFileLock)
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+class SharedReadPropertyHolder(MyPropertyHolder):
+	__storage = FilePropertyStorage(atomicWrite=False, sharedReadLock=True)
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+class FailingFilePropertyStorage(FilePropertyStorage):
+
+	def applyChanges(self, path, updates, removals, cleared, readTimeLimit, currentDict=None, expectedVersion=None):
+		raise IOError('Disk full')
+
+
+#============================================================================
+#============================================================================
+class FailingPropertyHolder(MyPropertyHolder):
+	__storage = FailingFilePropertyStorage()
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
+#============================================================================
+#============================================================================
+class SlowFilePropertyStorage(FilePropertyStorage):
+	numReads = 0
+
+	def read(self, path, readTimeLimit):
+		SlowFilePropertyStorage.numReads += 1
+		import time
+		time.sleep(0.2)
+		return super(SlowFilePropertyStorage, self).read(path, readTimeLimit)
+
+
+#============================================================================
+#============================================================================
+class SlowPropertyHolder(MyPropertyHolder):
+	__storage = SlowFilePropertyStorage()
+
+	def _getPropertyStorage(self):
+		return self.__storage
+
+
 #============================================================================
 #============================================================================
 class TestPropertyHolder(unittest.TestCase):
@@ -170,6 +253,546 @@ class TestPropertyHolder(unittest.TestCase):
 		self.assertTrue(self.p._getPropertyFilePath() in self.p._PropertyHolder__cache._PropertyCache__cache)
 		self.assertEqual(self.p.getDict(), {})
 
+	def testGetDictMany(self):
+		self.p.update('someKey', 1)
+		self.c.update('someOtherKey', 2)
+		self.p.clearAllCaches()
+		another = MyPropertyHolder('another', self.p)
+		self.assertEqual(PropertyHolder.getDictMany([self.c, another, self.p], poolSize=4), [{'someKey': 1, 'someOtherKey': 2}, {'someKey': 1}, {'someKey': 1}])
+		for holder in (self.p, self.c, another):
+			self.assertTrue(holder._getPropertyFilePath() in self.p._PropertyHolder__cache._PropertyCache__cache)
+
+	def testMergedCache(self):
+		self.p.update('someKey', 1)
+		self.c.update('someOtherKey', 2)
+		mergedCache = self.c._PropertyHolder__cache._PropertyCache__mergedCache
+		filePaths = (self.p._getPropertyFilePath(), self.c._getPropertyFilePath())
+		self.assertEqual(self.c.get('someKey'), 1)
+		self.assertTrue(filePaths in mergedCache)
+		self.c.getDict()['someKey'] = 3 #getDict() returns a copy.
+		self.assertEqual(self.c.get('someKey'), 1)
+		self.p.update('someKey', 2) #Parent update invalidates the merged cache of the child.
+		self.assertFalse(filePaths in mergedCache)
+		self.assertEqual(self.c.get('someKey'), 2)
+		self.assertEqual(self.p.getDict(), {'someKey': 2})
+
+	def testMergedCacheWithoutChildFile(self):
+		self.p.update('someKey', 1)
+		self.assertEqual(self.c.get('someKey'), 1)
+		mergedCache = self.c._PropertyHolder__cache._PropertyCache__mergedCache
+		filePaths = (self.p._getPropertyFilePath(), self.c._getPropertyFilePath())
+		self.assertTrue(filePaths in mergedCache)
+		self.__changeCacheValidtyUnCheckDuration(0)
+		import time
+		time.sleep(0.01)
+		self.assertEqual(self.c.get('someKey'), 1)
+		self.assertTrue(filePaths in mergedCache) #Still no child file, the merged cache is kept.
+
+	def testCacheWatcher(self):
+		from hohehohe2.utils import inotify
+		if not inotify.isAvailable():
+			return
+		self.assertTrue(self.p.enableCacheWatcher())
+		try:
+			self.p.update('someKey', 1)
+			self.assertEqual(self.c.get('someKey'), 1)
+			import time
+			time.sleep(0.03) #Make sure the file time stamp changes.
+			self.p.rawWrite('{"someKey": 2}') #Written by another process.
+			for i in range(100):
+				if self.c.get('someKey') == 2:
+					break
+				time.sleep(0.01)
+			self.assertEqual(self.c.get('someKey'), 2)
+		finally:
+			self.p.disableCacheWatcher()
+
+	def testCacheLimits(self):
+		another = MyPropertyHolder('another', None)
+		try:
+			self.p.setCacheLimits(maxEntries=2, maxNegativeEntries=1)
+			self.p.update('someKey', 1)
+			self.p.get('someKey') #Referenced twice, protected from a scan.
+			self.c.update('someKey', 2)
+			another.update('someKey', 3)
+			stats = self.p.getCacheStats()
+			self.assertEqual(stats['entries'], 2)
+			self.assertEqual(stats['evictions'], 1)
+			cache = self.p._PropertyHolder__cache._PropertyCache__cache
+			self.assertTrue(self.p._getPropertyFilePath() in cache)
+			self.assertFalse(self.c._getPropertyFilePath() in cache)
+
+			MyPropertyHolder('missing1', None).get('someKey')
+			MyPropertyHolder('missing2', None).get('someKey')
+			stats = self.p.getCacheStats()
+			self.assertEqual(stats['negativeEntries'], 1)
+			self.assertEqual(stats['negativeEvictions'], 1)
+			self.assertEqual(self.c.get('someKey'), 2)
+		finally:
+			self.p.setCacheLimits()
+			another.clear()
+
+	def testTransaction(self):
+		self.p.update('removedKey', 0)
+		with self.p.transaction():
+			self.assertEqual(self.p.update('someKey', 1), {'removedKey': 0, 'someKey': 1})
+			self.p.updateDict({'someKey': 2, 'someOtherKey': 3})
+			self.assertEqual(self.p.remove('removedKey'), {'someKey': 2, 'someOtherKey': 3})
+			self.c.update('childKey', 4)
+			self.assertEqual(self.p.get('someKey'), None) #Not written yet.
+			self.assertFalse(os.path.exists(self.c._getPropertyFilePath()))
+		self.assertEqual(self.c.getDict(), {'someKey': 2, 'someOtherKey': 3, 'childKey': 4})
+		self.p.clearAllCaches()
+		self.assertEqual(self.c.getDict(), {'someKey': 2, 'someOtherKey': 3, 'childKey': 4})
+
+	def testTransactionLockOnce(self):
+		import hohehohe2.utils.propertyHolder as propertyHolder
+		lockedFilePaths = []
+		class CountingFileLock(FileLock):
+			def __enter__(self):
+				lockedFilePaths.append(self._filePath)
+				return super(CountingFileLock, self).__enter__()
+		propertyHolder.FileLock = CountingFileLock
+		try:
+			with self.p.transaction():
+				for i in range(20):
+					self.p.update('key%d' % i, i)
+				for i in range(5):
+					self.p.remove('key%d' % i)
+				self.c.clear()
+				self.c.update('childKey', 1)
+		finally:
+			propertyHolder.FileLock = FileLock
+		self.assertEqual(sorted(lockedFilePaths), sorted([self.p._getPropertyFilePath(), self.c._getPropertyFilePath()]))
+		self.assertEqual(len(self.p.getDictWithoutInheritance()), 15)
+
+	def testTransactionLockTimeLimit(self):
+		def failMethod():
+			with self.p.transaction(lockTimeLimitSec = 0.1):
+				self.p.update('someKey', 1)
+				self.c.update('childKey', 1)
+		with FileLock(self.c._getPropertyFilePath()):
+			self.assertRaises(MyException, failMethod)
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.get('someKey'), None) #Nothing is written.
+		self.assertFalse(FileLock.isLocked(self.p._getPropertyFilePath()))
+
+	def testTransactionAbort(self):
+		def failMethod():
+			with self.p.transaction():
+				self.p.update('someKey', 1)
+				raise MyException('abort')
+		self.assertRaises(MyException, failMethod)
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.get('someKey'), None)
+
+	def testAtomicWrite(self):
+		self.p.update('someKey', 1)
+		oldInode = os.stat(self.p._getPropertyFilePath()).st_ino
+		self.p.update('someKey', 2)
+		self.assertNotEqual(os.stat(self.p._getPropertyFilePath()).st_ino, oldInode) #Replaced, not rewritten in place.
+		self.assertEqual([fileName for fileName in os.listdir(os.path.dirname(self.p._getPropertyFilePath())) if fileName.startswith('.tmp_')], [])
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.get('someKey'), 2)
+
+	def testCodec(self):
+		m = MarshalPropertyHolder('parent', None) #Same file as self.p.
+		m.updateDict({'someKey': 1, 'someOtherKey': (u'a', {'b': [None, True, 1.5]})})
+		with open(self.p._getPropertyFilePath(), 'rb') as f:
+			self.assertTrue(f.read().startswith(MarshalPropertyCodec.header))
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.getDict(), {'someKey': 1, 'someOtherKey': [u'a', {'b': [None, True, 1.5]}]}) #Format detected from the header.
+		self.p.update('someKey', 2) #Written back as JSON.
+		self.p.clearAllCaches()
+		self.assertEqual(m.get('someKey'), 2)
+		self.assertRaises(MyException, MarshalPropertyCodec().dumps, {'someKey': object()})
+		self.assertRaises(MyException, MarshalPropertyCodec().dumps, {'someKey': {1: 2}})
+
+	def testJournal(self):
+		j = JournaledPropertyHolder('parent', None) #Same file as self.p.
+		j.updateDict({'someKey': 'x' * 20, 'someOtherKey': 1})
+		filePath = j._getPropertyFilePath()
+		oldInode = os.stat(filePath).st_ino
+		j.update('someOtherKey', 2)
+		j.remove('someKey')
+		self.assertEqual(os.stat(filePath).st_ino, oldInode) #Appended, not replaced.
+		with open(filePath, 'rb') as f:
+			self.assertEqual(f.read().count('\n'), 4)
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.getDict(), {'someOtherKey': 2}) #Readable without the journaled storage.
+
+		#Records appended by another process are read incrementally, an incomplete record is ignored.
+		another = JournaledFilePropertyStorage()
+		another.applyChanges(filePath, {'someKey': 3}, (), False, None)
+		with open(filePath, 'ab') as f:
+			f.write('[{"someKey": 4')
+		self.p.clearAllCaches()
+		self.assertEqual(j.getDict(), {'someKey': 3, 'someOtherKey': 2})
+
+		#The incomplete record makes the next write compact the journal.
+		j.update('someKey', 5)
+		self.assertNotEqual(os.stat(filePath).st_ino, oldInode)
+		with open(filePath, 'rb') as f:
+			self.assertEqual(f.read().count('\n'), 2)
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.getDict(), {'someKey': 5, 'someOtherKey': 2})
+
+		#Compacted once the records outgrow the base.
+		oldInode = os.stat(filePath).st_ino
+		for i in range(10):
+			j.update('someOtherKey', i)
+		self.assertNotEqual(os.stat(filePath).st_ino, oldInode)
+		self.p.clearAllCaches()
+		self.assertEqual(j.getDict(), {'someKey': 5, 'someOtherKey': 9})
+		with open(filePath, 'rb') as f:
+			self.assertEqual(JournalPropertyCodec().loads(f.read()), {'someKey': 5, 'someOtherKey': 9})
+
+	def testJournalInodeReuse(self):
+		j = JournaledPropertyHolder('parent', None)
+		j.updateDict({'v': 'aaaa'})
+		j.update('w', 1)
+		reader = JournaledFilePropertyStorage()
+		filePath = j._getPropertyFilePath()
+		self.assertEqual(reader.read(filePath, None)[0], {'v': 'aaaa', 'w': 1})
+
+		#Compacted by another writer into a file with the same inode number and a longer content.
+		oldInode = os.stat(filePath).st_ino
+		with open(filePath, 'r+b') as f:
+			f.write(JournalPropertyCodec().dumps({'v': 'b001', 'w': 1}) + JournalPropertyCodec().dumpRecord({'x': 2}, []))
+		self.assertEqual(os.stat(filePath).st_ino, oldInode)
+		self.assertEqual(reader.read(filePath, None)[0], {'v': 'b001', 'w': 1, 'x': 2})
+
+		#Files of the old format without a generation are read and converted on the next update.
+		with open(filePath, 'wb') as f:
+			f.write('#HPJ1\n{"v": "c"}\n[{"w": 3}, []]\n')
+		self.assertEqual(reader.read(filePath, None)[0], {'v': 'c', 'w': 3})
+		reader.applyChanges(filePath, {'x': 4}, (), False, None)
+		with open(filePath, 'rb') as f:
+			self.assertTrue(f.read().startswith('#HPJ2 '))
+		self.assertEqual(JournaledFilePropertyStorage().read(filePath, None)[0], {'v': 'c', 'w': 3, 'x': 4})
+
+	def testPersistentCache(self):
+		from hohehohe2.utils.persistentPropertyCache import PersistentPropertyCache
+		dbPath = os.path.join(os.path.dirname(self.p._getPropertyFilePath()), 'persistentCache.db')
+		self.p.enablePersistentCache(dbPath)
+		try:
+			self.p.update('someKey', 1)
+			self.p.clearAllCaches()
+			self.assertEqual(self.p.get('someKey'), 1)
+
+			#A fresh process finds the entry by stamp and does not parse the file.
+			filePath = self.p._getPropertyFilePath()
+			stamp, size = self.p._getPropertyStorage().stat(filePath)
+			PersistentPropertyCache(dbPath).set(filePath, stamp, {'someKey': 'cached'})
+			self.p.clearAllCaches()
+			self.assertEqual(self.p.get('someKey'), 'cached')
+
+			#Stale once the file changes.
+			self.p.update('someKey', 2)
+			self.p.clearAllCaches()
+			self.assertEqual(self.p.get('someKey'), 2)
+		finally:
+			self.p.disablePersistentCache()
+			for suffix in ('', '-wal', '-shm'):
+				if os.path.exists(dbPath + suffix):
+					os.remove(dbPath + suffix)
+
+	def testPersistentCacheOfOtherUsers(self):
+		from hohehohe2.utils.persistentPropertyCache import PersistentPropertyCache, getDefaultDbPath
+		dirPath = os.path.join(os.path.dirname(self.p._getPropertyFilePath()), 'persistentCacheDir')
+		oldCacheHome = os.environ.get('XDG_CACHE_HOME')
+		os.environ['XDG_CACHE_HOME'] = dirPath
+		try:
+			#The default database is in a directory only the user can access.
+			cache = PersistentPropertyCache()
+			cache.set('somePath', (1, 2, 3), {'someKey': 1})
+			self.assertEqual(cache.get('somePath', (1, 2, 3)), {'someKey': 1})
+			self.assertEqual(os.stat(os.path.dirname(getDefaultDbPath())).st_mode & 0o777, 0o700)
+			self.assertEqual(os.stat(getDefaultDbPath()).st_mode & 0o077, 0)
+
+			#A database other users can write to is not read.
+			os.chmod(getDefaultDbPath(), 0o666)
+			self.assertEqual(PersistentPropertyCache().get('somePath', (1, 2, 3)), None)
+		finally:
+			if oldCacheHome is None:
+				del os.environ['XDG_CACHE_HOME']
+			else:
+				os.environ['XDG_CACHE_HOME'] = oldCacheHome
+			import shutil
+			shutil.rmtree(dirPath)
+
+	def testAsync(self):
+		try:
+			import asyncio
+		except ImportError:
+			try:
+				import trollius as asyncio
+			except ImportError:
+				self.skipTest('asyncio is not available.')
+
+		loop = asyncio.new_event_loop()
+		try:
+			self.p.update('someKey', 1)
+			loop.run_until_complete(self.c.aupdateDict({'someOtherKey': 2}, loop=loop))
+			self.p.clearAllCaches()
+
+			#Concurrent loads of the same holder share one load but get their own dicts.
+			futures = [self.c.agetDict(loop=loop), self.c.agetDict(loop=loop), self.c.aget('someKey', loop=loop)]
+			first, second, value = [loop.run_until_complete(future) for future in futures]
+			self.assertEqual(first, {'someKey': 1, 'someOtherKey': 2})
+			self.assertEqual(second, first)
+			self.assertFalse(second is first)
+			self.assertEqual(value, 1)
+			self.assertEqual(self.p.getCacheStats()['misses'], 2) #Parent and child, read once each.
+		finally:
+			loop.close()
+
+	def testLazyRead(self):
+		self.p.updateDict({'someKey': {'a': ['}', 1]}, 'someOtherKey': 'x"y'})
+		self.c.updateDict({'someKey': 2})
+		lp = LazyPropertyHolder('parent', None) #Same files as self.p and self.c.
+		lc = LazyPropertyHolder('child', lp)
+		self.p.clearAllCaches()
+		self.assertEqual(lc.get('someOtherKey'), 'x"y')
+		self.assertEqual(lc.get('someKey'), 2)
+		self.assertEqual(lp.get('someKey'), {'a': ['}', 1]})
+		self.assertEqual(lc.get('noKey', 3), 3)
+		self.assertEqual(type(lp.getDictWithoutInheritance()), dict)
+		self.assertEqual(lc.getDict(), {'someKey': 2, 'someOtherKey': 'x"y'})
+		self.assertEqual(lp.update('someKey', 4), {'someKey': 4, 'someOtherKey': 'x"y'})
+		self.assertEqual(lc.getWithoutInheritance('someKey'), 2)
+
+	def testLazyReadDecodedOnce(self):
+		self.p.updateDict({'someKey': 1, 'someOtherKey': [2]})
+		lp = LazyPropertyHolder('parent', None) #Same file as self.p.
+		self.p.clearAllCaches()
+		self.p._PropertyHolder__cache.resetStats()
+		self.assertEqual(lp.get('someKey'), 1)
+		first = lp.getDict()
+		first['someKey'] = 3
+		self.assertEqual(lp.getDict(), {'someKey': 1, 'someOtherKey': [2]})
+		self.assertEqual(lp.getDictWithoutInheritance(), {'someKey': 1, 'someOtherKey': [2]})
+		self.assertEqual(self.p.getCacheStats()['mergedMisses'], 1) #Decoded by the first getDict() only.
+
+	def testLazyReadRewrittenInPlace(self):
+		self.p.updateDict({'a': 1, 'b': 'x' * 10000})
+		lp = LazyPropertyHolder('parent', None) #Same file as self.p.
+		self.p.clearAllCaches()
+		self.assertEqual(lp.get('a'), 1)
+		self.p.rawWrite('{}') #Truncated in place by a legacy writer.
+		self.assertEqual(lp.get('b'), 'x' * 10000) #The cached dict doesn't refer to the file.
+
+	def testMetrics(self):
+		self.p.update('someKey', 1)
+		self.p.clearAllCaches()
+		self.p.enableMetrics(perPath=True)
+		self.p.resetMetrics()
+		try:
+			self.p.get('someKey')
+			self.p.get('someKey')
+			self.p.update('someKey', 2)
+		finally:
+			self.p.disableMetrics()
+		self.p.get('someKey') #Not recorded.
+
+		metrics = self.p.getMetrics(perPath=True)
+		total = metrics['total']
+		self.assertEqual((total['cacheMisses'], total['cacheHits'], total['reads'], total['lockAcquisitions'], total['readRetries']), (1, 1, 2, 1, 0)) #update() reads the file again under the lock.
+		self.assertTrue(total['bytesRead'] > 0)
+		self.assertEqual(metrics['perPath'][self.p._getPropertyFilePath()]['reads'], 2)
+		self.p.resetMetrics()
+		self.assertEqual(self.p.getMetrics()['total']['reads'], 0)
+
+	def testSingleFlightLoad(self):
+		self.p.update('someKey', 1)
+		self.p.clearAllCaches()
+		coalescedLoads = self.p.getCacheStats()['coalescedLoads']
+		sp = SlowPropertyHolder('parent', None) #Same file as self.p.
+		SlowFilePropertyStorage.numReads = 0
+
+		import threading
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(sp.getDict())) for i in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(results, [{'someKey': 1}] * 8)
+		self.assertEqual(SlowFilePropertyStorage.numReads, 1)
+		self.assertEqual(self.p.getCacheStats()['coalescedLoads'] - coalescedLoads, 7)
+
+	def testCacheStatsOfEndedThreads(self):
+		self.p.update('someKey', 1)
+		another = MyPropertyHolder('another', self.p)
+		cache = self.p._PropertyHolder__cache
+		cache.resetStats()
+		for i in range(20):
+			self.p.clearAllCaches()
+			PropertyHolder.getDictMany([self.c, another], poolSize=2) #A new thread pool each time.
+		self.assertTrue(len(cache._PropertyCache__threadCounters) < 10) #Counters of the ended threads are folded.
+		self.assertTrue(self.p.getCacheStats()['misses'] >= 40)
+		cache.resetStats()
+		self.assertEqual(self.p.getCacheStats()['misses'], 0)
+
+	def testRefreshDirectory(self):
+		holders = [MyPropertyHolder('bulk%d' % i, None) for i in range(10)]
+		try:
+			for i, holder in enumerate(holders):
+				holder.update('someKey', i)
+			self.p.clearAllCaches()
+			for holder in holders:
+				holder.get('someKey')
+
+			#Changed by another process.
+			holders[1].rawWrite('{"someKey": "changed"}')
+			holders[2].deleteFile()
+
+			self.p.enableMetrics()
+			self.p.resetMetrics()
+			try:
+				self.p.refreshCacheDirectory(os.path.dirname(holders[0]._getPropertyFilePath()))
+				self.assertEqual([holder.get('someKey') for holder in holders[:4]], [0, 'changed', None, 3])
+				self.assertEqual(self.p.getMetrics()['total']['reads'], 1)
+
+				#Stale entries are revalidated in bulk only when there are many of them in the directory.
+				propertyCache = self.p._PropertyHolder__cache
+				longAgo = datetime.timedelta(seconds=60)
+				def makeStale(holders):
+					for holder in holders:
+						filePath = os.path.abspath(os.path.normpath(holder._getPropertyFilePath()))
+						propDict, stamp, timeStampObtainedTime = propertyCache._PropertyCache__cache[filePath]
+						propertyCache._PropertyCache__cache[filePath] = (propDict, stamp, timeStampObtainedTime - longAgo)
+				scannedTimes = propertyCache._PropertyCache__directoryScannedTimes
+				for dirPath in scannedTimes:
+					scannedTimes[dirPath] -= longAgo #Scanned by refreshCacheDirectory() long ago.
+
+				makeStale(holders[4:5])
+				self.p.resetMetrics()
+				self.assertEqual(holders[4].get('someKey'), 4)
+				self.assertEqual(self.p.getMetrics()['total'].get('directoryScans', 0), 0)
+
+				makeStale(holders)
+				self.assertEqual(holders[5].get('someKey'), 5)
+				self.assertEqual(self.p.getMetrics()['total']['directoryScans'], 1)
+
+				#Not scanned again within the validity duration.
+				makeStale(holders)
+				self.assertEqual(holders[6].get('someKey'), 6)
+				self.assertEqual(self.p.getMetrics()['total']['directoryScans'], 1)
+			finally:
+				self.p.disableMetrics()
+		finally:
+			for holder in holders:
+				holder.clear()
+
+	def testView(self):
+		self.p.updateDict({'someKey': 1, 'someOtherKey': 2})
+		self.c.update('someKey', 3)
+		self.p.clearAllCaches()
+
+		view = self.c.getView()
+		self.assertEqual(view['someKey'], 3)
+		self.assertEqual(view.get('someOtherKey'), 2)
+		self.assertEqual(sorted(view), ['someKey', 'someOtherKey'])
+		self.assertEqual(len(view), 2)
+		self.assertFalse('noKey' in view)
+		with self.assertRaises(TypeError):
+			view['someKey'] = 4
+		self.assertEqual(dict(self.p.getViewWithoutInheritance()), {'someKey': 1, 'someOtherKey': 2})
+
+		#Modifying copies doesn't affect the cache.
+		propDict = view.copy()
+		propDict['someKey'] = 4
+		self.c.getDictWithoutInheritance()['someKey'] = 5
+		self.assertEqual(self.c.getView()['someKey'], 3)
+		self.assertEqual(self.c.get('someKey'), 3)
+
+	def testWriteErrorRaises(self):
+		self.assertRaises(TypeError, self.p.updateDict, {'someKey': object()}) #Not serializable.
+		self.assertFalse(self.p.isLocked())
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.getDict(), {})
+
+		f = FailingPropertyHolder('parent', None)
+		self.assertRaises(IOError, f.update, 'someKey', 1)
+		self.assertRaises(IOError, f.remove, 'someKey')
+		self.assertRaises(IOError, f.clear)
+		self.assertFalse(f.isLocked())
+
+	def testVersionedUpdate(self):
+		self.assertEqual(self.p.getVersion(), 0)
+		self.p.update('someKey', 1, expectedVersion=0)
+		version = self.p.getVersion()
+		self.p.updateDict({'someKey': 2}, expectedVersion=version)
+		self.assertRaises(PropertyVersionConflictError, self.p.update, 'someKey', 3, version)
+		self.assertEqual(self.p.get('someKey'), 2)
+
+		#Changed by another process. The file is read again under the lock.
+		self.p.rawWrite('{"someKey": 2, "someOtherKey": 4}')
+		self.assertRaises(PropertyVersionConflictError, self.p.update, 'someKey', 3, self.p.getVersion())
+		self.assertEqual(self.p.update('someKey', 3, self.p.getVersion()), {'someKey': 3, 'someOtherKey': 4}) #The conflict drops the stale cache.
+		self.assertEqual(self.p.update('someKey', 5), {'someKey': 5, 'someOtherKey': 4})
+
+		#All or nothing in a transaction.
+		def commitStaleVersion():
+			with self.p.transaction():
+				self.c.update('childKey', 1)
+				self.p.update('someKey', 6, expectedVersion=version)
+		self.assertRaises(PropertyVersionConflictError, commitStaleVersion)
+		self.assertFalse(os.path.exists(self.c._getPropertyFilePath()))
+		with self.p.transaction():
+			self.p.update('someKey', 6, expectedVersion=self.p.getVersion())
+		self.assertEqual(self.p.get('someKey'), 6)
+
+	def testFlockStorage(self):
+		fp = FlockPropertyHolder('parent', None)
+		self.addCleanup(self.__deleteFlockFiles, fp._getPropertyFilePath())
+		self.assertEqual(fp.update('someKey', 1), {'someKey': 1})
+		self.assertTrue(os.path.exists(FlockFileLock.getLockFilePath(fp._getPropertyFilePath())))
+		self.assertFalse(FlockFileLock.isLocked(fp._getPropertyFilePath()))
+		self.p.clearAllCaches()
+		self.assertEqual(self.c.get('someKey'), 1)
+
+	def __deleteFlockFiles(self, filePath):
+		gateFilePath = os.path.join(os.path.dirname(filePath), '.flockgate_' + os.path.basename(filePath))
+		for lockFilePath in (FlockFileLock.getLockFilePath(filePath), gateFilePath):
+			if os.path.exists(lockFilePath):
+				os.remove(lockFilePath)
+
+	def testSharedReadLock(self):
+		sp = SharedReadPropertyHolder('parent', None)
+		sp.update('someKey', 1)
+		self.p.clearAllCaches()
+
+		#Reading waits for the writer.
+		import threading, time
+		def writeInThread():
+			with FileLock(sp._getPropertyFilePath()):
+				time.sleep(0.1)
+				sp.rawWrite('{"someKey": 2}')
+		th = threading.Thread(target = writeInThread)
+		th.start()
+		time.sleep(0.03)
+		self.assertEqual(sp.get('someKey'), 2)
+		th.join()
+		self.assertFalse(os.path.exists(FileLock.getReadLockDirPath(sp._getPropertyFilePath())))
+
+	def testUpdateRewrittenWithSameStamp(self):
+		self.p.updateDict({'someKey': 1, 'someOtherKey': 2})
+		filePath = self.p._getPropertyFilePath()
+		os.utime(filePath, (1000000000, 1000000000)) #A file system with a coarse mtime.
+		self.p.clearAllCaches()
+		version = self.p.getVersion()
+
+		#Rewritten by another process with the same mtime, size and inode.
+		self.p.rawWrite(open(filePath).read().replace('1', '3'))
+		os.utime(filePath, (1000000000, 1000000000))
+		self.assertEqual(FilePropertyStorage().stat(os.path.abspath(filePath))[0], version)
+
+		self.assertRaises(PropertyVersionConflictError, self.p.update, 'someKey', 4, version)
+		self.assertEqual(self.p.update('someOtherKey', 5), {'someKey': 3, 'someOtherKey': 5})
+
 	def testUpdate(self):
 		self.p.update('someKey', 1)
 		propDict = {'someKey': 2, 'someOtherKey': 3}
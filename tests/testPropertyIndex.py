@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest, inspect, sqlite3
+from hohehohe2.utils.propertyHolder import PropertyHolder
+from hohehohe2.utils.propertyIndex import PropertyIndex
+
+
+#============================================================================
+#============================================================================
+def _getPropertiesDirPath():
+	thisDirPath = os.path.dirname(inspect.getabsfile(TestPropertyIndex))
+	return os.path.join(thisDirPath, 'properties')
+
+
+#============================================================================
+#============================================================================
+class IndexedPropertyHolder(PropertyHolder):
+	index = None
+
+	def __init__(self, name, parent):
+		super(IndexedPropertyHolder, self).__init__(parent)
+		self.name = name
+
+	def _getPropertyFilePath(self):
+		return os.path.join(_getPropertiesDirPath(), self.name)
+
+	def _getPropertyIndex(self):
+		return self.index
+
+
+#============================================================================
+#============================================================================
+class TestPropertyIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.dbPath = os.path.join(_getPropertiesDirPath(), 'propertyIndex.db')
+		self.__deleteDb()
+		IndexedPropertyHolder.index = PropertyIndex(self.dbPath)
+		self.p = IndexedPropertyHolder('parent', None)
+		self.c = IndexedPropertyHolder('child', self.p)
+		self.g = IndexedPropertyHolder('grandChild', self.c)
+		for holder in (self.p, self.c, self.g):
+			holder.clear()
+		self.p.clearAllCaches()
+
+	def tearDown(self):
+		IndexedPropertyHolder.index = None
+		for holder in (self.p, self.c, self.g):
+			holder.clear()
+		self.__deleteDb()
+
+	def __deleteDb(self):
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(self.dbPath + suffix):
+				os.remove(self.dbPath + suffix)
+
+	def __find(self, key, value, inherit=True):
+		return sorted(os.path.basename(filePath) for filePath in IndexedPropertyHolder.index.find(key, value, inherit))
+
+	def testFind(self):
+		self.p.updateDict({'status': 'approved', 'size': [1, 2]})
+		self.c.update('someKey', 1)
+		self.g.update('status', 'pending')
+		self.assertEqual(self.__find('status', 'approved'), ['child', 'parent'])
+		self.assertEqual(self.__find('status', 'approved', inherit=False), ['parent'])
+		self.assertEqual(self.__find('status', 'pending'), ['grandChild'])
+		self.assertEqual(self.__find('size', (1, 2)), ['child', 'grandChild', 'parent'])
+
+		self.c.update('status', 'rejected')
+		self.assertEqual(self.__find('status', 'approved'), ['parent'])
+		self.c.remove('status')
+		self.assertEqual(self.__find('status', 'approved'), ['child', 'parent'])
+		self.p.clear()
+		self.assertEqual(self.__find('status', 'approved'), [])
+
+	def testTransaction(self):
+		with PropertyHolder.transaction():
+			self.p.update('status', 'approved')
+			self.c.update('someKey', 1)
+		self.assertEqual(self.__find('status', 'approved'), ['child', 'grandChild', 'parent'])
+
+	def testIndexBusy(self):
+		IndexedPropertyHolder.index = PropertyIndex(self.dbPath, 0.05)
+		self.p.update('status', 'draft')
+		connection = sqlite3.connect(self.dbPath, isolation_level=None)
+		connection.execute('BEGIN IMMEDIATE') #Another process is writing the index.
+		try:
+			with PropertyHolder.transaction():
+				self.p.update('status', 'approved')
+				self.c.update('someKey', 1)
+		finally:
+			connection.execute('ROLLBACK')
+			connection.close()
+		#The property files are written even though the index is not updated.
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.get('status'), 'approved')
+		self.assertEqual(self.c.get('someKey'), 1)
+		self.assertEqual(self.__find('status', 'approved'), [])
+
+		IndexedPropertyHolder.index.rebuild([self.c])
+		self.assertEqual(self.__find('status', 'approved'), ['child', 'parent'])
+
+	def testRebuild(self):
+		index = IndexedPropertyHolder.index
+		IndexedPropertyHolder.index = None
+		self.p.update('status', 'approved')
+		self.g.update('someKey', 1)
+		IndexedPropertyHolder.index = index
+		self.assertEqual(self.__find('status', 'approved'), [])
+
+		index.rebuild([self.g])
+		self.assertEqual(self.__find('status', 'approved'), ['child', 'grandChild', 'parent'])
+		self.assertEqual(self.__find('someKey', 1), ['grandChild'])
+
+
+#============================================================================
+#============================================================================
+if __name__ == "__main__":
+	unittest.main()
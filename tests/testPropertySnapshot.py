@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest, inspect
+from hohehohe2.utils.propertyHolder import PropertyHolder
+from hohehohe2.utils.propertySnapshot import exportSnapshot, importSnapshot
+from hohehohe2.utils.myException import MyException
+
+
+#============================================================================
+#============================================================================
+def _getPropertiesDirPath():
+	thisDirPath = os.path.dirname(inspect.getabsfile(TestPropertySnapshot))
+	return os.path.join(thisDirPath, 'properties')
+
+
+#============================================================================
+#============================================================================
+class SnapshotPropertyHolder(PropertyHolder):
+
+	def __init__(self, name, parent):
+		super(SnapshotPropertyHolder, self).__init__(parent)
+		self.name = name
+
+	def _getPropertyFilePath(self):
+		return os.path.join(_getPropertiesDirPath(), self.name)
+
+
+#============================================================================
+#============================================================================
+class TestPropertySnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.snapshotPath = os.path.join(_getPropertiesDirPath(), 'snapshot.json')
+		self.p = SnapshotPropertyHolder('parent', None)
+		self.children = [SnapshotPropertyHolder('child%d' % i, self.p) for i in range(4)]
+		for holder in [self.p] + self.children:
+			holder.clear()
+		self.p.updateDict({'someKey': 1, 'status': u'approved'})
+		for i, holder in enumerate(self.children[:3]):
+			holder.update('childKey', i)
+		self.p.clearAllCaches()
+
+	def tearDown(self):
+		for holder in [self.p] + self.children:
+			holder.clear()
+		if os.path.exists(self.snapshotPath):
+			os.remove(self.snapshotPath)
+
+	def testPreload(self):
+		self.assertEqual(exportSnapshot(self.children, self.snapshotPath), 5)
+		self.p.clearAllCaches()
+
+		#Changed by another process after the export.
+		self.children[1].update('childKey', 'changed')
+		self.p.clearAllCaches()
+
+		self.assertEqual(importSnapshot(self.snapshotPath, self.children), 4)
+		self.p.enableMetrics()
+		self.p.resetMetrics()
+		try:
+			self.assertEqual(self.children[0].getDict(), {'someKey': 1, 'status': u'approved', 'childKey': 0})
+			self.assertEqual(self.children[3].getDict(), {'someKey': 1, 'status': u'approved'})
+			self.assertEqual(self.p.getMetrics()['total']['reads'], 0)
+			self.assertEqual(self.children[1].get('childKey'), 'changed')
+			self.assertEqual(self.p.getMetrics()['total']['reads'], 1)
+		finally:
+			self.p.disableMetrics()
+
+	def testWriteBack(self):
+		exportSnapshot(self.children, self.snapshotPath)
+		self.p.update('someKey', 2)
+		self.children[0].clear()
+		self.children[3].update('childKey', 3)
+
+		self.assertEqual(importSnapshot(self.snapshotPath, self.children[:1], writeBack=True), 2)
+		self.p.clearAllCaches()
+		self.assertEqual(self.children[0].getDict(), {'someKey': 1, 'status': u'approved', 'childKey': 0})
+		self.assertEqual(self.children[3].getDictWithoutInheritance(), {'childKey': 3}) #Not imported.
+
+	def testInvalidSnapshot(self):
+		with open(self.snapshotPath, 'w') as f:
+			f.write('{"entries": []}')
+		self.assertRaises(MyException, importSnapshot, self.snapshotPath, self.children)
+
+
+#============================================================================
+#============================================================================
+if __name__ == "__main__":
+	unittest.main()
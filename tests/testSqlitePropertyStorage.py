@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest, inspect
+from hohehohe2.utils.propertyHolder import PropertyHolder, PropertyVersionConflictError
+from hohehohe2.utils.sqlitePropertyStorage import SqlitePropertyStorage
+
+
+#============================================================================
+#============================================================================
+def _getDbPath():
+	thisDirPath = os.path.dirname(inspect.getabsfile(TestSqlitePropertyStorage))
+	return os.path.join(thisDirPath, 'properties', 'properties.db')
+
+
+#============================================================================
+#============================================================================
+class SqlitePropertyHolder(PropertyHolder):
+	storage = None
+
+	def __init__(self, name, parent):
+		super(SqlitePropertyHolder, self).__init__(parent)
+		self.name = name
+
+	def _getPropertyFilePath(self):
+		return '/' + self.name
+
+	def _getPropertyStorage(self):
+		return self.storage
+
+
+#============================================================================
+#============================================================================
+class TestSqlitePropertyStorage(unittest.TestCase):
+
+	def setUp(self):
+		self.__deleteDb()
+		SqlitePropertyHolder.storage = SqlitePropertyStorage(_getDbPath())
+		self.p = SqlitePropertyHolder('parent', None)
+		self.c = SqlitePropertyHolder('child', self.p)
+		self.p.clearAllCaches()
+
+	def tearDown(self):
+		SqlitePropertyHolder.storage = None
+		self.p.clearAllCaches()
+		self.__deleteDb()
+
+	def __deleteDb(self):
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(_getDbPath() + suffix):
+				os.remove(_getDbPath() + suffix)
+
+	def testReadWhileNoDataExists(self):
+		self.assertEqual(self.p.get('someKey'), None)
+		self.assertEqual(self.p.getDict(), {})
+
+	def testReadWrite(self):
+		self.p.update('someKey', 1)
+		self.assertEqual(self.p.get('someKey'), 1)
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.get('someKey'), 1)
+
+	def testInheritance(self):
+		self.p.updateDict({'someKey': 1, 'someOtherKey': 2})
+		self.c.update('someKey', 3)
+		self.assertEqual(self.c.getDict(), {'someKey': 3, 'someOtherKey': 2})
+		self.assertEqual(self.c.getDictWithoutInheritance(), {'someKey': 3})
+
+	def testRemoveAndClear(self):
+		self.p.updateDict({'someKey': 1, 'someOtherKey': 2})
+		self.assertEqual(self.p.remove('someKey'), {'someOtherKey': 2})
+		self.p.clear()
+		self.p.clearAllCaches()
+		self.assertEqual(self.p.getDict(), {})
+		self.assertEqual(SqlitePropertyHolder.storage.stat(self.p._getPropertyFilePath()), None)
+
+	def testStampChangesOnWrite(self):
+		storage = SqlitePropertyHolder.storage
+		self.p.update('someKey', 1)
+		stamp, size = storage.stat(self.p._getPropertyFilePath())
+		self.p.clear()
+		self.p.update('someKey', 1)
+		self.assertNotEqual(storage.stat(self.p._getPropertyFilePath())[0], stamp) #Never goes back to an old stamp.
+
+	def testUpdateFromAnotherConnection(self):
+		self.p.update('someKey', 1)
+		another = SqlitePropertyStorage(_getDbPath())
+		another.applyChanges(self.p._getPropertyFilePath(), {'someKey': 2}, (), False, None)
+		self.assertEqual(self.p._getPropertyStorage().read(self.p._getPropertyFilePath(), None)[0], {'someKey': 2})
+
+	def testVersionedUpdate(self):
+		self.p.update('someKey', 1, expectedVersion=0)
+		version = self.p.getVersion()
+		another = SqlitePropertyStorage(_getDbPath())
+		another.applyChanges(self.p._getPropertyFilePath(), {'someKey': 2}, (), False, None)
+		self.assertRaises(PropertyVersionConflictError, self.p.update, 'someKey', 3, version)
+		self.assertEqual(self.p.update('someKey', 3, self.p.getVersion()), {'someKey': 3})
+
+		#Checked in the same database transaction as the write.
+		self.assertRaises(PropertyVersionConflictError, another.applyChanges, self.p._getPropertyFilePath(), {'someKey': 4}, (), False, None, None, version)
+		self.assertEqual(another.read(self.p._getPropertyFilePath(), None)[0], {'someKey': 3})
+
+
+#============================================================================
+#============================================================================
+if __name__ == "__main__":
+	unittest.main()